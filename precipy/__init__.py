@@ -1,5 +1,9 @@
 PRECIPY_VERSION="0.3.0"
 
+# Increment this whenever a change to precipy means previously cached results
+# can no longer be used. Other precipy changes don't invalidate the cache.
+CACHE_FORMAT_VERSION=2
+
 class PrecipyException(Exception):
     pass
 
@@ -1,41 +1,147 @@
 from pathlib import Path
+from precipy.cache import TieredCache
+from precipy.figures import FigureRenderer
 from precipy.identifiers import FileType
 from precipy.identifiers import GeneratedFile
 from precipy.identifiers import hash_for_fn
 from precipy.identifiers import hash_for_supplemental_file
+from precipy.locking import FileLock
+from precipy.locking import atomic_path
+from precipy.locking import atomic_write
+from precipy.memory import MemoryTracker
+from precipy.partitions import RESERVED_KWARGS
+from precipy.partitions import partition_results
+import asyncio
+import collections
+import contextlib
+import io
 import os
 import pickle
 import shutil
 import tempfile
+import threading
 import time
 import inspect
 
+def dump_metadata(meta, f):
+    """
+    Writes metadata to f as two pickles, a header with just the list of
+    files followed by the full metadata, so the list of files can be read
+    without unpickling the function's output.
+    """
+    pickle.dump({ 'files' : meta['files'] }, f)
+    pickle.dump(meta, f)
+
+def load_metadata_header(f):
+    return pickle.load(f)
+
+def load_metadata(f):
+    load_metadata_header(f)
+    return pickle.load(f)
+
+class ModuleConstants(object):
+    """
+    Sets a config's constants as globals of an analytics module while
+    functions from it are hashed or run, and restores the module's own
+    values afterwards. Functions using the same constants can run at the
+    same time, while functions using different constants, from configs
+    rendered concurrently, wait for each other, so a function never runs
+    with another config's constants.
+    """
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def for_function(klass, fn):
+        module_globals = fn.__globals__
+        with klass.instances_lock:
+            if not id(module_globals) in klass.instances:
+                klass.instances[id(module_globals)] = klass(module_globals)
+            return klass.instances[id(module_globals)]
+
+    def __init__(self, module_globals):
+        self.module_globals = module_globals
+        self.condition = threading.Condition()
+        self.applied = None
+        self.originals = {}
+        self.n_users = 0
+
+    def acquire(self, constants):
+        constants = dict(constants or {})
+        with self.condition:
+            while self.n_users > 0 and self.applied != constants:
+                self.condition.wait()
+            if self.n_users == 0:
+                self.originals = dict((k, self.module_globals[k]) for k in constants if k in self.module_globals)
+                self.module_globals.update(constants)
+                self.applied = constants
+            self.n_users += 1
+
+    def release(self):
+        with self.condition:
+            self.n_users -= 1
+            if self.n_users == 0:
+                for k in self.applied:
+                    if k in self.originals:
+                        self.module_globals[k] = self.originals[k]
+                    else:
+                        del self.module_globals[k]
+                self.applied = None
+                self.originals = {}
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def applied_constants(self, constants):
+        self.acquire(constants)
+        try:
+            yield
+        finally:
+            self.release()
+
 class AnalyticsFunction(object):
     metadata_filename = "metadata.pkl"
-    metadata_keys = ["function_name", "function_source", "function_output", "kwargs", "files", "function_elapsed_seconds"]
+    metadata_keys = ["function_name", "function_source", "function_output", "kwargs", "files",
+            "function_elapsed_seconds", "function_peak_rss_bytes", "function_peak_alloc_bytes"]
 
-    def __init__(self, fn, kwargs, key=None, previous_functions=None, storages=None, cachePath=None, constants=None):
+    def __init__(self, fn, kwargs, key=None, previous_functions=None, storages=None, cachePath=None, constants=None,
+            track_memory=False, track_allocations=False, cache=None, figures=None):
         """
         Arguments:
 
             fn - a function object representing the analytics function to be called
             kwargs - a dictionary of argument names and values to be passed to the function when called
             previous_functions - a dictionary of function keys:hashcodes for previously run functions
+            storages - list of storages to use as cache tiers, if cache isn't given
             cachePath - an optional Path object representing the Batch's cache path, can be blank for testing
+            constants - dictionary of config constants, set as globals of fn's module while fn is hashed and run
+            track_memory - whether to record the peak increase in RSS while the function runs
+            track_allocations - whether to record peak memory allocated by python code using tracemalloc, which is slower
+            cache - the Batch's TieredCache, if not given one is made from cachePath and storages
+            figures - the Batch's FigureRenderer, if not given figures are rendered in this process
         """
         self.is_populated = False
         self.key = key or fn.__name__
         self.fn = fn
-        for k, v in (constants or {}).items():
-            self.fn.__globals__[k] = v
-        self.kwargs = kwargs
+        self.constants = constants or {}
+        self.module_constants = ModuleConstants.for_function(fn)
+        self.kwargs = dict(kwargs)
         self.args = self.kwargs
         self.previous_functions = previous_functions or []
-        self.generate_hash(self.fn, self.kwargs)
-        self.set_cache_path(cachePath)
+        # for reduce functions, the partition keys:AnalyticsFunctions
+        self.partition_functions = collections.OrderedDict()
+        # the hash includes the values of constants the function refers to
+        with self.module_constants.applied_constants(self.constants):
+            self.generate_hash(self.fn, self.kwargs)
+        self.set_cache(cache, cachePath, storages)
         self.setup_files()
         self.function_output = None
-        self.storages = storages or []
+        self.track_memory = track_memory
+        self.track_allocations = track_allocations
+        self.figures = figures or FigureRenderer()
+        self.pending_figures = []
+        # set once a checkpoint has been saved or restored, so functions
+        # which don't checkpoint don't delete one from every storage
+        self.checkpointed = False
         self.function_name = self.fn.__name__
         self.function_source = inspect.getsource(self.fn)
 
@@ -52,14 +158,18 @@ class AnalyticsFunction(object):
 
         self.h = hash_for_fn(fn, kwargs, self.depends_function_hashes)
             
-    def set_cache_path(self, cachePath):
+    def set_cache(self, cache, cachePath, storages):
         """
-        Utility for setting a safe cachePath when one is not supplied - intended for testing.
+        Uses cache if given, otherwise makes one, using a safe cachePath when
+        one is not supplied - intended for testing.
         """
-        if cachePath == None:
-            tempdir = tempfile.gettempdir()
-            cachePath = Path(tempdir) / "precipy" / "cache"
-        self.cachePath = cachePath
+        if cache is None:
+            if cachePath == None:
+                tempdir = tempfile.gettempdir()
+                cachePath = Path(tempdir) / "precipy" / "cache"
+            cache = TieredCache(cachePath, storages)
+        self.cache = cache
+        self.cachePath = cache.cachePath
 
     def setup_files(self):
         self.files = {}
@@ -72,32 +182,124 @@ class AnalyticsFunction(object):
         Returns a Path to the directory in which a cache file should be stored,
         creating the directory if it doesn't exist.
         """
-        prefix = h[0:2]
-        parent_dir = self.cachePath / prefix
-        os.makedirs(parent_dir, exist_ok=True)
-        return parent_dir
+        return self.cache.disk.directory(h)
+
+    def lock(self):
+        """
+        Returns a FileLock which is held while this function's results are
+        being computed, so concurrent runs sharing a cache wait for each
+        other instead of duplicating work.
+        """
+        lock_filepath = self.cache_dir(self.h) / ("%s.lock" % self.h)
+        return FileLock(lock_filepath, "%s (%s)" % (self.key, self.h))
 
     def call_function(self):
-        kwargs = dict((k, v) for k, v in self.kwargs.items() if k != 'function_name')
+        kwargs = dict((k, v) for k, v in self.kwargs.items() if not k in RESERVED_KWARGS)
+        if 'partition_keys' in self.kwargs:
+            kwargs['results'] = partition_results(self)
         return self.fn(self, **kwargs)
 
+    def read_output(self, fn_key):
+        """
+        Returns the output of a previously run function, read from its
+        cached metadata.
+        """
+        fn_h = self.previous_functions[fn_key]
+        meta = load_metadata(io.BytesIO(self.cache.read_bytes("%s.pkl" % fn_h)))
+        return meta['function_output']
+
+    def checkpoint_cache_filename(self):
+        return "%s.checkpoint.pkl" % self.h
+
+    def checkpoint(self, state):
+        """
+        Saves state, which can be any picklable object, so that if this
+        function is interrupted it can resume from here when it's run again.
+        The checkpoint is written atomically to the local cache and then to
+        storages, and is removed once the function completes.
+        """
+        filepath = self.cache.filepath(self.checkpoint_cache_filename())
+        with atomic_write(filepath, 'wb') as f:
+            pickle.dump(state, f)
+        self.cache.store(filepath)
+        self.checkpointed = True
+
+    def restore(self, default=None):
+        """
+        Returns the state saved by the last call to checkpoint() in an
+        earlier, interrupted run of this function, or default if there
+        isn't one.
+        """
+        checkpoint_filename = self.checkpoint_cache_filename()
+        if not self.cache.ensure_local(checkpoint_filename):
+            return default
+        self.checkpointed = True
+        with open(self.cache.filepath(checkpoint_filename), 'rb') as f:
+            return pickle.load(f)
+
+    def discard_checkpoint(self):
+        """
+        Removes the checkpoint once the function has completed, if it saved
+        or restored one.
+        """
+        if self.checkpointed:
+            self.cache.discard(self.checkpoint_cache_filename())
+            self.checkpointed = False
+
     def run_function(self):
-        start_time = time.time()
-        self.function_output = self.call_function()
-        self.function_elapsed_seconds = time.time() - start_time
+        with MemoryTracker(self.track_memory, self.track_allocations) as tracker:
+            start_time = time.time()
+            succeeded = False
+            try:
+                with self.module_constants.applied_constants(self.constants):
+                    self.function_output = self.call_function()
+                succeeded = True
+            finally:
+                self.wait_for_figures(discard=not succeeded)
+            self.function_elapsed_seconds = time.time() - start_time
+        self.function_peak_rss_bytes = tracker.peak_rss_bytes
+        self.function_peak_alloc_bytes = tracker.peak_alloc_bytes
         self.save_metadata()
+        self.discard_checkpoint()
         return self.function_metadata()
 
-    def upload_to_storages(self, canonical_filename, cache_filepath):
-        for storage in self.storages:
-            public_url = storage.upload_cache(cache_filepath)
-            self.files[canonical_filename].public_urls.append(public_url)
+    def is_coroutine_function(self):
+        return inspect.iscoroutinefunction(self.fn)
+
+    async def run_function_async(self):
+        """
+        Awaits an async def analytics function on the running event loop.
+        Metadata is saved and uploaded, and any checkpoint removed, in the
+        default executor. Memory is
+        tracked as in run_function, and isn't recorded for functions awaited
+        at the same time as others, see MemoryTracker.
+        """
+        loop = asyncio.get_running_loop()
+        with MemoryTracker(self.track_memory, self.track_allocations) as tracker:
+            start_time = time.time()
+            # waiting for functions with other constants mustn't block the event loop
+            await loop.run_in_executor(None, self.module_constants.acquire, self.constants)
+            succeeded = False
+            try:
+                self.function_output = await self.call_function()
+                succeeded = True
+            finally:
+                self.module_constants.release()
+                await loop.run_in_executor(None, self.wait_for_figures, not succeeded)
+            self.function_elapsed_seconds = time.time() - start_time
+        self.function_peak_rss_bytes = tracker.peak_rss_bytes
+        self.function_peak_alloc_bytes = tracker.peak_alloc_bytes
+        await loop.run_in_executor(None, self.save_metadata)
+        if self.checkpointed:
+            await loop.run_in_executor(None, self.discard_checkpoint)
+        return self.function_metadata()
 
-    def download_from_storages(self, cache_filepath):
-        for storage in self.storages:
-            if storage.download_cache(cache_filepath):
-                return True
-        return False
+    def write_back(self, canonical_filename):
+        """
+        Writes a file in the local cache back to the other cache tiers.
+        """
+        gf = self.files[canonical_filename]
+        self.cache.store(gf.cache_filepath, on_upload=gf.public_urls.append)
 
     def function_metadata(self):
         return dict((k, getattr(self, k, None)) for k in self.metadata_keys)
@@ -106,40 +308,58 @@ class AnalyticsFunction(object):
         return "%s.pkl" % self.h
 
     def metadata_cache_filepath(self):
-        return self.cache_dir(self.h) / self.metadata_cache_filename()
+        return self.cache.filepath(self.metadata_cache_filename())
 
     def metadata_path_exists(self):
-        return os.path.exists(self.metadata_cache_filepath())
+        return self.cache.exists_locally(self.metadata_cache_filename())
 
     def save_metadata(self):
         filepath = self.metadata_cache_filepath()
-        with open(filepath, 'wb') as f:
-            pickle.dump(self.function_metadata(), f)
-        self.upload_to_storages(self.metadata_filename, filepath)
+        with atomic_write(filepath, 'wb') as f:
+            dump_metadata(self.function_metadata(), f)
+        self.write_back(self.metadata_filename)
     
     def read_metadata(self):
         with open(self.metadata_cache_filepath(), 'rb') as f:
-            return pickle.load(f)
+            return load_metadata(f)
 
-    def load_metadata(self):
-        meta = self.read_metadata()
+    def load_metadata(self, data=None):
+        """
+        Populates this object from its cached metadata, or from data if
+        given, which should be the pickled metadata already read from the
+        cache.
+        """
+        if data is None:
+            meta = self.read_metadata()
+        else:
+            meta = load_metadata(io.BytesIO(data))
         for k, v in meta.items():
             setattr(self, k, v)
+
+        # metadata may have been written on another machine with a different cache path
+        for canonical_filename, gf in self.files.items():
+            if canonical_filename == self.metadata_filename:
+                gf.cache_filepath = self.metadata_cache_filepath()
+            else:
+                gf.cache_filepath = self.supplemental_file_cache_filepath(canonical_filename)
+
         self.is_populated = True
         return meta
 
     def supplemental_file_hash(self, canonical_filename, fn_h=None):
         return hash_for_supplemental_file(canonical_filename, fn_h or self.h)
 
-    def supplemental_file_cache_filepath(self, canonical_filename, fn_h=None):
+    def supplemental_file_cache_filename(self, canonical_filename, fn_h=None):
         ext = os.path.splitext(canonical_filename)[1]
         h = self.supplemental_file_hash(canonical_filename, fn_h)
-        cache_filename = "%s%s" % (h, ext)
-        return self.cache_dir(h) / cache_filename
+        return "%s%s" % (h, ext)
+
+    def supplemental_file_cache_filepath(self, canonical_filename, fn_h=None):
+        return self.cache.filepath(self.supplemental_file_cache_filename(canonical_filename, fn_h))
 
     def generate_file(self, canonical_filename, mode='w'):
         cache_filepath = self.supplemental_file_cache_filepath(canonical_filename)
-        with open(cache_filepath, mode) as f:
+        with atomic_write(cache_filepath, mode) as f:
             yield f
         self.append_generated_file(canonical_filename)
 
@@ -147,7 +367,8 @@ class AnalyticsFunction(object):
         if canonical_filename is None:
             canonical_filename = os.path.basename(filepath)
         cache_filepath = self.supplemental_file_cache_filepath(canonical_filename)
-        shutil.copyfile(filepath, cache_filepath)
+        with atomic_path(cache_filepath) as tmp_filepath:
+            shutil.copyfile(filepath, tmp_filepath)
         self.append_generated_file(canonical_filename)
         if remove:
             os.remove(filepath)
@@ -157,6 +378,8 @@ class AnalyticsFunction(object):
             fn_h = self.previous_functions[fn_key]
         else:
             fn_h = self.h
+        # supplemental files which weren't prefetched are downloaded when first read
+        self.cache.ensure_local(self.supplemental_file_cache_filename(canonical_filename, fn_h))
         return self.supplemental_file_cache_filepath(canonical_filename, fn_h)
 
     def read_file(self, canonical_filename, fn_key=None, mode='r'):
@@ -164,6 +387,46 @@ class AnalyticsFunction(object):
         with open(cache_filepath, mode) as f:
             yield f
 
+    def save_figure(self, fig, name, formats=("png",), **savefig_kwargs):
+        """
+        Saves a matplotlib figure as name.<format> for each of formats,
+        rendering it straight into the cache, in a background process if the
+        batch has figure_workers. The figure can be changed or closed as soon
+        as this returns, and the files are added to this function's files
+        once it completes. Returns the list of canonical filenames.
+        """
+        canonical_filenames = ["%s.%s" % (name, fmt) for fmt in formats]
+        targets = [(fmt, str(self.supplemental_file_cache_filepath(canonical_filename)))
+                for fmt, canonical_filename in zip(formats, canonical_filenames)]
+        future = self.figures.submit(fig, targets, savefig_kwargs)
+        self.pending_figures.append((future, canonical_filenames))
+        return canonical_filenames
+
+    def wait_for_figures(self, discard=False):
+        """
+        Waits for figures queued by save_figure and adds their files. With
+        discard, used when the function failed, the rendered files are
+        removed instead and rendering errors are ignored.
+        """
+        pending, self.pending_figures = self.pending_figures, []
+        for future, canonical_filenames in pending:
+            if discard:
+                # the function's own error is the one to report
+                try:
+                    future.result()
+                except Exception:
+                    pass
+                for canonical_filename in canonical_filenames:
+                    try:
+                        os.remove(self.supplemental_file_cache_filepath(canonical_filename))
+                    except FileNotFoundError:
+                        pass
+                continue
+
+            self.figures.wait(future, ", ".join(canonical_filenames))
+            for canonical_filename in canonical_filenames:
+                self.append_generated_file(canonical_filename)
+
     def append_generated_file(self, canonical_filename):
         """
         Adds file to list of supplemental files.
@@ -175,4 +438,4 @@ class AnalyticsFunction(object):
         h = self.supplemental_file_hash(self.h, canonical_filename)
         self.files[canonical_filename] = GeneratedFile(canonical_filename, h, cache_filepath = filepath)
 
-        self.upload_to_storages(canonical_filename, filepath)
+        self.write_back(canonical_filename)
@@ -1,56 +1,114 @@
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
-from jinja2 import select_autoescape
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from precipy import PrecipyException
+from precipy import ReportTemplateException
 from precipy.analytics_function import AnalyticsFunction
+from precipy.analytics_function import load_metadata_header
+from precipy.cache import TieredCache
+from precipy.context import RenderContext
 from precipy.identifiers import FileType
 from precipy.identifiers import GeneratedFile
+from precipy.identifiers import hash_for_dict
 from precipy.identifiers import hash_for_document
 from precipy.identifiers import hash_for_template_file
 from precipy.identifiers import hash_for_template_text
+from precipy.locking import atomic_path
+from precipy.locking import atomic_write
+from precipy.memory import MemoryLedger
+from precipy.memory import parse_memory
+from precipy.partitions import BUILTIN_FUNCTIONS
+from precipy.partitions import is_partitioned
+from precipy.partitions import partition_entries
+from precipy.publish import OutputDirectory
+from precipy.publish import output_name
+from precipy.publish import publish_hash
+from precipy.scheduling import CostModel
+from precipy.template_data import TemplateDataReader
 from uuid import uuid4
+import asyncio
+import contextlib
 import datetime
 import glob
 import itertools
-import json
 import logging
 import os
-import precipy.jinja_filters as jinja_filters
 import precipy.output_filters as output_filters
+import re
 import shutil
 import tempfile
+import threading
+import time
+
+# logging handlers added by batches, keyed by logfile, None for stderr
+LOG_HANDLERS = {}
+LOG_HANDLERS_LOCK = threading.Lock()
 
 def generate_range_key(range_env):
     return "__".join("%s_%s" % (k, range_env[k]) for k in sorted(range_env))
 
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form "i/N", where i is between 1 and
+    N, returning a tuple of (zero-based shard index, number of shards).
+    """
+    try:
+        index, count = [int(x) for x in str(shard).split("/")]
+    except ValueError:
+        raise PrecipyException("shard should be of the form i/N, got '%s'" % shard)
+    if count < 1 or index < 1 or index > count:
+        raise PrecipyException("shard %s is out of range, i must be between 1 and N" % shard)
+    return index - 1, count
+
 class Batch(object):
-    def __init__(self, config):
+    def __init__(self, config, context=None):
+        """
+        Arguments:
+
+            config - dictionary of configuration options, usually loaded from a JSON config file
+            context - a RenderContext shared with other batches in this process, if not given the batch gets its own
+        """
         self.orig_dir = os.getcwd()
         self.config = config
+        self.owns_context = context is None
+        self.context = context or RenderContext()
         self.h = str(uuid4())
         self.setup_logging()
         self.setup_work_dirs()
         self.setup_template_environment()
         self.setup_document_templates()
         self.setup_storages()
+        self.setup_cache()
+        self.setup_filter_engine()
+        self.setup_figure_renderer()
+        self.executor = None
         self.functions = {}
+        self.function_summary = {}
+        # keys of the ranges whose functions and documents are still held
+        self.range_keys = []
+        # keys of every range processed so far, for the 'keys' template variable
+        self.processed_range_keys = []
+        self.shared_functions = {}
         self.function_meta = {}
         self.documents = {}
 
     def setup_logging(self):
         self.logger = logging.getLogger(name="precipy")
 
-        if "logfile" in self.config:
-            handler = logging.FileHandler(self.config['logfile'])
-        else:
-            # log to stderr if no logfile specified
-            handler = logging.StreamHandler()
-
+        # batches in the same process share a handler for each destination
+        destination = self.config.get('logfile')
         level = self.config.get('loglevel', "INFO")
-        handler.setLevel(level)
+        with LOG_HANDLERS_LOCK:
+            if not destination in LOG_HANDLERS:
+                if destination:
+                    handler = logging.FileHandler(destination)
+                else:
+                    # log to stderr if no logfile specified
+                    handler = logging.StreamHandler()
+                LOG_HANDLERS[destination] = handler
+                self.logger.addHandler(handler)
+            LOG_HANDLERS[destination].setLevel(level)
         self.logger.setLevel(level)
 
-        self.logger.addHandler(handler)
         self.logger.info("logging!")
 
     def setup_work_dirs(self):
@@ -63,37 +121,74 @@ class Batch(object):
         self.cachePath = self.tempdir / self.cache_bucket_name
         self.outputPath = self.tempdir / self.output_bucket_name
         self.localOutputPath = Path(self.output_bucket_name)
+        # batches rendered together each publish to their own subdirectory
+        self.output_subdir = self.config.get('output_subdir')
+        if self.output_subdir:
+            self.outputPath = self.outputPath / self.output_subdir
+            self.localOutputPath = self.localOutputPath / self.output_subdir
 
         os.makedirs(self.cachePath, exist_ok=True)
-        shutil.rmtree(self.outputPath, ignore_errors=True)
         os.makedirs(self.outputPath, exist_ok=True)
+        self.output_dirs = None
+        # range keys published by a sharded run, which owns only their outputs
+        self.published_range_keys = set()
+        self.created_output_paths = set()
+        self.uploaded_cache_files = set()
+        self.cost_model = CostModel(self.cachePath)
+        max_memory = parse_memory(self.config.get('max_memory'))
+        if max_memory:
+            self.memory_ledger = MemoryLedger(self.cachePath / "memory", max_memory)
+        else:
+            self.memory_ledger = None
 
     def rangeOutputPath(self):
         path = self.outputPath / self.current_range_key
-        os.makedirs(path, exist_ok=True)
+        if not path in self.created_output_paths:
+            os.makedirs(path, exist_ok=True)
+            self.created_output_paths.add(path)
         return path
 
     def setup_template_environment(self):
         self.template_dir = self.config.get('template_dir', "templates")
 
-        self.jinja_env = Environment(
-            loader = FileSystemLoader(self.template_dir),
-            autoescape=select_autoescape(['html', 'xml']))
-
-        self.jinja_env.filters['highlight'] = jinja_filters.highlight
+        if self.config.get('cache_highlighting', True):
+            highlight_cachePath = self.cachePath / "highlight"
+        else:
+            highlight_cachePath = None
+        self.jinja_env = self.context.jinja_env(self.template_dir, highlight_cachePath,
+                sandboxed=self.config.get('sandbox', False))
 
         self.template_data = {}
 
     def setup_storages(self):
         self.storages = self.config.get('storages', [])
         for storage in self.storages:
-            storage.init(self)
-            storage.connect()
+            self.context.connect_storage(storage, self)
+
+    def setup_cache(self):
+        """
+        Sets up the cache tiers: memory (shared with batches using the same
+        context), the local cache directory and the storages. See
+        precipy/cache.py for the write back policies.
+        """
+        memory = self.context.memory_tier(
+                max_bytes=self.config.get('memory_cache_bytes'),
+                write_back=self.config.get('memory_write_back', "none"))
+        self.cache = TieredCache(self.cachePath, self.storages, memory,
+                write_back=self.config.get('storage_write_back', "sync"))
+
+    def setup_filter_engine(self):
+        self.filter_engine = self.context.filter_engine(
+                workers=self.config.get('filter_workers', 0),
+                timeout=self.config.get('filter_timeout'),
+                executables=self.config.get('filter_executables'),
+                custom_filter_fns=self.config.get('custom_render_fns'))
+
+    def setup_figure_renderer(self):
+        self.figure_renderer = self.context.figure_renderer(self.config.get('figure_workers', 0))
 
     def upload_to_storages_cache(self, f):
-        for storage in self.storages:
-            public_url = storage.upload_cache(f.cache_filepath)
-            f.public_urls.append(public_url)
+        self.cache.store(f.cache_filepath, on_upload=f.public_urls.append)
 
     def setup_document_templates(self):
         self.logger.info("Collecting list of document templates to process...")
@@ -122,23 +217,212 @@ class Batch(object):
     def init_range(self, range_env):
         self.current_range_env = range_env
         self.current_range_key = generate_range_key(range_env)
+        self.range_keys.append(self.current_range_key)
+        self.processed_range_keys.append(self.current_range_key)
         self.functions[self.current_range_key] = {}
         self.documents[self.current_range_key] = {}
 
     def run(self, analytics_modules):
-        for range_env in self.range_environments():
-            self.init_range(range_env)
-            self.generate_analytics(analytics_modules)
+        prefetching = self.storages and self.config.get('prefetch', True)
+        try:
+            previous_range_key = None
+            for range_envs in self.range_environment_chunks():
+                if prefetching:
+                    self.prefetch(analytics_modules, range_envs)
+                for range_env in range_envs:
+                    self.init_range(range_env)
+                    self.generate_analytics(analytics_modules)
+                    self.generate_and_publish_documents()
+                    if previous_range_key is not None and not self.config.get('keep_range_state', False):
+                        self.release_range(previous_range_key)
+                    previous_range_key = self.current_range_key
+            self.cache.flush()
+            self.finish_publishing()
+        finally:
+            self.cost_model.flush()
+            # stops filter and figure worker processes even if rendering failed
+            if self.owns_context:
+                self.context.shutdown()
+        self.log_summary()
+
+    def generate_and_publish_documents(self):
+        # filters running in this process change the working directory, which
+        # other batches rendering at the same time rely on
+        cwd_lock = output_filters.cwd_lock if self.filter_engine.workers == 0 else contextlib.nullcontext()
+        with self.context.document_lock(self.localOutputPath), cwd_lock:
             self.generate_documents()
             self.publish_documents()
 
+    async def run_async(self, analytics_modules):
+        """
+        Asyncio version of run. Analytics functions in each range run
+        concurrently, see generate_analytics_async, and rendering, filtering
+        and publishing run in the batch's executor so they don't block the
+        event loop.
+        """
+        loop = asyncio.get_running_loop()
+        prefetching = self.storages and self.config.get('prefetch', True)
+        try:
+            previous_range_key = None
+            for range_envs in self.range_environment_chunks():
+                if prefetching:
+                    await loop.run_in_executor(self.get_executor(), self.prefetch, analytics_modules, range_envs)
+                for range_env in range_envs:
+                    self.init_range(range_env)
+                    await self.generate_analytics_async(analytics_modules)
+                    await loop.run_in_executor(self.get_executor(), self.generate_and_publish_documents)
+                    if previous_range_key is not None and not self.config.get('keep_range_state', False):
+                        self.release_range(previous_range_key)
+                    previous_range_key = self.current_range_key
+            await loop.run_in_executor(self.get_executor(), self.cache.flush)
+            await loop.run_in_executor(self.get_executor(), self.finish_publishing)
+        finally:
+            self.cost_model.flush()
+            if self.owns_context:
+                self.context.shutdown()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        self.log_summary()
+
+    def get_executor(self):
+        """
+        Returns the thread pool used by run_async for blocking work, sized by
+        the executor_workers config value.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.config.get('executor_workers'))
+        return self.executor
+
+    def prefetch(self, analytics_modules, range_envs=None):
+        """
+        Resolves every analytics function in range_envs, or in every range
+        if not given, then downloads in parallel the metadata of functions
+        which are in storage but not in the local cache, followed by the
+        supplemental files this run will read: files of functions which
+        functions that still have to run depend on, files named in a
+        template, and files which an output location doesn't have yet.
+        Other supplemental files are only downloaded if something asks for
+        them.
+
+        Only the list of files at the start of each metadata file is read,
+        not the function's output.
+        """
+        from precipy.distributed import expand_tasks
+        tasks = expand_tasks(self, analytics_modules, range_envs)
+        if self.output_dirs is None:
+            self.start_publishing()
+
+        missing = [h for h in tasks if not self.cache.exists_locally("%s.pkl" % h)]
+        found = self.fetch_cache_files(["%s.pkl" % h for h in missing])
+        to_run = set(h for h in missing if not found["%s.pkl" % h])
+        cached = [h for h in tasks if not h in to_run]
+        read_by_functions = set(dep_h for h in to_run for dep_h in tasks[h].depends.values())
+        template_sources = self.template_sources()
+
+        filenames = []
+        for h in cached:
+            with open(self.cache.filepath("%s.pkl" % h), 'rb') as f:
+                files = load_metadata_header(f)['files']
+            for canonical_filename, gf in files.items():
+                if gf.file_type == FileType.METADATA:
+                    continue
+                cache_filename = Path(gf.cache_filepath).name
+                if self.cache.exists_locally(cache_filename):
+                    continue
+                if h in read_by_functions or canonical_filename in template_sources or any(
+                        self.output_needs(output_name(range_key, canonical_filename), publish_hash(gf))
+                        for range_key in tasks[h].range_keys):
+                    filenames.append(cache_filename)
+
+        self.fetch_cache_files(filenames, required=True)
+        self.logger.debug("prefetched metadata for %s functions and %s supplemental files, %s functions to run" % (
+            len(missing) - len(to_run), len(filenames), len(to_run)))
+
+    def fetch_cache_files(self, cache_filenames, required=False):
+        """
+        Makes sure files are in the local cache, downloading any which
+        aren't in parallel. Returns a dictionary of cache filename:True if
+        the file is available. If required, raises an exception if any
+        aren't.
+        """
+        with ThreadPoolExecutor(max_workers=self.config.get('prefetch_workers', 16)) as executor:
+            found = dict(zip(cache_filenames, executor.map(self.cache.ensure_local, cache_filenames)))
+        if required and not all(found.values()):
+            missing = [filename for filename, ok in found.items() if not ok]
+            raise PrecipyException("couldn't find %s in any cache tier" % ", ".join(missing))
+        return found
+
+    def template_sources(self):
+        """
+        Returns the text of all the templates, for checking which
+        supplemental files they refer to.
+        """
+        sources = []
+        for template_info in self.template_filenames:
+            if isinstance(template_info, dict):
+                template_info = template_info['file']
+            if template_info == "%s.md" % self.h:
+                sources.append(self.config['template'])
+            else:
+                try:
+                    with open(os.path.join(self.template_dir, template_info), 'r') as f:
+                        sources.append(f.read())
+                except (OSError, UnicodeDecodeError):
+                    continue
+        return "\n".join(sources)
+
+    def output_needs(self, name, h):
+        """
+        Returns True if publishing name with hash h would transfer it to any
+        output location.
+        """
+        return any(output_dir.needs(name, h) for output_dir in self.output_dirs) or any(
+                storage.output_needs(name, h, self.output_subdir) for storage in self.storages)
+
+    def release_range(self, range_key):
+        """
+        Frees the functions and documents of a range once they have been
+        published. Range-invariant functions are kept in shared_functions for
+        later ranges, and the most recent range is kept by run() so the batch
+        can still be inspected afterwards.
+        """
+        del self.functions[range_key]
+        del self.documents[range_key]
+        self.range_keys.remove(range_key)
+
+    def is_sharded(self):
+        return parse_shard(self.config.get('shard', "1/1"))[1] > 1
+
+    def range_environment_chunks(self):
+        """
+        Yields lists of up to prefetch_ranges consecutive range
+        environments, so the results for a chunk of ranges can be
+        prefetched together without resolving every range up front.
+        """
+        range_envs = self.range_environments()
+        chunk_size = self.config.get('prefetch_ranges', 100)
+        while True:
+            chunk = list(itertools.islice(range_envs, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
     def range_environments(self):
         """
-        Generates a list of dictionaries containing variable names and values
-        for every combination of the specified ranges.
+        Yields dictionaries containing variable names and values for every
+        combination of the specified ranges.
+
+        If a shard "i/N" is specified in the config, only every Nth
+        combination starting from the ith is yielded, so N separate runs
+        each process a deterministic, non-overlapping slice of the ranges.
         """
+        shard_index, shard_count = parse_shard(self.config.get('shard', "1/1"))
+
         if not 'ranges' in self.config:
-            return [{}]
+            if shard_index == 0:
+                yield {}
+            return
 
         var_names = sorted(self.config['ranges'])
         var_ranges = []
@@ -152,7 +436,9 @@ class Batch(object):
 
             var_ranges.append(rng)
 
-        return [dict(zip(var_names, var_values)) for var_values in itertools.product(*var_ranges)]
+        for i, var_values in enumerate(itertools.product(*var_ranges)):
+            if i % shard_count == shard_index:
+                yield dict(zip(var_names, var_values))
 
     ## Analytics
     def generate_analytics(self, analytics_modules):
@@ -164,45 +450,324 @@ class Batch(object):
         self.current_function_name = None
         self.current_function_data = None
 
+        invariant_keys = self.range_invariant_keys()
+
         previous_functions = {}
-        for key, kwargs in self.config.copy().get('analytics', []):
-            for k, v in self.current_range_env.items():
-                if k not in kwargs:
-                    continue
-                self.logger.debug("updating value for %s to %s" % (k, str(v)))
-                kwargs[k] = v
-            h = self.process_analytics_entry(key, kwargs, previous_functions)
+        for key, kwargs in self.config.get('analytics', []):
+            if key in self.shared_functions:
+                self.reuse_shared_function(key, previous_functions)
+                continue
+
+            kwargs = self.range_kwargs(kwargs, self.current_range_env)
+            if is_partitioned(kwargs):
+                h = self.process_partitioned_entry(key, kwargs, previous_functions)
+            else:
+                h = self.process_analytics_entry(key, kwargs, previous_functions)
             previous_functions[key] = h
 
+            if key in invariant_keys:
+                self.shared_functions[key] = self.functions[self.current_range_key][key]
+
         self.current_function_name = None
         self.current_function_data = None
 
+    def reuse_shared_function(self, key, previous_functions):
+        af = self.shared_functions[key]
+        self.logger.debug("reusing range-invariant function %s" % key)
+        for entry_key, entry_af in list(af.partition_functions.items()) + [(key, af)]:
+            self.functions[self.current_range_key][entry_key] = entry_af
+            previous_functions[entry_key] = entry_af.h
+
+    def range_kwargs(self, kwargs, range_env):
+        """
+        Returns a copy of kwargs with values of range variables replaced by
+        their values in range_env.
+        """
+        kwargs = dict(kwargs)
+        for k, v in range_env.items():
+            if k not in kwargs:
+                continue
+            self.logger.debug("updating value for %s to %s" % (k, str(v)))
+            kwargs[k] = v
+        return kwargs
+
+    def range_invariant_keys(self):
+        """
+        Returns the set of analytics keys whose kwargs don't include any range
+        variable, either directly or via the functions they depend on. These
+        only need to be resolved and loaded once per batch.
+        """
+        range_vars = set(self.config.get('ranges', {}))
+        invariant_keys = set()
+        for key, kwargs in self.config.get('analytics', []):
+            if range_vars.intersection(kwargs):
+                continue
+            if all(dep in invariant_keys for dep in kwargs.get('depends', [])):
+                invariant_keys.add(key)
+        return invariant_keys
+
     def process_analytics_entry(self, key, kwargs, previous_functions):
         af = self.resolve_function(key, kwargs, previous_functions)
+        self.ensure_analytics_results(af)
+        self.summarize_function(af)
+        self.functions[self.current_range_key][key] = af
+        return af.h
 
-        if af.metadata_path_exists():
-            af.load_metadata()
+    def resolve_entry(self, key, kwargs, previous_functions):
+        """
+        Resolves an analytics entry without running anything, returning a
+        list of (key, kwargs, af) in the order they must run. Partitioned
+        entries resolve to a function for each partition followed by the
+        reduce function, other entries to a single function.
+        previous_functions is updated with each function's hash.
+        """
+        if is_partitioned(kwargs):
+            entries = partition_entries(key, kwargs)
+        else:
+            entries = [(key, kwargs)]
 
-        if not af.metadata_path_exists():
-            if af.download_from_storages(af.metadata_cache_filepath()):
-                af.load_metadata()
-                for sf in af.files.values():
-                    filepath = af.supplemental_file_cache_filepath(sf.canonical_filename)
-                    if not af.download_from_storages(filepath):
-                        raise Exception("Couldn't download storage for %s" % filepath)
+        resolved = []
+        for entry_key, entry_kwargs in entries:
+            af = self.resolve_function(entry_key, entry_kwargs, previous_functions)
+            previous_functions[entry_key] = af.h
+            resolved.append((entry_key, entry_kwargs, af))
 
-        if not af.metadata_path_exists():
-            af.run_function()
-            af.is_populated = True
-            af.save_metadata()
-            af.from_cache = False
-        else:
-            if not af.is_populated:
-                af.load_metadata()
+        reduce_af = resolved[-1][2]
+        for entry_key, _, af in resolved[:-1]:
+            reduce_af.partition_functions[entry_key] = af
+        return resolved
 
+    def process_partitioned_entry(self, key, kwargs, previous_functions):
+        """
+        Ensures results for each partition of a partitioned entry, running
+        up to partition_workers of them at a time in threads, and then for
+        its reduce function.
+
+        Memory is measured for the whole process, so partitions running
+        alongside each other can't be measured separately. partition_workers
+        defaults to 1 when track_memory or track_allocations is set, and if
+        it's set higher, memory isn't tracked for the partitions.
+        """
+        resolved = self.resolve_entry(key, kwargs, previous_functions)
+        partition_afs = [af for _, _, af in resolved[:-1]]
+
+        tracking = self.config.get('track_memory', False) or self.config.get('track_allocations', False)
+        workers = self.config.get('partition_workers', 1 if tracking else os.cpu_count())
+        if tracking and workers > 1:
+            self.logger.debug("not tracking memory for %s partitions of %s run in parallel" % (len(partition_afs), key))
+            for af in partition_afs:
+                af.track_memory = False
+                af.track_allocations = False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() raises the first error from any partition
+            list(executor.map(self.ensure_analytics_results, partition_afs))
+
+        for entry_key, _, af in resolved[:-1]:
+            self.summarize_function(af)
+            self.functions[self.current_range_key][entry_key] = af
+
+        af = resolved[-1][2]
+        self.ensure_analytics_results(af)
+        self.summarize_function(af)
         self.functions[self.current_range_key][key] = af
         return af.h
 
+    def summarize_function(self, af):
+        """
+        Adds af to per-key totals of calls, cache hits, time and peak memory
+        which are logged at the end of the run.
+        """
+        # partitions are totalled together, as key[*]
+        summary_key = re.sub(r"\[.*\]$", "[*]", af.key)
+        summary = self.function_summary.setdefault(summary_key, {
+            "calls" : 0, "cached" : 0, "seconds" : 0.0, "peak_rss_bytes" : None, "peak_alloc_bytes" : None })
+        summary["calls"] += 1
+        if af.from_cache:
+            summary["cached"] += 1
+        else:
+            summary["seconds"] += af.function_elapsed_seconds or 0.0
+        for k in ("peak_rss_bytes", "peak_alloc_bytes"):
+            value = getattr(af, "function_%s" % k, None)
+            if value is not None:
+                summary[k] = max(summary[k] or 0, value)
+
+    def log_summary(self):
+        def mb(n_bytes):
+            return "-" if n_bytes is None else "%.1fMB" % (n_bytes / 1024.0 ** 2)
+
+        self.logger.info("%-30s %6s %6s %10s %10s %10s" % ("function", "calls", "cached", "seconds", "peak rss", "peak alloc"))
+        for key, summary in self.function_summary.items():
+            self.logger.info("%-30s %6s %6s %10.2f %10s %10s" % (key, summary["calls"], summary["cached"],
+                summary["seconds"], mb(summary["peak_rss_bytes"]), mb(summary["peak_alloc_bytes"])))
+
+    def ensure_analytics_results(self, af):
+        """
+        Populates af from the local cache, downloading its results from
+        storages or running the function if they aren't cached yet.
+        """
+        af.from_cache = True
+        if not af.metadata_path_exists():
+            # batches in other threads computing this hash are waited for
+            self.context.function_flights.do(af.h, self.compute_analytics_results, af)
+
+        if not af.is_populated:
+            af.load_metadata(self.cache.read_bytes(af.metadata_cache_filename()))
+            self.cost_model.record_cached(af)
+
+    def compute_analytics_results(self, af):
+        # if another process is computing this hash, wait for its result
+        with af.lock():
+            if not af.metadata_path_exists():
+                self.download_analytics_results(af)
+
+            if not af.metadata_path_exists():
+                reservation = self.reserve_memory(af)
+                try:
+                    af.run_function()
+                finally:
+                    self.release_memory(reservation)
+                af.is_populated = True
+                af.from_cache = False
+                self.cost_model.record_run(af)
+
+    def reserve_memory(self, af):
+        """
+        With a max_memory budget, waits until af's predicted memory use fits
+        alongside the functions running in precipy processes on this
+        machine, and reserves it. Returns the reservation's name for
+        release_memory, or None without a budget.
+        """
+        if self.memory_ledger is None:
+            return None
+        name = "%s-%s" % (af.h, uuid4().hex)
+        predicted = self.cost_model.estimate_memory(self.cost_model.cost_key(af))
+        while not self.memory_ledger.reserve(name, predicted):
+            time.sleep(self.config.get('memory_poll_seconds', 0.5))
+        return name
+
+    def release_memory(self, reservation):
+        if reservation is not None:
+            self.memory_ledger.release(reservation)
+
+    def download_analytics_results(self, af):
+        """
+        Downloads metadata and supplemental files for af from the storage
+        cache tiers, if available. Metadata is committed to the local cache
+        last so its presence there means all supplemental files are present
+        too.
+        """
+        metadata_filename = af.metadata_cache_filename()
+        with atomic_path(self.cache.filepath(metadata_filename)) as tmp_filepath:
+            if not self.cache.fetch(metadata_filename, tmp_filepath):
+                return False
+            with open(tmp_filepath, 'rb') as f:
+                files = load_metadata_header(f)['files']
+            for canonical_filename in files:
+                if canonical_filename == af.metadata_filename:
+                    continue
+                cache_filename = af.supplemental_file_cache_filename(canonical_filename)
+                if not self.cache.ensure_local(cache_filename):
+                    raise Exception("Couldn't download storage for %s" % cache_filename)
+        return True
+
+    async def generate_analytics_async(self, analytics_modules):
+        """
+        Like generate_analytics, but each entry starts as soon as the entries
+        listed in its depends are done rather than waiting for every earlier
+        entry. Functions written as async def are awaited on the event loop,
+        other functions run in the batch's executor, so a stage of I/O bound
+        functions takes about as long as the slowest one.
+        """
+        self.analytics_modules = analytics_modules
+
+        invariant_keys = self.range_invariant_keys()
+
+        previous_functions = {}
+        futures = {}
+        for key, kwargs in self.config.get('analytics', []):
+            if key in self.shared_functions:
+                self.reuse_shared_function(key, previous_functions)
+                continue
+
+            kwargs = self.range_kwargs(kwargs, self.current_range_env)
+            for entry_key, entry_kwargs, af in self.resolve_entry(key, kwargs, previous_functions):
+                depends = [futures[k] for k in entry_kwargs.get('depends', []) if k in futures]
+                futures[entry_key] = asyncio.ensure_future(self.ensure_analytics_results_async(af, depends))
+
+        try:
+            afs = await asyncio.gather(*futures.values())
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+
+        for af in afs:
+            self.summarize_function(af)
+            self.functions[self.current_range_key][af.key] = af
+            if af.key in invariant_keys:
+                self.shared_functions[af.key] = af
+
+    async def ensure_analytics_results_async(self, af, depends=None):
+        """
+        Asyncio version of ensure_analytics_results, which first waits for
+        the futures in depends. Returns af.
+        """
+        await asyncio.gather(*(depends or []))
+
+        loop = asyncio.get_running_loop()
+        if not af.is_coroutine_function():
+            await loop.run_in_executor(self.get_executor(), self.ensure_analytics_results, af)
+            return af
+
+        af.from_cache = True
+        if not af.metadata_path_exists():
+            lock = af.lock()
+            # not in the batch's executor, where blocking functions could
+            # hold every thread while waiting for this function
+            await loop.run_in_executor(None, lock.acquire)
+            try:
+                if not af.metadata_path_exists():
+                    await self.download_analytics_results_async(af)
+
+                if not af.metadata_path_exists():
+                    reservation = await loop.run_in_executor(None, self.reserve_memory, af)
+                    try:
+                        await af.run_function_async()
+                    finally:
+                        self.release_memory(reservation)
+                    af.is_populated = True
+                    af.from_cache = False
+                    await loop.run_in_executor(self.get_executor(), self.cost_model.record_run, af)
+            finally:
+                lock.release()
+
+        if not af.is_populated:
+            af.load_metadata()
+            self.cost_model.record_cached(af)
+        return af
+
+    async def download_analytics_results_async(self, af):
+        """
+        Asyncio version of download_analytics_results, supplemental files are
+        downloaded concurrently.
+        """
+        metadata_filename = af.metadata_cache_filename()
+        with atomic_path(self.cache.filepath(metadata_filename)) as tmp_filepath:
+            if not await self.cache.fetch_async(metadata_filename, tmp_filepath):
+                return False
+            with open(tmp_filepath, 'rb') as f:
+                files = load_metadata_header(f)['files']
+            cache_filenames = [af.supplemental_file_cache_filename(canonical_filename)
+                    for canonical_filename in files
+                    if canonical_filename != af.metadata_filename]
+            found = await asyncio.gather(*(self.cache.fetch_async(cache_filename)
+                for cache_filename in cache_filenames))
+            for cache_filename, ok in zip(cache_filenames, found):
+                if not ok:
+                    raise Exception("Couldn't download storage for %s" % cache_filename)
+        return True
+
     def resolve_function(self, key, kwargs, previous_functions):
         """
         Determines which function is to be run. Function name is generally the
@@ -230,10 +795,12 @@ class Batch(object):
 
         return AnalyticsFunction(fn, kwargs,
             previous_functions=previous_functions, 
-            storages=self.storages,
-            cachePath=self.cachePath,
+            cache=self.cache,
             constants=self.config.get('constants', None),
-            key=key
+            key=key,
+            track_memory=self.config.get('track_memory', False),
+            track_allocations=self.config.get('track_allocations', False),
+            figures=self.figure_renderer
             )
 
     def get_fn_object(self, module_name, function_name):
@@ -241,24 +808,36 @@ class Batch(object):
             if module_name != None and mod.__name__ != module_name:
                 pass
             else:
-                fn = getattr(mod, function_name)
+                fn = getattr(mod, function_name, None)
                 if fn is not None:
                     return fn
+        if module_name is None:
+            return BUILTIN_FUNCTIONS.get(function_name)
 
     def populate_template_data(self):
-        def read_file_contents(path):
-            with open(self.rangeOutputPath() / path, 'r') as f:
-                return f.read()
-        def load_json(path):
-            with open(self.rangeOutputPath() / path, 'r') as f:
-                return json.load(f)
+        functions = self.functions[self.current_range_key]
+        supplemental_files = dict((gf.canonical_filename, gf) for af in functions.values()
+                for gf in af.files.values() if gf.file_type != FileType.METADATA)
+
+        def template_data_filepath(path):
+            # files generated in this range haven't been published yet, so are read from the cache
+            gf = supplemental_files.get(str(path))
+            if gf is not None and self.cache.ensure_local(gf.cache_filepath.name):
+                return gf.cache_filepath
+            filepath = self.rangeOutputPath() / path
+            if self.config.get('sandbox', False) and not os.path.realpath(filepath).startswith(
+                    os.path.join(os.path.realpath(self.rangeOutputPath()), "")):
+                raise ReportTemplateException("templates can only read files in the output directory, not %s" % path)
+            return filepath
+        reader = TemplateDataReader(self.context.parsed_files, template_data_filepath)
+
         def fn_params(qual_fn_name, param_name):
             return self.config['analytics'][qual_fn_name][param_name]
 
-        self.template_data['batch'] = self
-        self.template_data['keys'] = self.functions.keys()
+        if not self.config.get('sandbox', False):
+            self.template_data['batch'] = self
+        self.template_data['keys'] = self.processed_range_keys
 
-        functions = self.functions[self.current_range_key]
         self.template_data['functions'] = functions
         self.template_data.update(functions)
 
@@ -267,35 +846,58 @@ class Batch(object):
         self.template_data['constants'] = constants
 
         # functions/modules for use within templates
-        self.template_data['read_file_contents'] = read_file_contents
-        self.template_data['load_json'] = load_json
+        self.template_data['read_file_contents'] = reader.read_file_contents
+        self.template_data['load_json'] = reader.load_json
+        self.template_data['csv_rows'] = reader.csv_rows
+        self.template_data['csv_columns'] = reader.csv_columns
         self.template_data['fn_params'] = fn_params
         self.template_data['datetime'] = datetime
 
-    def copy_all_supplemental_files(self):
+    def copy_all_supplemental_files(self, dest_dir=None, referenced_in=None):
         """
-        Copies all supplemental files to the current working directory.
+        Copies all supplemental files to dest_dir, or the current working directory.
+
+        Supplemental files which haven't been downloaded to the local cache
+        are downloaded first, or, if referenced_in is given, only if their
+        name appears in it and otherwise skipped.
         """
-        for af in self.functions[self.current_range_key].values():
-            for gf in af.files.values():
-                shutil.copyfile(gf.cache_filepath, gf.canonical_filename)
+        files = [gf for af in self.functions[self.current_range_key].values() for gf in af.files.values()]
+        missing = [gf for gf in files if not os.path.exists(gf.cache_filepath)]
+        if referenced_in is not None:
+            missing = [gf for gf in missing if gf.canonical_filename.encode('utf-8') in referenced_in]
+        self.fetch_cache_files([gf.cache_filepath.name for gf in missing], required=True)
+
+        for gf in files:
+            if os.path.exists(gf.cache_filepath):
+                shutil.copyfile(gf.cache_filepath, Path(dest_dir or ".") / gf.canonical_filename)
 
     def upload_all_supplemental_files(self):
         """
-        Uploads all supplemental files
+        Uploads all supplemental files which aren't in storage caches yet.
         """
-        for af in self.functions.values():
+        for af in self.functions[self.current_range_key].values():
             for gf in af.files.values():
-                self.upload_to_storages_cache(gf)
+                cache_filename = gf.cache_filepath.name
+                if cache_filename in self.uploaded_cache_files:
+                    continue
+                if not os.path.exists(gf.cache_filepath):
+                    # not prefetched because nothing reads it, so it's already in storage
+                    continue
+                self.cache.store(gf.cache_filepath, on_upload=gf.public_urls.append, only_missing=True)
+                self.uploaded_cache_files.add(cache_filename)
+
+    def work_dir(self, prev_doc):
+        return self.cachePath / "docs" / prev_doc.h
 
     def create_and_populate_work_dir(self, prev_doc):
-        workPath = self.cachePath / "docs" / prev_doc.h
+        workPath = self.work_dir(prev_doc)
         os.makedirs(workPath, exist_ok=True)
-        os.chdir(workPath)
 
         # write the previous document
-        shutil.copyfile(prev_doc.cache_filepath, prev_doc.canonical_filename)
-        self.copy_all_supplemental_files()
+        if prev_doc.cache_filepath != workPath / prev_doc.canonical_filename:
+            shutil.copyfile(prev_doc.cache_filepath, workPath / prev_doc.canonical_filename)
+        with open(prev_doc.cache_filepath, 'rb') as f:
+            self.copy_all_supplemental_files(workPath, referenced_in=f.read())
 
         return workPath
 
@@ -312,11 +914,17 @@ class Batch(object):
             pretty_name = pretty_name or template_file
             h, text = self.render_file_template(template_file)
 
-        with open(self.cachePath / template_file, 'w') as f:
+        # the document is named after what was rendered as well as the
+        # template, so batches rendering the same template with different
+        # data at the same time don't overwrite each other's documents
+        doc_h = hash_for_dict({ "template_hash" : h, "text_hash" : hash_for_template_text(text) })
+        doc_filepath = self.cachePath / "docs" / doc_h / pretty_name
+        os.makedirs(doc_filepath.parent, exist_ok=True)
+        with atomic_write(doc_filepath) as f:
             f.write(text)
 
-        doc = GeneratedFile(pretty_name, h, file_type=FileType.TEMPLATE,
-                cache_filepath=self.cachePath / template_file)
+        doc = GeneratedFile(pretty_name, doc_h, file_type=FileType.TEMPLATE,
+                cache_filepath=doc_filepath)
         self.documents[self.current_range_key][pretty_name] = doc
 
         return doc
@@ -324,9 +932,14 @@ class Batch(object):
     def generate_documents(self):
         """
         Render all the templates and apply all the document filters on them.
+
+        Each filter is applied to every template's document before moving
+        on to the next filter, so documents can be processed together by the
+        filter engine's worker processes.
         """
         self.populate_template_data()
 
+        template_docs = []
         for template_info in self.template_filenames:
             if isinstance(template_info, str):
                 template_file = template_info
@@ -335,74 +948,126 @@ class Batch(object):
                 template_file = template_info['file']
                 template_name = template_info.get('name')
             template_doc = self.render_and_save_template(template_file, template_name)
-            doc = template_doc
+            template_docs.append(template_doc)
+        docs = list(template_docs)
 
-            for filter_opts in self.config.get('filters', []):
-                workPath = self.create_and_populate_work_dir(doc)
-
-                if len(filter_opts) == 2:
-                    filter_name, output_ext = filter_opts
-                    filter_args = {}
-                else:
-                    filter_name, output_ext, filter_args = filter_opts
-
-                filter_doc_hash = hash_for_document(template_doc.h, filter_name, output_ext, filter_args)
-                result_filename = "%s.%s" % (os.path.splitext(doc.canonical_filename)[0], output_ext)
-                filter_fn = output_filters.__dict__["do_%s" % filter_name]
-                filter_fn(doc.canonical_filename, result_filename, output_ext, filter_args)
-                
-                doc = GeneratedFile(result_filename, filter_doc_hash, file_type=FileType.DOCUMENT, 
-                    cache_filepath = workPath / result_filename)
-                self.documents[self.current_range_key][result_filename] = doc
-    
-                self.upload_to_storages_cache(doc)
-
-            # change back to original working directory
-            os.chdir(self.orig_dir)
-
-    def rewrite_local_output(self):
-        print(os.getcwd())
-        if os.path.exists(self.localOutputPath):
-            if os.path.exists(self.localOutputPath / (".%s" % self.h)):
-                pass
-            elif os.path.exists(self.localOutputPath / '.precipy'):
-                print("removing old %s" % self.localOutputPath)
-                shutil.rmtree(self.localOutputPath)
+        for filter_opts in self.config.get('filters', []):
+            if len(filter_opts) == 2:
+                filter_name, output_ext = filter_opts
+                filter_args = {}
             else:
-                print("Can't remove old: %s" % self.localOutputPath)
-                return False
+                filter_name, output_ext, filter_args = filter_opts
+
+            # batches which rendered identical documents share their work
+            # directories, so each is filtered by one batch at a time
+            with contextlib.ExitStack() as stack:
+                for workPath in sorted(set(self.work_dir(doc) for doc in docs)):
+                    stack.enter_context(self.context.document_lock(workPath))
+
+                jobs = []
+                for template_doc, doc in zip(template_docs, docs):
+                    workPath = self.create_and_populate_work_dir(doc)
+                    result_filename = "%s.%s" % (os.path.splitext(doc.canonical_filename)[0], output_ext)
+                    future = self.filter_engine.submit(filter_name, workPath,
+                            doc.canonical_filename, result_filename, output_ext, filter_args)
+                    jobs.append((template_doc, workPath, result_filename, future))
+
+                docs = []
+                for template_doc, workPath, result_filename, future in jobs:
+                    self.filter_engine.wait(future, "%s with %s" % (result_filename, filter_name), filter_name)
+
+                    filter_doc_hash = hash_for_document(template_doc.h, filter_name, output_ext, filter_args)
+                    doc = GeneratedFile(result_filename, filter_doc_hash, file_type=FileType.DOCUMENT,
+                        cache_filepath = workPath / result_filename)
+                    self.documents[self.current_range_key][result_filename] = doc
+                    docs.append(doc)
+
+                    self.upload_to_storages_cache(doc)
+
+    def start_publishing(self):
+        """
+        Sets up output locations, loading manifests of what was published to
+        them last time. The local output directory, in the working directory,
+        is skipped if the local_output config value is false, and is only
+        written to if it was created by precipy.
+        """
+        self.output_dirs = [OutputDirectory(self.outputPath)]
+        self.logger.info("output directory is %s" % self.outputPath)
 
-        shutil.copytree(self.rangeOutputPath(), self.localOutputPath / self.current_range_key)
-        with open(self.localOutputPath / ".precipy", 'w') as f:
-            f.write("Keep this here so precipy knows it's okay to delete this dir.")
-        with open(self.localOutputPath / (".%s" % self.h), 'w') as f:
-            f.write("Track which batch this is for.")
-        with open(self.localOutputPath / "PrecipyREADME.txt", 'w') as f:
-            f.write("""This folder will be deleted and recreated with each run. 
-            Copy this folder elsewhere if you want to keep it permanently.""")
-        return True
+        if not self.config.get('local_output', True):
+            self.logger.info("not writing a local output directory")
+        elif os.path.exists(self.localOutputPath) and not os.path.exists(self.localOutputPath / '.precipy'):
+            self.logger.warning("Can't write to %s, it wasn't created by precipy" % self.localOutputPath)
+        else:
+            self.output_dirs.append(OutputDirectory(self.localOutputPath))
+            with open(self.localOutputPath / ".precipy", 'w') as f:
+                f.write("Keep this here so precipy knows it's okay to delete this dir.")
+            with open(self.localOutputPath / "PrecipyREADME.txt", 'w') as f:
+                f.write("""This folder will be updated to match the output of each run.
+                Copy this folder elsewhere if you want to keep it permanently.""")
+            self.logger.info("local output directory is %s" % self.localOutputPath)
 
-    def publish_documents(self):
-        curdir = os.getcwd()
-        os.chdir(self.rangeOutputPath())
+        for storage in self.storages:
+            storage.start_output(self.output_subdir)
 
+    def output_entries(self):
+        """
+        Returns a dictionary of output name:(hash, cache filepath) for every
+        document and supplemental file in the current range.
+        """
+        entries = {}
+        for af in self.functions[self.current_range_key].values():
+            for gf in af.files.values():
+                name = output_name(self.current_range_key, gf.canonical_filename)
+                entries[name] = (publish_hash(gf), gf.cache_filepath)
         for doc in self.documents[self.current_range_key].values():
-            shutil.copyfile(doc.cache_filepath, doc.canonical_filename)
-        self.copy_all_supplemental_files()
+            name = output_name(self.current_range_key, doc.canonical_filename)
+            entries[name] = (publish_hash(doc), doc.cache_filepath)
+        return entries
 
-        os.chdir(curdir)
+    def publish_documents(self):
+        """
+        Publishes documents and supplemental files for the current range to
+        the output directories and storages, transferring only files which
+        changed since they were last published.
+        """
+        if self.output_dirs is None:
+            self.start_publishing()
+
+        if self.is_sharded():
+            self.published_range_keys.add(self.current_range_key)
+        entries = self.output_entries()
+        self.fetch_cache_files([filepath.name for name, (h, filepath) in entries.items()
+            if not os.path.exists(filepath) and self.output_needs(name, h)], required=True)
+        for output_dir in self.output_dirs:
+            copied = output_dir.publish(entries)
+            self.logger.debug("copied %s of %s files to %s" % (len(copied), len(entries), output_dir.path))
+        for storage in self.storages:
+            uploaded = storage.publish_output(entries, self.output_subdir)
+            self.logger.debug("uploaded %s of %s output files" % (len(uploaded), len(entries)))
+        self.upload_all_supplemental_files()
 
-        print("output directory is %s" % self.rangeOutputPath())
-        if self.rewrite_local_output():
-            print("local output directory is %s" % self.localOutputPath)
+    def finish_publishing(self):
+        """
+        Removes files which weren't published by this run from output
+        locations and saves their manifests.
+        """
+        if self.output_dirs is None:
+            return
+        # other shards publish the other ranges to the same locations
+        range_keys = self.published_range_keys if self.is_sharded() else None
+        with self.context.document_lock(self.localOutputPath):
+            for output_dir in self.output_dirs:
+                output_dir.finish(range_keys)
             for storage in self.storages:
-                storage.reset_output()
-                for doc in self.documents.values():
-                    storage.upload_output(doc.canonical_filename, doc.cache_filepath)
-                self.upload_all_supplemental_files()
+                storage.finish_output(self.output_subdir, range_keys)
+        self.output_dirs = None
+        self.published_range_keys = set()
+        # empty directories are removed from output locations
+        self.created_output_paths.clear()
 
     def render_text(self, text):
-        template = self.jinja_env.from_string(text)
+        template = self.context.template_from_string(self.jinja_env, text)
         return template.render(self.template_data)
 
     def render_text_template(self):
@@ -0,0 +1,280 @@
+"""
+The analytics cache, as a stack of tiers which are checked in order: an
+in-process memory tier, the local cache directory, and then each storage.
+Hits in slower tiers are promoted to the faster ones.
+
+Files are always written to the local cache directory first, and are then
+written back to the other tiers according to each tier's policy:
+
+    sync - written before store() returns
+    async - written by a background thread, call flush() to wait for them
+    none - not written, the tier is only read from
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from precipy import PrecipyException
+import os
+import threading
+
+WRITE_BACK_POLICIES = ("sync", "async", "none")
+
+# default size of the memory tier
+DEFAULT_MEMORY_BYTES = 64 * 1024 ** 2
+
+def check_write_back(write_back):
+    if not write_back in WRITE_BACK_POLICIES:
+        raise PrecipyException("write back policy should be one of %s, got '%s'" % (
+            ", ".join(WRITE_BACK_POLICIES), write_back))
+    return write_back
+
+class MemoryTier(object):
+    """
+    A size-bounded LRU of file contents, which can be shared by batches in
+    the same process. Async write back is treated as sync, since writing to
+    memory is cheap.
+
+    Only files read with TieredCache.read_bytes are served from memory,
+    which in practice means functions' metadata pickles. Supplemental files
+    are read from the local cache directory by path.
+    """
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, write_back="none"):
+        self.max_bytes = max_bytes
+        self.write_back = check_write_back(write_back)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, filename):
+        with self.lock:
+            if filename in self.entries:
+                self.entries.move_to_end(filename)
+                return self.entries[filename]
+
+    def put(self, filename, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if filename in self.entries:
+                self.size -= len(self.entries.pop(filename))
+            self.entries[filename] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, filename):
+        with self.lock:
+            if filename in self.entries:
+                self.size -= len(self.entries.pop(filename))
+
+    def store(self, filepath):
+        if self.write_back != "none":
+            with open(filepath, 'rb') as f:
+                self.put(Path(filepath).name, f.read())
+
+class LocalDiskTier(object):
+    """
+    The local cache directory, with files in subdirectories named after the
+    first two characters of their names.
+    """
+    def __init__(self, cachePath):
+        self.cachePath = Path(cachePath)
+
+    def directory(self, filename):
+        parent_dir = self.cachePath / filename[0:2]
+        os.makedirs(parent_dir, exist_ok=True)
+        return parent_dir
+
+    def filepath(self, filename):
+        return self.directory(filename) / filename
+
+    def exists(self, filename):
+        return os.path.exists(self.filepath(filename))
+
+class StorageTier(object):
+    """
+    A Storage used as a cache tier. With async write back, uploads are made
+    in order by a single background thread, so a function's metadata, which
+    is stored after its supplemental files, is still uploaded last.
+    """
+    def __init__(self, storage, write_back="sync"):
+        self.storage = storage
+        self.write_back = check_write_back(write_back)
+        self.executor = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def exists(self, filename):
+        return self.storage.cache_exists(filename)
+
+    def fetch(self, filepath, dest_filepath=None):
+        return self.storage.download_cache(filepath, dest_filepath)
+
+    async def fetch_async(self, filepath, dest_filepath=None):
+        return await self.storage.download_cache_async(filepath, dest_filepath)
+
+    def upload(self, filepath, on_upload=None):
+        public_url = self.storage.upload_cache(filepath)
+        if on_upload is not None:
+            on_upload(public_url)
+        return public_url
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.pending.append(self.executor.submit(fn, *args))
+
+    def store(self, filepath, on_upload=None):
+        """
+        Writes back the file at filepath according to the tier's policy.
+        on_upload is called with the file's public url once it's uploaded.
+        """
+        if self.write_back == "sync":
+            self.upload(filepath, on_upload)
+        elif self.write_back == "async":
+            self.submit(self.upload, filepath, on_upload)
+
+    def delete(self, filename):
+        """
+        Deletes filename from the storage, after any async uploads queued
+        before it. Tiers which aren't written to aren't deleted from.
+        """
+        if self.write_back == "sync":
+            self.storage.delete_cache(filename)
+        elif self.write_back == "async":
+            self.submit(self.storage.delete_cache, filename)
+
+    def flush(self):
+        """
+        Waits for async uploads, raising the first error if any failed.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def shutdown(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+class TieredCache(object):
+    def __init__(self, cachePath, storages=None, memory=None, write_back="sync"):
+        """
+        Arguments:
+
+            cachePath - Path to the local cache directory
+            storages - list of storages to use as remote tiers
+            memory - a MemoryTier, or None to not keep anything in memory
+            write_back - policy for the storage tiers, either a single policy or a list with one per storage
+        """
+        self.cachePath = Path(cachePath)
+        self.memory = memory
+        self.disk = LocalDiskTier(cachePath)
+        storages = storages or []
+        if isinstance(write_back, str):
+            write_back = [write_back] * len(storages)
+        if len(write_back) != len(storages):
+            raise PrecipyException("expected a write back policy for each of %s storages, got %s" % (
+                len(storages), len(write_back)))
+        self.remote = [StorageTier(storage, "none" if storage.read_only else wb)
+                for storage, wb in zip(storages, write_back)]
+
+    @property
+    def storages(self):
+        return [tier.storage for tier in self.remote]
+
+    def filepath(self, filename):
+        """
+        Returns the Path at which filename is kept in the local cache.
+        """
+        return self.disk.filepath(filename)
+
+    def exists_locally(self, filename):
+        return self.disk.exists(filename)
+
+    def exists_remotely(self, filename):
+        return any(tier.exists(filename) for tier in self.remote)
+
+    def fetch(self, filename, dest_filepath=None):
+        """
+        Downloads filename from the first storage tier which has it into the
+        local cache, or to dest_filepath if given. Returns True if found.
+        """
+        for tier in self.remote:
+            if tier.fetch(self.filepath(filename), dest_filepath):
+                return True
+        return False
+
+    async def fetch_async(self, filename, dest_filepath=None):
+        for tier in self.remote:
+            if await tier.fetch_async(self.filepath(filename), dest_filepath):
+                return True
+        return False
+
+    def ensure_local(self, filename):
+        """
+        Makes sure filename is in the local cache, fetching it from storage
+        tiers if needed. Returns True if it's available.
+        """
+        return self.exists_locally(filename) or self.fetch(filename)
+
+    def read_bytes(self, filename):
+        """
+        Returns the contents of filename from the fastest tier which has it,
+        promoting it to the faster tiers.
+        """
+        if self.memory is not None:
+            data = self.memory.get(filename)
+            if data is not None:
+                return data
+
+        if not self.ensure_local(filename):
+            raise FileNotFoundError("%s isn't in any cache tier" % filename)
+        with open(self.filepath(filename), 'rb') as f:
+            data = f.read()
+
+        if self.memory is not None:
+            self.memory.put(filename, data)
+        return data
+
+    def store(self, filepath, on_upload=None, only_missing=False):
+        """
+        Writes back a file which has been written locally to the other tiers.
+        on_upload is called with the public url from each storage the file is
+        uploaded to. With only_missing, files already in a storage aren't
+        uploaded to it again.
+        """
+        if self.memory is not None:
+            self.memory.store(filepath)
+        for tier in self.remote:
+            if only_missing and tier.exists(Path(filepath).name):
+                continue
+            tier.store(filepath, on_upload)
+
+    def discard(self, filename):
+        """
+        Removes filename from every tier.
+        """
+        if self.memory is not None:
+            self.memory.discard(filename)
+        try:
+            os.remove(self.filepath(filename))
+        except FileNotFoundError:
+            pass
+        for tier in self.remote:
+            tier.delete(filename)
+
+    def flush(self):
+        """
+        Waits until async write backs have finished.
+        """
+        for tier in self.remote:
+            tier.flush()
+
+    def shutdown(self):
+        for tier in self.remote:
+            tier.shutdown()
@@ -0,0 +1,174 @@
+"""
+State which batches rendered in the same process can share, so that a
+long-running process such as the render server doesn't redo setup work for
+every batch.
+"""
+from jinja2 import Environment
+from jinja2 import FileSystemLoader
+from jinja2 import select_autoescape
+from jinja2.sandbox import SandboxedEnvironment
+from precipy import PrecipyException
+from precipy.cache import DEFAULT_MEMORY_BYTES
+from precipy.cache import MemoryTier
+from precipy.figures import FigureRenderer
+from precipy.locking import SingleFlight
+from precipy.template_data import ParsedFileCache
+from precipy.template_data import TemplateDataReader
+import collections
+import functools
+import os
+import precipy.jinja_filters as jinja_filters
+import precipy.output_filters as output_filters
+import threading
+
+class TemplateSandbox(SandboxedEnvironment):
+    """
+    A Jinja sandbox for templates from untrusted clients. As well as Jinja's
+    own restrictions, methods of precipy objects such as analytics functions
+    and caches can't be called, other than the template data readers, so
+    templates can read results but not change anything.
+    """
+    def is_safe_callable(self, obj):
+        owner = getattr(obj, '__self__', None)
+        if owner is not None and type(owner).__module__.split(".")[0] == "precipy" and not isinstance(owner, TemplateDataReader):
+            return False
+        return super().is_safe_callable(obj)
+
+class RenderContext(object):
+    """
+    Holds Jinja environments (which keep compiled templates), filter engines,
+    figure renderers, data files parsed for templates and the memory cache tier for batches, and coalesces concurrent
+    computation of the same function hash by batches running in different
+    threads.
+
+    Batches publishing to the same output directory take its document_lock
+    while rendering and publishing documents, so batches with different
+    output directories render at the same time, as long as their filters run
+    in worker processes rather than changing this process's working
+    directory.
+    """
+    string_template_memory_size = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.document_locks = {}
+        self.function_flights = SingleFlight()
+        self.jinja_envs = {}
+        self.filter_engines = {}
+        self.figure_renderers = {}
+        self.connected_storages = {}
+        self.string_templates = collections.OrderedDict()
+        self.parsed_files = ParsedFileCache()
+        self.memory_tiers = {}
+
+    def document_lock(self, output_path):
+        """
+        Returns the lock for rendering documents into, and publishing them
+        to, the output directory at output_path.
+        """
+        key = os.path.abspath(output_path)
+        with self.lock:
+            if not key in self.document_locks:
+                self.document_locks[key] = threading.RLock()
+            return self.document_locks[key]
+
+    def jinja_env(self, template_dir, highlight_cachePath=None, sandboxed=False):
+        """
+        Returns a Jinja environment loading templates from template_dir. If
+        highlight_cachePath is given, highlighted code is cached there. With
+        sandboxed, the environment is a TemplateSandbox.
+        """
+        key = (template_dir, str(highlight_cachePath), sandboxed)
+        with self.lock:
+            if not key in self.jinja_envs:
+                environment_class = TemplateSandbox if sandboxed else Environment
+                jinja_env = environment_class(
+                    loader = FileSystemLoader(template_dir),
+                    autoescape=select_autoescape(['html', 'xml']))
+
+                if highlight_cachePath:
+                    jinja_env.filters['highlight'] = functools.partial(jinja_filters.highlight,
+                            cachePath=highlight_cachePath)
+                else:
+                    jinja_env.filters['highlight'] = jinja_filters.highlight
+
+                self.jinja_envs[key] = jinja_env
+            return self.jinja_envs[key]
+
+    def template_from_string(self, jinja_env, text):
+        """
+        Returns a compiled template for text, reusing recently compiled ones.
+        """
+        key = (id(jinja_env), text)
+        with self.lock:
+            if key in self.string_templates:
+                self.string_templates.move_to_end(key)
+                return self.string_templates[key]
+
+        template = jinja_env.from_string(text)
+
+        with self.lock:
+            self.string_templates[key] = template
+            while len(self.string_templates) > self.string_template_memory_size:
+                self.string_templates.popitem(last=False)
+        return template
+
+    def filter_engine(self, workers=0, timeout=None, executables=None, custom_filter_fns=None):
+        """
+        Returns a FilterEngine with the given settings, see output_filters.
+        """
+        key = (workers, timeout, tuple(sorted((executables or {}).items())), tuple(custom_filter_fns or []))
+        with self.lock:
+            if not key in self.filter_engines:
+                self.filter_engines[key] = output_filters.FilterEngine(
+                        workers=workers,
+                        timeout=timeout,
+                        executables=executables,
+                        custom_filter_fns=custom_filter_fns)
+            return self.filter_engines[key]
+
+    def figure_renderer(self, workers=0):
+        """
+        Returns a FigureRenderer with the given number of worker processes.
+        """
+        with self.lock:
+            if not workers in self.figure_renderers:
+                self.figure_renderers[workers] = FigureRenderer(workers)
+            return self.figure_renderers[workers]
+
+    def connect_storage(self, storage, batch):
+        """
+        Initializes and connects storage for batch, unless it's already
+        been connected for another batch. A storage holds its bucket names
+        and the manifests of outputs being published, so batches sharing
+        it must use the same bucket names.
+        """
+        bucket_names = (batch.cache_bucket_name, batch.output_bucket_name)
+        with self.lock:
+            if id(storage) in self.connected_storages:
+                _, connected_bucket_names = self.connected_storages[id(storage)]
+                if connected_bucket_names != bucket_names:
+                    raise PrecipyException("%s is already connected to buckets %s and %s, configs sharing a storage need the same cache_bucket_name and output_bucket_name" % (
+                        storage.__class__.__name__, *connected_bucket_names))
+                return
+            storage.init(batch)
+            storage.connect()
+            # keeping the storage means its id isn't reused
+            self.connected_storages[id(storage)] = (storage, bucket_names)
+
+    def memory_tier(self, max_bytes=None, write_back="none"):
+        """
+        Returns the memory cache tier with the given settings, which is
+        shared by batches asking for the same settings.
+        """
+        key = (max_bytes or DEFAULT_MEMORY_BYTES, write_back)
+        with self.lock:
+            if not key in self.memory_tiers:
+                self.memory_tiers[key] = MemoryTier(*key)
+            return self.memory_tiers[key]
+
+    def shutdown(self):
+        for filter_engine in self.filter_engines.values():
+            filter_engine.shutdown()
+        for figure_renderer in self.figure_renderers.values():
+            figure_renderer.shutdown()
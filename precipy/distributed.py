@@ -0,0 +1,390 @@
+"""
+Coordinator/worker mode for spreading a batch over several machines.
+
+The shared storage (the first storage configured for the batch) is used for
+coordination: workers claim tasks by taking a lease named after the task's
+function hash, and a task is done once its metadata is in the storage cache.
+A worker whose task raises leaves a <hash>.failed marker in the storage
+cache, so workers waiting for the task and the coordinator stop with an
+error rather than waiting for it forever. Markers left before a worker
+started are from earlier runs, and those tasks are tried again.
+Workers need the same config file and analytics modules as the coordinator.
+"""
+from pathlib import Path
+from precipy import PrecipyException
+from precipy.batch import generate_range_key
+from precipy.identifiers import FileType
+from precipy.identifiers import hash_for_dict
+from precipy.locking import atomic_write
+from precipy.memory import MemoryLedger
+from precipy.memory import parse_memory
+from precipy.scheduling import critical_path_priorities
+from precipy.scheduling import order_by_priority
+from precipy.scheduling import task_costs
+from uuid import uuid4
+import collections
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+class Task(object):
+    """
+    A single analytics function call, identified by its function hash.
+    """
+    def __init__(self, key, h, kwargs, previous_functions, depends, range_key, cost_key=None, range_keys=None):
+        """
+        Arguments:
+
+            key - the analytics entry key
+            h - the function hash
+            kwargs - kwargs for the entry with range values filled in
+            previous_functions - a dictionary of function keys:hashcodes for earlier entries in the same range
+            depends - a dictionary of function keys:hashcodes for the entries listed in depends
+            range_key - the range key of the first range this task was found in
+            cost_key - key for the task's timing history in the batch's CostModel
+            range_keys - the range keys of every range this task was found in
+        """
+        self.key = key
+        self.h = h
+        self.kwargs = kwargs
+        self.previous_functions = previous_functions
+        self.depends = depends
+        self.range_key = range_key
+        self.cost_key = cost_key
+        self.range_keys = range_keys or [range_key]
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in
+                ("key", "h", "kwargs", "previous_functions", "depends", "range_key", "cost_key", "range_keys"))
+
+    @classmethod
+    def from_dict(klass, d):
+        return klass(**d)
+
+def expand_tasks(batch, analytics_modules, range_envs=None):
+    """
+    Resolves every analytics entry in range_envs, or in every range
+    environment of the batch if not given, without running anything.
+    Returns an OrderedDict of hash:Task, with each task appearing after the
+    tasks it depends on. Entries with the same hash in different ranges
+    become a single task.
+    """
+    batch.analytics_modules = analytics_modules
+    tasks = collections.OrderedDict()
+
+    if range_envs is None:
+        range_envs = batch.range_environments()
+    for range_env in range_envs:
+        range_key = generate_range_key(range_env)
+        previous_functions = {}
+        for key, kwargs in batch.config.get('analytics', []):
+            kwargs = batch.range_kwargs(kwargs, range_env)
+            # partitioned entries become a task for each partition and one to reduce them
+            for entry_key, entry_kwargs, af in batch.resolve_entry(key, kwargs, previous_functions):
+                if not af.h in tasks:
+                    depends = dict((k, previous_functions[k]) for k in entry_kwargs.get('depends', []))
+                    tasks[af.h] = Task(entry_key, af.h, entry_kwargs, dict(previous_functions), depends, range_key,
+                            batch.cost_model.cost_key(af))
+                elif not range_key in tasks[af.h].range_keys:
+                    tasks[af.h].range_keys.append(range_key)
+
+    return tasks
+
+def hash_for_tasks(tasks):
+    return hash_for_dict({ "tasks" : list(tasks) })
+
+class LeaseHeartbeat(object):
+    """
+    Renews a lease in a background thread while a long task is running.
+    """
+    def __init__(self, storage, lease_name, owner, seconds):
+        self.storage = storage
+        self.lease_name = lease_name
+        self.owner = owner
+        self.seconds = seconds
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+
+    def renew(self):
+        while not self.stopped.wait(self.seconds / 3.0):
+            self.storage.acquire_lease(self.lease_name, self.owner, self.seconds)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+def work_queue_storage(batch):
+    """
+    Returns the storage which holds a distributed run's leases and done
+    markers, the first of batch's storages.
+    """
+    if not batch.storages:
+        raise PrecipyException("distributed runs need a storage shared by all workers")
+    storage = batch.storages[0]
+    if storage.read_only:
+        raise PrecipyException("distributed runs need a writable storage shared by all workers, %s is read only" % storage.__class__.__name__)
+    return storage
+
+class Worker(object):
+    def __init__(self, batch, analytics_modules, worker_id=None, run_id=None, lease_seconds=300, poll_seconds=5,
+            max_memory=None):
+        """
+        Arguments:
+
+            batch - a Batch set up with the shared config and storages
+            analytics_modules - list of modules containing analytics functions
+            worker_id - unique name for this worker, defaults to hostname, pid and a random suffix
+            run_id - id of a task manifest published by a coordinator, if not given the worker expands the tasks itself
+            lease_seconds - how long a claim on a task lasts without being renewed
+            poll_seconds - how long to wait before checking again when no task can be claimed
+            max_memory - memory budget shared by workers on this machine, e.g. "8G", defaults to the max_memory config value
+        """
+        self.batch = batch
+        self.storage = work_queue_storage(batch)
+        self.analytics_modules = analytics_modules
+        self.worker_id = worker_id or "%s-%s-%s" % (socket.gethostname(), os.getpid(), uuid4().hex[0:8])
+        self.run_id = run_id
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.done = set()
+        # failures recorded before this are from earlier runs
+        self.started = time.time()
+
+        max_memory = parse_memory(max_memory or batch.config.get('max_memory'))
+        if max_memory:
+            self.memory_ledger = MemoryLedger(batch.cachePath / "memory", max_memory)
+        else:
+            self.memory_ledger = None
+        # tasks are admitted before they're claimed, see run_tasks, so the
+        # batch mustn't wait for a second reservation alongside the first
+        batch.memory_ledger = None
+
+    def reserve_memory(self, task):
+        """
+        Reserves the task's predicted memory use in this machine's ledger,
+        returns False if it doesn't fit in max_memory alongside the tasks
+        already running.
+        """
+        if self.memory_ledger is None:
+            return True
+        predicted = self.batch.cost_model.estimate_memory(task.cost_key)
+        return self.memory_ledger.reserve(self.reservation_name(task), predicted)
+
+    def release_memory(self, task):
+        if self.memory_ledger is not None:
+            self.memory_ledger.release(self.reservation_name(task))
+
+    def reservation_name(self, task):
+        """
+        Names a reservation after the task and this worker, since workers on
+        the same machine can reserve memory for the same task while only one
+        of them gets its lease.
+        """
+        return "%s-%s" % (task.h, re.sub(r"[^\w.-]", "_", self.worker_id))
+
+    def load_tasks(self):
+        if self.run_id is None:
+            return expand_tasks(self.batch, self.analytics_modules)
+
+        self.batch.analytics_modules = self.analytics_modules
+        manifest_filepath = self.batch.cachePath / manifest_filename(self.run_id)
+        if not self.storage.download_cache(manifest_filepath):
+            raise PrecipyException("couldn't find task manifest for run %s" % self.run_id)
+        with open(manifest_filepath, 'r') as f:
+            manifest = json.load(f)
+        return collections.OrderedDict((d['h'], Task.from_dict(d)) for d in manifest['tasks'])
+
+    def is_done(self, h):
+        if not h in self.done:
+            if self.storage.cache_exists("%s.pkl" % h):
+                self.done.add(h)
+        return h in self.done
+
+    def record_failure(self, task, e):
+        """
+        Leaves a failure marker for task in the shared storage.
+        """
+        failure_filepath = self.batch.cachePath / failure_filename(task.h)
+        with atomic_write(failure_filepath) as f:
+            json.dump({ "key" : task.key, "worker_id" : self.worker_id, "time" : time.time(),
+                "error" : "%s: %s" % (e.__class__.__name__, e) }, f)
+        self.storage.upload_cache(failure_filepath)
+
+    def check_failed(self, h):
+        """
+        Raises a PrecipyException if a worker recorded a failure for task h
+        since this worker started.
+        """
+        if h in self.done or not self.storage.cache_exists(failure_filename(h)):
+            return
+        failure_filepath = self.batch.cachePath / failure_filename(h)
+        if not self.storage.download_cache(failure_filepath):
+            return
+        with open(failure_filepath, 'r') as f:
+            failure = json.load(f)
+        if failure['time'] >= self.started:
+            raise PrecipyException("task %s (%s) failed on worker %s: %s" % (
+                failure['key'], h, failure['worker_id'], failure['error']))
+
+    def resolve_task(self, task):
+        return self.batch.resolve_function(task.key, task.kwargs, task.previous_functions)
+
+    def execute(self, task, tasks):
+        """
+        Runs a task after making sure results of the functions it depends on
+        are in the local cache. Results are uploaded to storages as they are
+        generated, metadata last.
+        """
+        self.batch.logger.info("worker %s running %s (%s)" % (self.worker_id, task.key, task.h))
+        for dep_h in task.depends.values():
+            self.batch.ensure_analytics_results(self.resolve_task(tasks[dep_h]))
+        af = self.resolve_task(task)
+        self.batch.ensure_analytics_results(af)
+        self.batch.cache.flush()
+        self.publish_results(af)
+        self.done.add(task.h)
+
+    def publish_results(self, af):
+        """
+        Uploads af's supplemental files and then its metadata to the shared
+        storage if they aren't there already, which is the case when the
+        results came from this worker's local cache rather than being run.
+        Other workers treat the task as done once its metadata is in storage.
+        """
+        gfs = sorted(af.files.values(), key=lambda gf: gf.file_type == FileType.METADATA)
+        for gf in gfs:
+            cache_filepath = Path(gf.cache_filepath)
+            if not self.storage.cache_exists(cache_filepath.name):
+                self.storage.upload_cache(cache_filepath)
+
+    def run(self):
+        """
+        Claims and runs tasks until every task is done, by this worker or
+        others. Returns the number of tasks run by this worker.
+
+        Tasks with the longest critical path, based on the batch's timing
+        history, are claimed first.
+        """
+        tasks = self.load_tasks()
+        done = set(h for h in tasks if self.is_done(h))
+        priorities = critical_path_priorities(tasks, task_costs(tasks, self.batch.cost_model, done))
+        pending = order_by_priority(tasks, priorities)
+        try:
+            return self.run_tasks(pending, tasks)
+        finally:
+            self.batch.cost_model.flush()
+
+    def run_tasks(self, pending, tasks):
+        n_run = 0
+        while pending:
+            progressed = False
+            still_pending = []
+            for task in pending:
+                if self.is_done(task.h):
+                    progressed = True
+                    continue
+
+                for h in [task.h] + list(task.depends.values()):
+                    self.check_failed(h)
+                if not all(self.is_done(h) for h in task.depends.values()):
+                    still_pending.append(task)
+                elif not self.reserve_memory(task):
+                    still_pending.append(task)
+                elif self.storage.acquire_lease(task.h, self.worker_id, self.lease_seconds):
+                    try:
+                        with LeaseHeartbeat(self.storage, task.h, self.worker_id, self.lease_seconds):
+                            self.execute(task, tasks)
+                    except Exception as e:
+                        self.record_failure(task, e)
+                        raise
+                    finally:
+                        self.storage.release_lease(task.h, self.worker_id)
+                        self.release_memory(task)
+                    n_run += 1
+                    progressed = True
+                else:
+                    self.release_memory(task)
+                    still_pending.append(task)
+
+            pending = still_pending
+            if pending and not progressed:
+                self.batch.logger.debug("waiting for %s tasks claimed by other workers" % len(pending))
+                time.sleep(self.poll_seconds)
+
+        return n_run
+
+def manifest_filename(run_id):
+    return "tasks-%s.json" % run_id
+
+def failure_filename(h):
+    return "%s.failed" % h
+
+class Coordinator(object):
+    def __init__(self, batch, analytics_modules, work=True, poll_seconds=5, timeout=None, **worker_kwargs):
+        """
+        Arguments:
+
+            batch - a Batch set up with the shared config and storages
+            analytics_modules - list of modules containing analytics functions
+            work - whether the coordinator should also run tasks itself
+            poll_seconds - how long to wait between checks for finished tasks
+            timeout - seconds to wait for workers to finish the tasks when work is False, None to wait indefinitely
+        """
+        work_queue_storage(batch)
+        self.batch = batch
+        self.analytics_modules = analytics_modules
+        self.work = work
+        self.poll_seconds = poll_seconds
+        self.timeout = timeout
+        self.worker_kwargs = worker_kwargs
+        self.run_id = None
+
+    def publish_manifest(self, tasks):
+        """
+        Uploads the list of tasks so workers can start with run_id instead of
+        expanding the tasks themselves.
+        """
+        self.run_id = hash_for_tasks(tasks)
+        manifest_filepath = self.batch.cachePath / manifest_filename(self.run_id)
+        with atomic_write(manifest_filepath) as f:
+            json.dump({ "tasks" : [task.to_dict() for task in tasks.values()] }, f)
+        for storage in self.batch.storages:
+            storage.upload_cache(manifest_filepath)
+        self.batch.logger.info("published %s tasks as run %s" % (len(tasks), self.run_id))
+        return self.run_id
+
+    def run(self):
+        """
+        Publishes the tasks, waits for workers to finish them (helping out if
+        work is True) and then renders documents from the cached results.
+        Raises a PrecipyException if a worker fails a task, or if workers
+        haven't finished within timeout.
+        """
+        started = time.time()
+        tasks = expand_tasks(self.batch, self.analytics_modules)
+        self.publish_manifest(tasks)
+
+        worker = Worker(self.batch, self.analytics_modules,
+                run_id=self.run_id, poll_seconds=self.poll_seconds, **self.worker_kwargs)
+        worker.started = started
+        if self.work:
+            worker.run()
+        else:
+            while not all(worker.is_done(h) for h in tasks):
+                for h in tasks:
+                    worker.check_failed(h)
+                if self.timeout is not None and time.time() - started > self.timeout:
+                    n_done = len([h for h in tasks if worker.is_done(h)])
+                    raise PrecipyException("timed out after %ss with %s of %s tasks done" % (
+                        self.timeout, n_done, len(tasks)))
+                time.sleep(self.poll_seconds)
+
+        self.batch.run(self.analytics_modules)
+        return self.batch
@@ -0,0 +1,81 @@
+"""
+Rendering matplotlib figures for analytics functions. Figures are saved
+straight to their cache paths, and with workers > 0 they are pickled and
+rendered by a pool of worker processes using the Agg backend, so analytics
+functions can carry on while savefig runs.
+"""
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from precipy import AnalyticsException
+from precipy.locking import atomic_path
+import pickle
+import threading
+
+def init_figure_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+def render_figure(fig, targets, savefig_kwargs):
+    """
+    Saves fig, or a pickled figure, to each (format, filepath) in targets.
+    """
+    unpickled = isinstance(fig, bytes)
+    if unpickled:
+        fig = pickle.loads(fig)
+    try:
+        for fmt, filepath in targets:
+            with atomic_path(filepath) as tmp_filepath:
+                fig.savefig(tmp_filepath, format=fmt, **savefig_kwargs)
+    finally:
+        if unpickled:
+            # unpickled pyplot figures are registered with pyplot in the worker
+            import matplotlib.pyplot as plt
+            plt.close(fig)
+
+class FigureRenderer(object):
+    """
+    Renders figures in this process with workers=0, otherwise in a pool of
+    worker processes which is started when the first figure is submitted.
+    """
+    def __init__(self, workers=0):
+        """
+        Arguments:
+
+            workers - number of worker processes, 0 to render figures in this process when they're submitted
+        """
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, fig, targets, savefig_kwargs=None):
+        """
+        Queues fig to be saved to each (format, filepath) in targets,
+        returning a Future. The figure is pickled before this returns, so
+        it can be changed or closed straight away.
+        """
+        savefig_kwargs = savefig_kwargs or {}
+        if self.workers > 0:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_figure_worker)
+                pool = self.pool
+            return pool.submit(render_figure, pickle.dumps(fig), targets, savefig_kwargs)
+
+        future = Future()
+        try:
+            future.set_result(render_figure(fig, targets, savefig_kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def wait(self, future, description):
+        try:
+            return future.result()
+        except Exception as e:
+            raise AnalyticsException("error rendering figure %s: %s" % (description, e)) from e
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
@@ -1,7 +1,14 @@
+from enum import Enum
+from precipy import CACHE_FORMAT_VERSION
+import ast
+import builtins
+import functools
 import hashlib
 import inspect
-from enum import Enum
 import os
+import sysconfig
+import textwrap
+import types
 
 class FileType(Enum):
     ANALYTICS = "analytics"
@@ -23,16 +30,207 @@ def hash_for_dict(info_dict):
             for k in sorted(info_dict))
     return hashlib.sha256(description.encode('utf-8')).hexdigest()
 
+LIBRARY_PATHS = tuple(sorted(set(os.path.realpath(sysconfig.get_path(k))
+    for k in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+    if sysconfig.get_path(k))))
+
+SIMPLE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+# AST descriptions of code objects, these don't change while a process is running
+code_descriptions = {}
+
+def is_library_object(obj):
+    """
+    Returns True if obj comes from the standard library, an installed package
+    or precipy itself. Changes to these are not tracked by fingerprints,
+    precipy's own changes are covered by CACHE_FORMAT_VERSION.
+    """
+    module = inspect.getmodule(obj)
+    if module is None or getattr(module, '__file__', None) is None:
+        return True
+    if module.__name__.split(".")[0] == "precipy":
+        return True
+    return os.path.realpath(module.__file__).startswith(LIBRARY_PATHS)
+
+def code_names(code):
+    """
+    Returns all global and attribute names referenced by a code object and
+    any code objects nested within it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(code_names(const))
+    return names
+
+def describe_code(fn):
+    code = fn.__code__
+    if not code in code_descriptions:
+        try:
+            source = textwrap.dedent(inspect.getsource(fn))
+            code_descriptions[code] = ast.dump(ast.parse(source))
+        except (OSError, TypeError, SyntaxError):
+            # source not available, fall back to bytecode
+            code_descriptions[code] = "%s %r" % (code.co_code.hex(),
+                    [c for c in code.co_consts if not isinstance(c, types.CodeType)])
+    return code_descriptions[code]
+
+def describe_value(value):
+    """
+    Returns a stable description of a referenced global value. Simple values
+    and containers of simple values are described in full, other objects are
+    described by their type only.
+    """
+    if isinstance(value, SIMPLE_TYPES):
+        return repr(value)
+    elif isinstance(value, (list, tuple)):
+        return "%s(%s)" % (type(value).__name__, ", ".join(describe_value(v) for v in value))
+    elif isinstance(value, (set, frozenset)):
+        return "%s(%s)" % (type(value).__name__, ", ".join(sorted(describe_value(v) for v in value)))
+    elif isinstance(value, dict):
+        return "dict(%s)" % ", ".join(sorted("%s: %s" % (describe_value(k), describe_value(v))
+            for k, v in value.items()))
+    else:
+        return "<%s.%s instance>" % (type(value).__module__, type(value).__qualname__)
+
+def qualified_name(obj):
+    return "%s.%s" % (getattr(obj, '__module__', None), getattr(obj, '__qualname__', obj))
+
+def unique_key(seen, key):
+    """
+    Returns key, or key with a numbered suffix if another object with the
+    same qualified name, like another module level lambda, is already in seen.
+    """
+    n = 1
+    unique = key
+    while unique in seen:
+        n += 1
+        unique = "%s#%s" % (key, n)
+    return unique
+
+def fingerprint_fn(fn, seen=None, visited=None):
+    """
+    Returns a dict describing fn's code along with the code of every user
+    defined function and class it refers to, followed transitively, and the
+    values of simple globals these refer to.
+
+    Code is described by its AST, so editing comments or formatting does not
+    change the fingerprint. Objects from the standard library or installed
+    packages are described by name only. functools.partial objects are
+    described by their arguments and the function they wrap is followed.
+    Attributes of user modules, like helpers.SCALE or helpers.compute, are
+    followed like globals.
+
+    Not everything a function can depend on is tracked. Globals which aren't
+    simple values or containers of them, such as instances of user classes
+    or numpy arrays, are described by their type only, so changing e.g. the
+    contents of a referenced config object doesn't change the fingerprint.
+    Nor do values reached through attributes of objects, data files read by
+    the function, or changes to installed packages. Pass such values as
+    kwargs, or as constants, to have them included in the hash.
+
+    Functions are followed once per code object rather than per name, so
+    lambdas and nested functions sharing a qualified name are all followed.
+    """
+    if seen is None:
+        seen = {}
+    if visited is None:
+        visited = set()
+
+    fn = inspect.unwrap(fn)
+    if fn.__code__ in visited:
+        return seen
+    visited.add(fn.__code__)
+    key = unique_key(seen, qualified_name(fn))
+    seen[key] = describe_code(fn)
+
+    closure_values = []
+    for cell in (fn.__closure__ or []):
+        try:
+            closure_values.append(cell.cell_contents)
+        except ValueError:
+            # cell is still empty
+            pass
+
+    default_values = list(fn.__defaults__ or []) + list((fn.__kwdefaults__ or {}).values())
+    for i, value in enumerate(default_values):
+        seen["%s:default_%s" % (key, i)] = describe_value(value)
+
+    names = code_names(fn.__code__)
+    referenced = [(name, fn.__globals__[name]) for name in sorted(names) if name in fn.__globals__]
+    referenced += [("closure_%s" % i, value) for i, value in enumerate(closure_values)]
+
+    for name, value in referenced:
+        if isinstance(value, types.ModuleType):
+            fingerprint_module(value, "%s:%s" % (key, name), names, seen, visited)
+        elif callable(value) or value is not getattr(builtins, name, None):
+            fingerprint_reference(value, "%s:%s" % (key, name), seen, visited)
+
+    return seen
+
+def fingerprint_module(module, ref_key, names, seen, visited):
+    """
+    Records a module referenced as ref_key and, for user modules, follows
+    those of its attributes whose names appear in names, so module-qualified
+    references like helpers.compute(...) and helpers.SCALE are tracked.
+    """
+    seen[ref_key] = "module %s" % module.__name__
+    if is_library_object(module) or module in visited:
+        return
+    visited.add(module)
+    for attr in sorted(names):
+        if not hasattr(module, attr):
+            continue
+        member = getattr(module, attr)
+        if isinstance(member, types.ModuleType):
+            fingerprint_module(member, "%s.%s" % (ref_key, attr), names, seen, visited)
+        else:
+            fingerprint_reference(member, "%s.%s" % (ref_key, attr), seen, visited)
+
+def fingerprint_reference(value, ref_key, seen, visited):
+    """
+    Records a non-module value referenced as ref_key, following user
+    defined functions and classes, and the functions wrapped by partials.
+    """
+    if isinstance(value, (types.FunctionType, type)):
+        fingerprint_object(value, seen, visited)
+    elif isinstance(value, functools.partial):
+        seen[ref_key] = "partial(%s, %s, %s)" % (qualified_name(value.func),
+                describe_value(value.args), describe_value(value.keywords))
+        fingerprint_reference(value.func, "%s.func" % ref_key, seen, visited)
+    elif callable(value) and not isinstance(value, SIMPLE_TYPES):
+        seen[ref_key] = qualified_name(value)
+    else:
+        seen[ref_key] = describe_value(value)
+
+def fingerprint_object(obj, seen, visited):
+    if is_library_object(obj):
+        seen[qualified_name(obj)] = "library"
+    elif isinstance(obj, types.FunctionType):
+        fingerprint_fn(obj, seen, visited)
+    else:
+        if obj in visited:
+            return
+        visited.add(obj)
+        key = unique_key(seen, qualified_name(obj))
+        try:
+            seen[key] = ast.dump(ast.parse(textwrap.dedent(inspect.getsource(obj))))
+        except (OSError, TypeError, SyntaxError):
+            seen[key] = "class"
+        for member in obj.__dict__.values():
+            if isinstance(member, (staticmethod, classmethod)):
+                member = member.__func__
+            if isinstance(member, types.FunctionType):
+                fingerprint_fn(member, seen, visited)
+
 def hash_for_fn(fn, kwargs, depends=None):
-    import precipy.batch as batch
-    import precipy.analytics_function as analytics_function
+    fingerprint = fingerprint_fn(fn)
     return hash_for_dict({
             'canonical_function_name' : fn.__name__,
-            'fn_source' : inspect.getsource(fn),
+            'fn_fingerprint' : [(k, fingerprint[k]) for k in sorted(fingerprint)],
             'depends' : depends,
             'arg_values' : kwargs,
-            'batch_source' : inspect.getsource(batch),
-            'analytics_function_source' : inspect.getsource(analytics_function)
+            'cache_format_version' : CACHE_FORMAT_VERSION
             })
 
 def hash_for_supplemental_file(canonical_filename, fn_h):
@@ -52,6 +250,21 @@ def hash_for_template_file(filepath):
         m.update(f.read())
     return m.hexdigest()
 
+def hash_for_highlight(text, options):
+    m = hashlib.sha256()
+    m.update(text.encode('utf-8'))
+    return hash_for_dict({
+        "text_hash" : m.hexdigest(),
+        "options" : options
+        })
+
+def hash_for_file_content(filepath):
+    m = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
 def hash_for_document(template_hash, filter_name, filter_ext, filter_args):
     x = { "template_hash" : template_hash,
           "filter_name" : filter_name,
@@ -60,13 +273,12 @@ def hash_for_document(template_hash, filter_name, filter_ext, filter_args):
     return hash_for_dict(x)
 
 def hash_for_doc(canonical_filename, hash_args=None):
-    import precipy.batch as batch
     analytics_frameinfo = inspect.stack()[2]
     frame = analytics_frameinfo.frame 
 
     d = { 
             'canonical_filename' : canonical_filename,
-            'batch_source' : inspect.getsource(batch),
+            'cache_format_version' : CACHE_FORMAT_VERSION,
             'frame_source' : inspect.getsource(frame),
             'values' : inspect.getargvalues(frame).args
             }
@@ -1,12 +1,76 @@
+from pathlib import Path
+from precipy.identifiers import hash_for_highlight
+from precipy.locking import atomic_write
+import collections
+import functools
+import os
 import pygments
 import pygments.lexers
 import pygments.formatters
+import threading
 
-def highlight(text, lexer_name='py', fmt='html', noclasses=True, style=None, lineanchors='l'):
-    text = str(text)
+# number of highlighted snippets kept in memory, shared by all batches in a process
+HIGHLIGHT_MEMORY_SIZE = 512
+highlight_memory = collections.OrderedDict()
+# batches rendering in different threads share highlight_memory
+highlight_memory_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(lexer_name):
+    return pygments.lexers.get_lexer_by_name(lexer_name)
+
+@functools.lru_cache(maxsize=None)
+def get_formatter(fmt, noclasses, style, lineanchors):
     formatter_options = { "lineanchors" : lineanchors, "noclasses" : noclasses }
     if style is not None:
         formatter_options['style'] = style
-    lexer = pygments.lexers.get_lexer_by_name(lexer_name)
-    formatter = pygments.formatters.get_formatter_by_name(fmt, **formatter_options)
-    return pygments.highlight(text, lexer, formatter)
+    return pygments.formatters.get_formatter_by_name(fmt, **formatter_options)
+
+def remember_highlight(h, highlighted):
+    with highlight_memory_lock:
+        highlight_memory[h] = highlighted
+        highlight_memory.move_to_end(h)
+        while len(highlight_memory) > HIGHLIGHT_MEMORY_SIZE:
+            highlight_memory.popitem(last=False)
+
+def recall_highlight(h):
+    with highlight_memory_lock:
+        if h in highlight_memory:
+            highlight_memory.move_to_end(h)
+            return highlight_memory[h]
+
+def highlight(text, lexer_name='py', fmt='html', noclasses=True, style=None, lineanchors='l', cachePath=None):
+    """
+    Highlights text using pygments.
+
+    Results are memoized in memory by a hash of the text and the highlighting
+    options and, if cachePath is given, also written to disk under cachePath
+    so later runs can skip pygments entirely.
+    """
+    text = str(text)
+    h = hash_for_highlight(text, (lexer_name, fmt, noclasses, style, lineanchors))
+
+    highlighted = recall_highlight(h)
+    if highlighted is not None:
+        return highlighted
+
+    cache_filepath = None
+    if cachePath is not None:
+        cache_filepath = Path(cachePath) / h[0:2] / ("%s.%s" % (h, fmt))
+        if os.path.exists(cache_filepath):
+            with open(cache_filepath, 'r') as f:
+                highlighted = f.read()
+            remember_highlight(h, highlighted)
+            return highlighted
+
+    lexer = get_lexer(lexer_name)
+    formatter = get_formatter(fmt, noclasses, style, lineanchors)
+    highlighted = pygments.highlight(text, lexer, formatter)
+
+    if cache_filepath is not None:
+        os.makedirs(cache_filepath.parent, exist_ok=True)
+        with atomic_write(cache_filepath) as f:
+            f.write(highlighted)
+
+    remember_highlight(h, highlighted)
+    return highlighted
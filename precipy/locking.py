@@ -0,0 +1,125 @@
+"""
+Advisory file locks and atomic writes, so that several precipy processes
+can safely share one cache directory.
+"""
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import uuid4
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # advisory locks aren't available on this platform (e.g. Windows)
+    fcntl = None
+
+@contextmanager
+def atomic_path(filepath):
+    """
+    Yields a temporary path next to filepath. If the block completes without
+    error and the temporary file was written, it is renamed over filepath,
+    so readers never see a partially written file.
+    """
+    filepath = Path(filepath)
+    tmp_filepath = filepath.parent / (".%s.%s.tmp" % (filepath.name, uuid4().hex))
+    try:
+        yield tmp_filepath
+        if os.path.exists(tmp_filepath):
+            os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+@contextmanager
+def atomic_write(filepath, mode='w'):
+    """
+    Yields a file object which replaces filepath atomically once the block
+    completes.
+    """
+    with atomic_path(filepath) as tmp_filepath:
+        with open(tmp_filepath, mode) as f:
+            yield f
+
+class FileLock(object):
+    """
+    An exclusive advisory lock on a lock file. Lock files are left in place
+    after the lock is released, removing them would race with other
+    processes which have opened them but not yet acquired the lock.
+    """
+    def __init__(self, lock_filepath, description=None):
+        self.lock_filepath = lock_filepath
+        self.description = description or str(lock_filepath)
+        self.f = None
+        self.waited = False
+
+    def acquire(self, blocking=True):
+        """
+        Acquires the lock, waiting for any other holder to release it if
+        blocking is True. Returns True if the lock was acquired.
+        """
+        self.f = open(self.lock_filepath, 'a')
+        if fcntl is None:
+            return True
+
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not blocking:
+                self.f.close()
+                self.f = None
+                return False
+
+        self.waited = True
+        logging.getLogger(name="precipy").info(
+                "waiting for %s which is locked by another process" % self.description)
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return True
+
+    def release(self):
+        if self.f is not None:
+            if fcntl is not None:
+                fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls made with the same key by threads of one
+    process, so the work is done once and every caller gets its result.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) unless a call with the same key is already
+        running, in which case waits for that call and returns its result or
+        raises its exception.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+
+        if leader:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+        return future.result()
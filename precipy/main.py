@@ -5,18 +5,77 @@ You need to write your own python script so you can import analytics modules and
 
 It is recommended to import render_file from here into your script.
 """
+from concurrent.futures import ThreadPoolExecutor
+from precipy import PrecipyException
 from precipy.batch import Batch
+from precipy.context import RenderContext
+from precipy.distributed import Coordinator
+from precipy.distributed import Worker
+from precipy.distributed import expand_tasks
+from precipy.pack import PackReader
+from precipy.pack import all_cache_filenames
+from precipy.pack import task_cache_filenames
+from precipy.pack import write_pack
+from precipy.scheduling import Plan
+from precipy.server import RenderService
+from precipy.server import make_server
 import importlib
+import collections
 import json
+import multiprocessing
+import os
 import sys
 
 
-def render_file(filepath, raw_analytics_modules, storages=None, custom_render_fns=None):
+def render_file(filepath, raw_analytics_modules, storages=None, custom_render_fns=None, shard=None):
     with open(filepath, 'r') as f:
         info = json.load(f)
     return render_data(info, raw_analytics_modules,
             storages=storages,
-            custom_render_fns=custom_render_fns)
+            custom_render_fns=custom_render_fns,
+            shard=shard)
+
+def render_files(filepaths, raw_analytics_modules, storages=None, custom_render_fns=None, shard=None, workers=1):
+    """
+    Renders many configuration files in one process. Analytics modules are
+    imported once, and the batches share a RenderContext, so Jinja
+    environments and compiled templates, filter engines, parsed template
+    data, recently used results and storage connections are set up once
+    rather than for every config.
+
+    Each config publishes to an output subdirectory named after its file,
+    unless it sets output_subdir. With workers > 1, that many configs are
+    rendered at a time in threads, and an analytics function needed by
+    several of them at once is computed once. Functions from configs with
+    different constants take turns, so each runs with its own config's
+    constants. The storages are shared by every config, so configs need the
+    same cache_bucket_name and output_bucket_name.
+
+    Returns the list of batches.
+    """
+    names = [os.path.splitext(os.path.basename(filepath))[0] for filepath in filepaths]
+    duplicates = [name for name, n in collections.Counter(names).items() if n > 1]
+    if duplicates:
+        raise PrecipyException("config files need different names to be rendered together, got %s more than once" % (
+            ", ".join(duplicates)))
+
+    analytics_modules = load_analytics_modules(raw_analytics_modules)
+    context = RenderContext()
+
+    def render_config(filepath, name):
+        info = load_config(filepath, storages, shard)
+        info.setdefault('output_subdir', name)
+        if custom_render_fns:
+            info['custom_render_fns'] = custom_render_fns
+        batch = Batch(info, context=context)
+        batch.run(analytics_modules)
+        return batch
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(render_config, filepaths, names))
+    finally:
+        context.shutdown()
 
 def import_module_or_file(ram):
     try:
@@ -28,7 +87,7 @@ def import_module_or_file(ram):
         spec.loader.exec_module(module)
         return module
 
-def render_data(info, raw_analytics_modules, storages=None, custom_render_fns=None):
+def render_data(info, raw_analytics_modules, storages=None, custom_render_fns=None, shard=None):
     """
     Runs all analytics then generates any reports, per the configuration file specified by filepath.
 
@@ -37,12 +96,38 @@ def render_data(info, raw_analytics_modules, storages=None, custom_render_fns=No
     You can provide additional document rendering tools via custom_render_fns which should be a list of functions.
     Function names should be of the form do_x where x is the name of the document filter, e.g. do_markdown
     See precipy/output_filters.py for examples.
+
+    To split a large set of ranges across several machines, pass shard as
+    "i/N" to only process the ith of N slices.
     """
     if custom_render_fns:
         info['custom_render_fns'] = custom_render_fns
     if storages:
         info['storages'] = storages
+    if shard:
+        info['shard'] = shard
+
+    batch = Batch(info)
+    batch.run(load_analytics_modules(raw_analytics_modules))
+    return batch
 
+async def render_data_async(info, raw_analytics_modules, storages=None, custom_render_fns=None, shard=None):
+    """
+    Asyncio version of render_data, see Batch.run_async. Analytics functions
+    written as async def are awaited concurrently, others run in threads.
+    """
+    if custom_render_fns:
+        info['custom_render_fns'] = custom_render_fns
+    if storages:
+        info['storages'] = storages
+    if shard:
+        info['shard'] = shard
+
+    batch = Batch(info)
+    await batch.run_async(load_analytics_modules(raw_analytics_modules))
+    return batch
+
+def load_analytics_modules(raw_analytics_modules):
     analytics_modules = []
     for ram in raw_analytics_modules:
         if isinstance(ram, str):
@@ -50,7 +135,103 @@ def render_data(info, raw_analytics_modules, storages=None, custom_render_fns=No
         else:
             am = ram
         analytics_modules.append(am)
+    return analytics_modules
 
-    batch = Batch(info)
-    batch.run(analytics_modules)
-    return batch
+def load_config(filepath, storages=None, shard=None):
+    with open(filepath, 'r') as f:
+        info = json.load(f)
+    if storages:
+        info['storages'] = storages
+    if shard:
+        info['shard'] = shard
+    return info
+
+def run_worker(filepath, raw_analytics_modules, storages=None, shard=None, processes=1, **worker_kwargs):
+    """
+    Runs analytics for the configuration file as one of several workers
+    sharing a storage. See precipy/distributed.py for the options.
+
+    With processes > 1, starts that many workers in separate processes.
+    """
+    if processes > 1:
+        workers = [multiprocessing.Process(target=run_worker,
+            args=(filepath, raw_analytics_modules),
+            kwargs=dict(storages=storages, shard=shard, **worker_kwargs))
+            for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            raise PrecipyException("%s worker process(es) failed" % len([w for w in workers if w.exitcode != 0]))
+        return
+
+    batch = Batch(load_config(filepath, storages, shard))
+    worker = Worker(batch, load_analytics_modules(raw_analytics_modules), **worker_kwargs)
+    return worker.run()
+
+def run_coordinator(filepath, raw_analytics_modules, storages=None, shard=None, **coordinator_kwargs):
+    """
+    Publishes the analytics tasks for the configuration file for workers
+    sharing a storage to run, then generates documents from their results.
+    """
+    batch = Batch(load_config(filepath, storages, shard))
+    coordinator = Coordinator(batch, load_analytics_modules(raw_analytics_modules), **coordinator_kwargs)
+    return coordinator.run()
+
+def plan_file(filepath, raw_analytics_modules, storages=None, shard=None, workers=1):
+    """
+    Returns a Plan describing which analytics for the configuration file are
+    already cached and estimating how long the rest will take to run,
+    without running anything.
+    """
+    batch = Batch(load_config(filepath, storages, shard))
+    return Plan(batch, load_analytics_modules(raw_analytics_modules), workers)
+
+def export_cache(pack_filepath, config_filepath=None, raw_analytics_modules=None, storages=None, shard=None,
+        range_keys=None):
+    """
+    Writes cache entries to a pack file, see precipy/pack.py. With a
+    configuration file, only the entries for its analytics are written, and
+    only those for the given range keys (e.g. "a_1") if any are given.
+    Otherwise everything in the local cache is written. Returns the number of
+    entries written.
+    """
+    if config_filepath is None:
+        if range_keys:
+            raise PrecipyException("exporting entries for ranges needs a config file")
+        batch = Batch({})
+        cache_filenames = all_cache_filenames(batch.cachePath)
+    else:
+        batch = Batch(load_config(config_filepath, storages, shard))
+        tasks = expand_tasks(batch, load_analytics_modules(raw_analytics_modules or []))
+        cache_filenames = task_cache_filenames(batch, tasks, range_keys or None)
+    return len(write_pack(pack_filepath, batch.cache, cache_filenames))
+
+def import_cache(pack_filepath, config_filepath=None, overwrite=False):
+    """
+    Unpacks a pack file into the local cache used by the configuration file,
+    or the default local cache. Returns the number of entries written.
+    """
+    if config_filepath is None:
+        batch = Batch({})
+    else:
+        batch = Batch(load_config(config_filepath))
+    return PackReader(pack_filepath).extract_all(batch.cachePath, overwrite)
+
+def serve(raw_analytics_modules, storages=None, host="127.0.0.1", port=8000, socket_path=None, defaults=None,
+        filters=None, keep_outputs=False):
+    """
+    Runs a render server until interrupted, see precipy/server.py.
+    """
+    service = RenderService(load_analytics_modules(raw_analytics_modules), storages=storages, defaults=defaults,
+            filters=filters, keep_outputs=keep_outputs)
+    server = make_server(service, host=host, port=port, socket_path=socket_path)
+    print("serving on %s" % (socket_path or "http://%s:%s" % server.server_address[0:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
@@ -0,0 +1,194 @@
+"""
+Measuring how much memory analytics functions use, and limiting how many
+run at once on a machine so their predicted memory fits a budget.
+"""
+from precipy import PrecipyException
+from precipy.locking import FileLock
+from precipy.locking import atomic_write
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+MEMORY_UNITS = { "K" : 1024, "M" : 1024 ** 2, "G" : 1024 ** 3, "T" : 1024 ** 4 }
+
+def parse_memory(spec):
+    """
+    Parses a number of bytes, optionally with a K, M, G or T suffix.
+    """
+    if spec is None or isinstance(spec, (int, float)):
+        return spec
+    spec = str(spec).strip().upper().rstrip("B")
+    try:
+        if spec and spec[-1] in MEMORY_UNITS:
+            return int(float(spec[:-1]) * MEMORY_UNITS[spec[-1]])
+        return int(spec)
+    except ValueError:
+        raise PrecipyException("can't parse memory size '%s', use e.g. 512M or 8G" % spec)
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it
+    can't be determined. Falls back to the peak RSS where the current RSS
+    isn't available.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+class MemoryTracker(object):
+    """
+    Measures memory use while a block of code runs.
+
+    With track_rss, a background thread samples the process RSS and
+    peak_rss_bytes is the largest increase over the RSS at the start. With
+    track_allocations, tracemalloc is used and peak_alloc_bytes is the
+    largest increase in memory allocated by Python code. Tracemalloc gives
+    more detail but slows code down noticeably.
+
+    Both measure the whole process, so blocks which overlap with another
+    tracked block, such as functions run at the same time in threads or on
+    an event loop, can't be told apart. Their peaks are left as None rather
+    than recording each other's memory, and only the first of them touches
+    tracemalloc.
+    """
+    # trackers whose blocks are running, in any thread
+    active = set()
+    active_lock = threading.Lock()
+
+    def __init__(self, track_rss=True, track_allocations=False, interval=0.01):
+        self.track_rss = track_rss
+        self.track_allocations = track_allocations
+        self.interval = interval
+        self.peak_rss_bytes = None
+        self.peak_alloc_bytes = None
+        self.overlapped = False
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.max_rss = max(self.max_rss, current_rss() or 0)
+
+    def __enter__(self):
+        with self.active_lock:
+            for other in self.active:
+                other.overlapped = True
+            self.overlapped = bool(self.active)
+            self.active.add(self)
+        # overlapping from the start, so nothing to measure
+        self.measuring = not self.overlapped
+
+        if self.measuring and self.track_allocations:
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.start_alloc = tracemalloc.get_traced_memory()[0]
+
+        if self.measuring and self.track_rss:
+            self.start_rss = current_rss()
+            self.max_rss = self.start_rss or 0
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.active_lock:
+            self.active.discard(self)
+        if not self.measuring:
+            return
+
+        if self.track_rss:
+            self.stopped.set()
+            self.thread.join()
+            if self.start_rss is not None and not self.overlapped:
+                self.max_rss = max(self.max_rss, current_rss() or 0)
+                self.peak_rss_bytes = self.max_rss - self.start_rss
+
+        if self.track_allocations:
+            if not self.overlapped:
+                self.peak_alloc_bytes = max(0, tracemalloc.get_traced_memory()[1] - self.start_alloc)
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+def pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, but owned by another user
+        return True
+    return True
+
+class MemoryLedger(object):
+    """
+    Reservations of memory by tasks running on this machine, kept in the
+    local cache directory so that all workers on the machine share a
+    max_memory budget.
+    """
+    def __init__(self, path, max_memory):
+        self.path = path
+        self.max_memory = max_memory
+        self.lock_filepath = os.path.join(path, "ledger.lock")
+        os.makedirs(path, exist_ok=True)
+
+    def reservation_filepath(self, name):
+        return os.path.join(self.path, "%s.json" % name)
+
+    def reservations(self):
+        """
+        Returns a dictionary of name:bytes for reservations held by running
+        processes, removing any left behind by processes which died.
+        """
+        reservations = {}
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".json"):
+                continue
+            filepath = os.path.join(self.path, filename)
+            try:
+                with open(filepath, 'r') as f:
+                    reservation = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if pid_is_running(reservation['pid']):
+                reservations[filename[:-5]] = reservation['bytes']
+            else:
+                os.remove(filepath)
+        return reservations
+
+    def reserve(self, name, n_bytes):
+        """
+        Reserves n_bytes for the task called name if it fits in the budget
+        alongside other running tasks. A task is always admitted if nothing
+        else is running, even if its prediction exceeds the budget. Returns
+        True if the reservation was made.
+        """
+        n_bytes = n_bytes or 0
+        with FileLock(self.lock_filepath, "memory ledger"):
+            reserved = self.reservations()
+            if reserved and sum(reserved.values()) + n_bytes > self.max_memory:
+                return False
+            with atomic_write(self.reservation_filepath(name)) as f:
+                json.dump({ "bytes" : n_bytes, "pid" : os.getpid(), "time" : time.time() }, f)
+            return True
+
+    def release(self, name):
+        try:
+            os.remove(self.reservation_filepath(name))
+        except FileNotFoundError:
+            pass
@@ -1,11 +1,58 @@
-import subprocess
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+from precipy import ReportFilterException
+import contextvars
+import functools
 import markdown
 import os
+import shutil
+import subprocess
+import threading
+
+# Paths to external programs used by filters, keyed by filter name, for the
+# filter currently running. Filters fall back to looking up the program on
+# the PATH.
+executables = contextvars.ContextVar('executables', default={})
+
+# Seconds an external program may run for, None for no limit.
+timeout = contextvars.ContextVar('timeout', default=None)
+
+# Filters run in the document's work directory, and the working directory is
+# shared by every thread, so filters running in this process take turns.
+cwd_lock = threading.RLock()
+
+def executable(filter_name, default):
+    return executables.get().get(filter_name) or shutil.which(default) or default
+
+@functools.lru_cache(maxsize=None)
+def markdown_converter():
+    return markdown.Markdown()
+
+@functools.lru_cache(maxsize=None)
+def weasyprint_font_config():
+    try:
+        from weasyprint.text.fonts import FontConfiguration
+    except ImportError:
+        # weasyprint < 53
+        from weasyprint.fonts import FontConfiguration
+    return FontConfiguration()
+
+def warm_xhtml2pdf():
+    from xhtml2pdf import pisa
+
+# Functions which do a filter's slow imports and setup, run once when a
+# filter worker process starts.
+WARMUP = {
+        'markdown' : markdown_converter,
+        'weasyprint' : weasyprint_font_config,
+        'xhtml2pdf' : warm_xhtml2pdf
+        }
 
 def do_markdown(input_filepath, output_filepath, output_ext, filter_args):
     with open(input_filepath, 'r') as i_f:
         with open(output_filepath, 'w') as o_f:
-            html = markdown.markdown(i_f.read())
+            html = markdown_converter().reset().convert(i_f.read())
             o_f.write(html)
     assert os.path.exists(output_filepath)
 
@@ -17,7 +64,122 @@ def do_xhtml2pdf(input_filepath, output_filepath, output_ext, filter_args):
 
 def do_weasyprint(input_filepath, output_filepath, output_ext, filter_args):
     from weasyprint import HTML
-    HTML(input_filepath).write_pdf(output_filepath)
+    HTML(input_filepath).write_pdf(output_filepath, font_config=weasyprint_font_config())
 
 def do_pandoc(input_filepath, output_filepath, output_ext, filter_args):
-    subprocess.run(['/opt/local/bin/pandoc', input_filepath, '-o', output_filepath], capture_output=True, check=True)
+    subprocess.run([executable('pandoc', 'pandoc'), input_filepath, '-o', output_filepath],
+            capture_output=True, check=True, timeout=timeout.get())
+
+def run_filter(filter_fn, work_dir, input_filename, output_filename, output_ext, filter_args,
+        filter_executables=None, filter_timeout=None):
+    """
+    Runs filter_fn within work_dir, where the input document and any
+    supplemental files it refers to have been copied, with the given
+    external program paths and timeout.
+    """
+    executables_token = executables.set(dict(filter_executables or {}))
+    timeout_token = timeout.set(filter_timeout)
+    with cwd_lock:
+        orig_dir = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            filter_fn(input_filename, output_filename, output_ext, filter_args)
+        finally:
+            os.chdir(orig_dir)
+            executables.reset(executables_token)
+            timeout.reset(timeout_token)
+
+def init_filter_worker(filter_name):
+    if filter_name in WARMUP:
+        WARMUP[filter_name]()
+
+class FilterEngine(object):
+    """
+    Runs document filters. With workers=0 filters run in this process, with
+    workers > 0 each filter gets its own pool of long-lived worker processes
+    which import and set up everything the filter needs once, and documents
+    are queued to them.
+    """
+    def __init__(self, workers=0, timeout=None, executables=None, custom_filter_fns=None):
+        """
+        Arguments:
+
+            workers - number of worker processes per filter, 0 to run filters in this process
+            timeout - seconds to wait for each document, None for no limit
+            executables - dictionary of filter names:paths to the external programs they run
+            custom_filter_fns - list of additional do_x functions, which take precedence over built in ones
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.executables = executables or {}
+        self.custom_filter_fns = dict((fn.__name__, fn) for fn in (custom_filter_fns or []))
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def filter_fn(self, filter_name):
+        fn_name = "do_%s" % filter_name
+        if fn_name in self.custom_filter_fns:
+            return self.custom_filter_fns[fn_name]
+        elif fn_name in globals():
+            return globals()[fn_name]
+        else:
+            raise ReportFilterException("no document filter named '%s'" % filter_name)
+
+    def pool(self, filter_name):
+        with self.lock:
+            if not filter_name in self.pools:
+                self.pools[filter_name] = ProcessPoolExecutor(max_workers=self.workers,
+                        initializer=init_filter_worker,
+                        initargs=(filter_name,))
+            return self.pools[filter_name]
+
+    def discard_pool(self, filter_name):
+        """
+        Stops a filter's pool, cancelling queued documents and terminating
+        its worker processes, so one stuck in a filter doesn't keep the
+        interpreter from exiting. A new pool is started for the next document.
+        """
+        with self.lock:
+            pool = self.pools.pop(filter_name, None)
+        if pool is not None:
+            # shutdown() can't stop a running task, so terminate the workers
+            # as concurrent.futures does for a broken pool
+            processes = list((getattr(pool, '_processes', None) or {}).values())
+            pool.shutdown(wait=False, cancel_futures=True)
+            for process in processes:
+                process.terminate()
+
+    def submit(self, filter_name, work_dir, input_filename, output_filename, output_ext, filter_args):
+        """
+        Queues a document to be filtered, returning a Future.
+        """
+        args = (self.filter_fn(filter_name), work_dir, input_filename, output_filename, output_ext, filter_args,
+                self.executables, self.timeout)
+        if self.workers > 0:
+            return self.pool(filter_name).submit(run_filter, *args)
+
+        future = Future()
+        try:
+            future.set_result(run_filter(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def wait(self, future, description, filter_name=None):
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # don't leave the document running, or shutdown would wait for it
+            if not future.cancel() and filter_name is not None:
+                self.discard_pool(filter_name)
+            raise ReportFilterException("timed out after %ss filtering %s" % (self.timeout, description))
+        except ReportFilterException:
+            raise
+        except Exception as e:
+            raise ReportFilterException("error filtering %s: %s" % (description, e)) from e
+
+    def shutdown(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.shutdown()
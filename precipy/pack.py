@@ -0,0 +1,156 @@
+"""
+Pack files, which bundle cache entries into a single file for copying a
+cache between machines or archiving it.
+
+A pack is the contents of each entry one after the other, followed by a JSON
+index of cache filename:[offset, size] and a trailer holding the index's
+offset. Single entries can be read with one seek, and a whole pack is
+unpacked with one sequential read. Entries are written with each function's
+supplemental files before its metadata, so metadata is unpacked last.
+"""
+from pathlib import Path
+from precipy import PrecipyException
+from precipy.analytics_function import load_metadata_header
+from precipy.cache import LocalDiskTier
+from precipy.identifiers import FileType
+from precipy.locking import atomic_write
+import json
+import os
+import shutil
+import struct
+
+MAGIC = b"PRECIPY-PACK-1\n"
+TRAILER = struct.Struct(">Q")
+CHUNK_SIZE = 1024 * 1024
+
+def copy_bytes(src, dest, size):
+    while size > 0:
+        chunk = src.read(min(CHUNK_SIZE, size))
+        if not chunk:
+            raise PrecipyException("pack file is truncated")
+        dest.write(chunk)
+        size -= len(chunk)
+
+def is_cache_entry(filename):
+    """
+    Returns True for files in the cache directory which are results, rather
+    than locks, temporary files or checkpoints.
+    """
+    return not (filename.startswith(".") or filename.endswith(".lock") or filename.endswith(".checkpoint.pkl"))
+
+def all_cache_filenames(cachePath):
+    """
+    Returns the names of every entry in the local cache directory.
+    """
+    filenames = []
+    for dirname in sorted(os.listdir(cachePath)):
+        dirpath = Path(cachePath) / dirname
+        if len(dirname) != 2 or not os.path.isdir(dirpath):
+            continue
+        filenames.extend(filename for filename in sorted(os.listdir(dirpath)) if is_cache_entry(filename))
+    return filenames
+
+def task_cache_filenames(batch, tasks, range_keys=None):
+    """
+    Returns the cache filenames of the metadata and supplemental files of
+    tasks, as returned by expand_tasks, limited to tasks found in any of
+    range_keys if given. Tasks whose results aren't in any cache tier are
+    skipped.
+    """
+    filenames = []
+    for h, task in tasks.items():
+        if range_keys is not None and not set(range_keys).intersection(task.range_keys):
+            continue
+        metadata_filename = "%s.pkl" % h
+        if not batch.cache.ensure_local(metadata_filename):
+            batch.logger.warning("%s (%s) isn't cached, skipping it" % (task.key, h))
+            continue
+        with open(batch.cache.filepath(metadata_filename), 'rb') as f:
+            files = load_metadata_header(f)['files']
+        for gf in files.values():
+            if gf.file_type != FileType.METADATA:
+                filenames.append(Path(gf.cache_filepath).name)
+        filenames.append(metadata_filename)
+    return filenames
+
+def write_pack(pack_filepath, cache, cache_filenames):
+    """
+    Writes the named entries of cache, a TieredCache, to a pack file,
+    fetching entries which aren't in the local cache from storages. Returns
+    the index.
+    """
+    index = {}
+    with atomic_write(pack_filepath, 'wb') as f:
+        f.write(MAGIC)
+        for cache_filename in cache_filenames:
+            if cache_filename in index:
+                continue
+            if not cache.ensure_local(cache_filename):
+                raise PrecipyException("couldn't find %s in any cache tier" % cache_filename)
+            offset = f.tell()
+            with open(cache.filepath(cache_filename), 'rb') as entry_f:
+                shutil.copyfileobj(entry_f, f, CHUNK_SIZE)
+            index[cache_filename] = [offset, f.tell() - offset]
+
+        index_offset = f.tell()
+        f.write(json.dumps({ "entries" : index }).encode('utf-8'))
+        f.write(TRAILER.pack(index_offset))
+        f.write(MAGIC)
+    return index
+
+class PackReader(object):
+    """
+    Reads entries from a pack file.
+    """
+    def __init__(self, pack_filepath):
+        self.pack_filepath = Path(pack_filepath)
+        with open(self.pack_filepath, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise PrecipyException("%s isn't a precipy pack file" % pack_filepath)
+            f.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+            index_end = f.tell()
+            index_offset, = TRAILER.unpack(f.read(TRAILER.size))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise PrecipyException("%s is truncated" % pack_filepath)
+            f.seek(index_offset)
+            self.index = json.loads(f.read(index_end - index_offset))['entries']
+
+    def exists(self, cache_filename):
+        return cache_filename in self.index
+
+    def read_bytes(self, cache_filename):
+        offset, size = self.index[cache_filename]
+        with open(self.pack_filepath, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def extract(self, cache_filename, dest_filepath):
+        """
+        Copies an entry to dest_filepath, returns False if there's no such entry.
+        """
+        if not cache_filename in self.index:
+            return False
+        offset, size = self.index[cache_filename]
+        with open(self.pack_filepath, 'rb') as f:
+            f.seek(offset)
+            with open(dest_filepath, 'wb') as dest_f:
+                copy_bytes(f, dest_f, size)
+        return True
+
+    def extract_all(self, cachePath, overwrite=False):
+        """
+        Unpacks every entry into the cache directory at cachePath in a single
+        pass over the file. Entries already in the cache are skipped unless
+        overwrite is True. Returns the number of entries written.
+        """
+        disk = LocalDiskTier(cachePath)
+        n_written = 0
+        with open(self.pack_filepath, 'rb') as f:
+            for cache_filename, (offset, size) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                if not overwrite and disk.exists(cache_filename):
+                    continue
+                f.seek(offset)
+                with atomic_write(disk.filepath(cache_filename), 'wb') as dest_f:
+                    copy_bytes(f, dest_f, size)
+                n_written += 1
+        return n_written
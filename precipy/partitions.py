@@ -0,0 +1,95 @@
+"""
+Partitioned analytics entries, which map a function over the values of one
+of its kwargs. Each partition is cached and computed as its own function,
+so when one input changes only that partition is recomputed, and the
+partitions of an entry are run in parallel.
+
+An entry is partitioned by a 'partition' kwarg naming the kwarg to map over
+and either a list of values or a glob pattern:
+
+    ["daily_totals", { "partition" : { "day" : ["2024-01-01", "2024-01-02"] } }]
+    ["daily_totals", { "partition" : { "path" : { "glob" : "data/*.csv" } } }]
+
+With a glob, the function is called with each matching path, and the hash of
+each partition includes the file's contents. The results of the partitions
+are combined by the function named in 'reduce', which is called with a
+results dictionary of partition value:function output, and is cached under
+the hashes of the partitions. Without 'reduce', the entry's output is the
+results dictionary itself.
+"""
+from precipy import PrecipyException
+from precipy.identifiers import hash_for_file_content
+import collections
+import glob
+
+# kwargs which are used by precipy and not passed to analytics functions
+RESERVED_KWARGS = ('function_name', 'input_hash', 'partition_keys')
+
+def collect_partitions(af, results):
+    return dict(results)
+
+# functions which can be named in configs without being in an analytics module
+BUILTIN_FUNCTIONS = { 'collect_partitions' : collect_partitions }
+
+def is_partitioned(kwargs):
+    return 'partition' in kwargs
+
+def partition_key(key, value):
+    return "%s[%s]" % (key, value)
+
+def partition_values(spec):
+    """
+    Returns the name of the partitioned kwarg and a list of (value, input
+    hash) tuples, where the input hash is the content hash of the file for
+    glob partitions and None otherwise.
+    """
+    if not isinstance(spec, dict) or len(spec) != 1:
+        raise PrecipyException("partition should name exactly one kwarg, got %s" % spec)
+    name, values = list(spec.items())[0]
+
+    if isinstance(values, dict):
+        if not 'glob' in values:
+            raise PrecipyException("partition %s should be a list of values or a glob, got %s" % (name, values))
+        paths = sorted(glob.glob(values['glob']))
+        if not paths:
+            raise PrecipyException("no files match partition glob %s" % values['glob'])
+        return name, [(path, hash_for_file_content(path)) for path in paths]
+
+    return name, [(value, None) for value in values]
+
+def partition_entries(key, kwargs):
+    """
+    Expands a partitioned entry into a list of (key, kwargs) entries, one
+    for each partition followed by one for the reduce function, which
+    depends on all the partitions and keeps the entry's key.
+    """
+    function_name = kwargs.get('function_name', key)
+    name, values = partition_values(kwargs['partition'])
+    base_kwargs = dict((k, v) for k, v in kwargs.items() if not k in ('partition', 'reduce', 'function_name'))
+    if name in base_kwargs:
+        raise PrecipyException("%s is partitioned, so shouldn't also be passed as a kwarg" % name)
+
+    entries = []
+    for value, input_hash in values:
+        entry_kwargs = dict(base_kwargs)
+        entry_kwargs['function_name'] = function_name
+        entry_kwargs[name] = value
+        if input_hash is not None:
+            entry_kwargs['input_hash'] = input_hash
+        entries.append((partition_key(key, value), entry_kwargs))
+
+    reduce_kwargs = {
+            'function_name' : kwargs.get('reduce', 'collect_partitions'),
+            'depends' : [entry_key for entry_key, _ in entries],
+            'partition_keys' : [[value, entry_key] for (value, _), (entry_key, _) in zip(values, entries)]
+            }
+    entries.append((key, reduce_kwargs))
+    return entries
+
+def partition_results(af):
+    """
+    Returns an OrderedDict of partition value:function output for the
+    partitions of a reduce function, read from the cache.
+    """
+    return collections.OrderedDict((value, af.read_output(entry_key))
+            for value, entry_key in af.kwargs['partition_keys'])
@@ -0,0 +1,142 @@
+"""
+Incremental publishing of documents and supplemental files.
+
+Each output location keeps a manifest of the files published to it along
+with their content hashes, so republishing only transfers files which
+changed and removes files which are no longer published.
+
+Sharded runs publish to the same output location, so a run only removes
+files under the range keys it published, and merges its entries into the
+manifest as it is when the run finishes. Two shards finishing at the same
+moment can still drop each other's manifest entries, which only means
+those files are transferred again next time.
+"""
+from pathlib import Path
+from precipy.identifiers import FileType
+from precipy.identifiers import hash_for_file_content
+from precipy.locking import atomic_path
+from precipy.locking import atomic_write
+import json
+import os
+import shutil
+
+MANIFEST_FILENAME = ".precipy-manifest.json"
+
+def output_name(range_key, canonical_filename):
+    """
+    Returns the name a file is published under, relative to the output root.
+    """
+    if range_key:
+        return "%s/%s" % (range_key, canonical_filename)
+    else:
+        return canonical_filename
+
+def is_owned(name, range_keys):
+    """
+    Returns True if name was published under one of range_keys, or always
+    if range_keys is None, meaning the run covered every range.
+    """
+    return range_keys is None or name.split("/", 1)[0] in range_keys
+
+def merge_manifest(previous, published, range_keys):
+    """
+    Returns the manifest after a run over range_keys published the entries
+    in published, keeping previous entries from other ranges.
+    """
+    merged = dict((name, h) for name, h in previous.items() if not is_owned(name, range_keys))
+    merged.update(published)
+    return merged
+
+def publish_hash(gf):
+    """
+    Returns a hash identifying the contents of a generated file.
+
+    Supplemental files and metadata are stored in the cache under a hash of
+    the function which generated them, so that hash identifies their
+    contents without reading them. Documents are hashed by content.
+    """
+    if gf.file_type in (FileType.ANALYTICS, FileType.METADATA):
+        return gf.h
+    else:
+        return hash_for_file_content(gf.cache_filepath)
+
+def read_manifest_file(filepath):
+    try:
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+class OutputDirectory(object):
+    """
+    A local directory which published files are synced into.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.manifest_filepath = self.path / MANIFEST_FILENAME
+        self.published = {}
+
+        previous = read_manifest_file(self.manifest_filepath)
+        if previous is None:
+            if os.path.exists(self.path):
+                # written before manifests were kept, start over
+                shutil.rmtree(self.path)
+            os.makedirs(self.path, exist_ok=True)
+            # so other shards starting now don't start over too
+            self.write_manifest({})
+        self.previous = previous or {}
+
+    def write_manifest(self, manifest):
+        with atomic_write(self.manifest_filepath) as f:
+            json.dump(manifest, f, sort_keys=True, indent=1)
+
+    def needs(self, name, h):
+        """
+        Returns True if publishing name with hash h would copy it.
+        """
+        return self.previous.get(name) != h or not os.path.exists(self.path / name)
+
+    def publish(self, entries):
+        """
+        Copies files which changed since the last publish. Entries is a
+        dictionary of output name:(hash, source filepath). Returns the list
+        of names which were copied.
+        """
+        copied = []
+        for name, (h, filepath) in entries.items():
+            dest = self.path / name
+            if self.needs(name, h):
+                os.makedirs(dest.parent, exist_ok=True)
+                with atomic_path(dest) as tmp_filepath:
+                    shutil.copyfile(filepath, tmp_filepath)
+                copied.append(name)
+            self.published[name] = h
+        return copied
+
+    def finish(self, range_keys=None):
+        """
+        Removes files which were published previously but not this time, and
+        saves the manifest. Returns the list of names which were removed.
+
+        If range_keys is given, only files under those range keys are
+        removed, and the manifest keeps other ranges' entries.
+        """
+        stale = [name for name in self.previous
+                if is_owned(name, range_keys) and not name in self.published]
+        for name in stale:
+            try:
+                os.remove(self.path / name)
+            except FileNotFoundError:
+                pass
+
+        for name in stale:
+            # remove directories emptied by removing stale files
+            parent = (self.path / name).parent
+            while parent != self.path and os.path.isdir(parent) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = parent.parent
+
+        current = read_manifest_file(self.manifest_filepath) or {}
+        self.previous = merge_manifest(current, self.published, range_keys)
+        self.write_manifest(self.previous)
+        return stale
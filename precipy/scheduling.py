@@ -0,0 +1,266 @@
+"""
+Estimating how long analytics functions will take, and ordering tasks so
+that the longest chains of dependent work start first.
+"""
+from pathlib import Path
+from precipy.identifiers import fingerprint_fn
+from precipy.identifiers import hash_for_dict
+from precipy.locking import FileLock
+from precipy.locking import atomic_write
+import collections
+import heapq
+import json
+import threading
+
+# cost assumed for functions which have never been run
+DEFAULT_COST_SECONDS = 1.0
+
+def arg_shape(kwargs):
+    """
+    Describes the names and types of arguments, and the lengths of sized
+    arguments, without their values. Calls with the same argument shape are
+    assumed to take similar amounts of time.
+    """
+    shape = []
+    for k in sorted(kwargs):
+        if k in ('function_name', 'depends'):
+            continue
+        v = kwargs[k]
+        if isinstance(v, (str, bytes, list, tuple, dict, set, frozenset)):
+            shape.append((k, type(v).__name__, len(v)))
+        else:
+            shape.append((k, type(v).__name__))
+    return shape
+
+def peak_memory(af):
+    """
+    Returns the best available measure of the memory af used when it ran,
+    or None if memory wasn't tracked.
+    """
+    for k in ('function_peak_rss_bytes', 'function_peak_alloc_bytes'):
+        if getattr(af, k, None) is not None:
+            return getattr(af, k)
+
+class CostModel(object):
+    """
+    A history of how long analytics functions took to run and how much
+    memory they used, keyed by a fingerprint of the function's code and the
+    shape of its arguments, and kept in the cache directory.
+
+    New records are held in memory until flush is called, which a batch does
+    once at the end of its run, so the history file is only rewritten once
+    however many functions run.
+    """
+    history_filename = "timings.json"
+    history_length = 10
+
+    def __init__(self, cachePath):
+        self.filepath = Path(cachePath) / self.history_filename
+        self.lock_filepath = Path(cachePath) / "timings.lock"
+        self.lock = threading.Lock()
+        self.pending = []
+        self.history = self.read()
+
+    def read(self):
+        try:
+            with open(self.filepath, 'r') as f:
+                history = json.load(f)
+        except (FileNotFoundError, ValueError):
+            history = {}
+        if not "seconds" in history:
+            # histories written before memory was recorded only have times
+            history = { "seconds" : history }
+        history.setdefault("memory", {})
+        return history
+
+    def cost_key(self, af):
+        fingerprint = fingerprint_fn(af.fn)
+        return hash_for_dict({
+            'fn_fingerprint' : [(k, fingerprint[k]) for k in sorted(fingerprint)],
+            'arg_shape' : arg_shape(af.kwargs)
+            })
+
+    def add(self, history, cost_key, seconds, memory_bytes):
+        for k, value in (("seconds", seconds), ("memory", memory_bytes)):
+            if value is not None:
+                values = history[k].setdefault(cost_key, [])
+                values.append(value)
+                del values[:-self.history_length]
+
+    def record(self, cost_key, seconds, memory_bytes=None):
+        with self.lock:
+            self.add(self.history, cost_key, seconds, memory_bytes)
+            self.pending.append((cost_key, seconds, memory_bytes))
+
+    def flush(self):
+        """
+        Adds the records made since the last flush to the history file,
+        along with any written by other processes in the meantime.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        with FileLock(self.lock_filepath, "timing history"):
+            history = self.read()
+            for record in pending:
+                self.add(history, *record)
+            with atomic_write(self.filepath) as f:
+                json.dump(history, f)
+        with self.lock:
+            for record in self.pending:
+                self.add(history, *record)
+            self.history = history
+
+    def record_run(self, af):
+        self.record(self.cost_key(af), af.function_elapsed_seconds, peak_memory(af))
+
+    def record_cached(self, af):
+        """
+        Seeds the history from a cached result's elapsed time and memory
+        use, if there is no history for the function yet.
+        """
+        seconds = getattr(af, 'function_elapsed_seconds', None)
+        if seconds is not None:
+            cost_key = self.cost_key(af)
+            if not cost_key in self.history["seconds"]:
+                self.record(cost_key, seconds, peak_memory(af))
+
+    def estimate(self, cost_key):
+        """
+        Returns the mean of recent run times, or None if there's no history.
+        """
+        times = self.history["seconds"].get(cost_key)
+        if times:
+            return sum(times) / len(times)
+
+    def estimate_memory(self, cost_key):
+        """
+        Returns the largest recent memory use, or None if there's no history.
+        """
+        memory = self.history["memory"].get(cost_key)
+        if memory:
+            return max(memory)
+
+def task_costs(tasks, cost_model, done=None):
+    """
+    Returns a dictionary of task hash:estimated seconds. Tasks in done cost
+    nothing, tasks without history are assumed to take as long as the
+    average known task.
+    """
+    done = done or set()
+    estimates = dict((h, cost_model.estimate(task.cost_key)) for h, task in tasks.items())
+    known = [e for e in estimates.values() if e is not None]
+    default_cost = sum(known) / len(known) if known else DEFAULT_COST_SECONDS
+
+    costs = {}
+    for h in tasks:
+        if h in done:
+            costs[h] = 0.0
+        elif estimates[h] is None:
+            costs[h] = default_cost
+        else:
+            costs[h] = estimates[h]
+    return costs
+
+def critical_path_priorities(tasks, costs):
+    """
+    Returns a dictionary of task hash:seconds of the longest chain of work
+    which starts with the task, i.e. the task's own cost plus the longest
+    chain of tasks which depend on it. Tasks must be ordered with each task
+    after the tasks it depends on, as returned by expand_tasks.
+    """
+    dependents = collections.defaultdict(list)
+    for task in tasks.values():
+        for dep_h in task.depends.values():
+            dependents[dep_h].append(task.h)
+
+    priorities = {}
+    for h in reversed(list(tasks)):
+        priorities[h] = costs[h] + max([priorities[d] for d in dependents[h]] or [0])
+    return priorities
+
+def order_by_priority(tasks, priorities):
+    return sorted(tasks.values(), key=lambda task: -priorities[task.h])
+
+def estimate_wall_time(tasks, costs, workers=1):
+    """
+    Simulates running tasks on the given number of workers, each starting
+    the ready task with the longest critical path first, and returns the
+    estimated number of seconds until all are done.
+    """
+    priorities = critical_path_priorities(tasks, costs)
+    pending = order_by_priority(tasks, priorities)
+    running = []
+    done = set()
+    now = 0.0
+
+    while pending or running:
+        for task in list(pending):
+            if len(running) >= workers:
+                break
+            if all(h in done for h in task.depends.values()):
+                heapq.heappush(running, (now + costs[task.h], task.h))
+                pending.remove(task)
+
+        if not running:
+            # remaining tasks depend on tasks which aren't in this run
+            break
+
+        now, h = heapq.heappop(running)
+        done.add(h)
+
+    return now
+
+class PlanEntry(object):
+    def __init__(self, task, cached, estimate):
+        self.task = task
+        self.cached = cached
+        self.estimate = estimate
+
+class Plan(object):
+    """
+    Describes which tasks of a batch will be loaded from the cache and which
+    will be run, and estimates how long running them will take.
+    """
+    def __init__(self, batch, analytics_modules, workers=1):
+        from precipy.distributed import expand_tasks
+        self.workers = workers
+        self.tasks = expand_tasks(batch, analytics_modules)
+
+        self.entries = []
+        done = set()
+        for task in self.tasks.values():
+            af = batch.resolve_function(task.key, task.kwargs, task.previous_functions)
+            if af.metadata_path_exists():
+                cached = "local"
+            elif batch.cache.exists_remotely(af.metadata_cache_filename()):
+                cached = "storage"
+            else:
+                cached = None
+            if cached:
+                done.add(task.h)
+            self.entries.append(PlanEntry(task, cached, batch.cost_model.estimate(task.cost_key)))
+
+        self.costs = task_costs(self.tasks, batch.cost_model, done)
+        self.critical_path_seconds = max(critical_path_priorities(self.tasks, self.costs).values() or [0])
+        self.wall_seconds = estimate_wall_time(self.tasks, self.costs, workers)
+
+    def summary(self):
+        lines = []
+        for entry in self.entries:
+            if entry.cached:
+                status = "hit (%s)" % entry.cached
+            elif entry.estimate is None:
+                status = "miss, no timing history"
+            else:
+                status = "miss, ~%.1fs" % entry.estimate
+            lines.append("%-30s %-30s %s  %s" % (entry.task.key, entry.task.range_key, entry.task.h[0:12], status))
+
+        n_hits = len([e for e in self.entries if e.cached])
+        lines.append("")
+        lines.append("%s tasks: %s cached, %s to run" % (len(self.entries), n_hits, len(self.entries) - n_hits))
+        lines.append("estimated total compute time: %.1fs" % sum(self.costs.values()))
+        lines.append("estimated critical path: %.1fs" % self.critical_path_seconds)
+        lines.append("estimated wall time with %s worker(s): %.1fs" % (self.workers, self.wall_seconds))
+        return "\n".join(lines)
@@ -0,0 +1,240 @@
+"""
+A long-running render server.
+
+Clients POST a config, in the same JSON format as the configs passed to
+render_data or loaded by precipy.mock.Request, to /render over HTTP or a
+Unix socket, and get back the documents generated for each range. The
+server keeps analytics modules, Jinja environments with their compiled
+templates, filter engines and recently used metadata in memory between
+requests.
+
+Requests come from clients which aren't trusted to run commands or write
+files on the server, so a request may only set the keys in REQUEST_KEYS,
+and may only use the filters the server was started with (markdown by
+default). Everything else, such as where files are written and which
+executables filters run, comes from the server's defaults. Templates are
+rendered in a Jinja sandbox, can't reach the batch, and can only read files
+in the request's output directory.
+
+Concurrent requests for the same config are rendered once and share the
+result, and concurrent requests which need the same analytics function
+hash compute it once. Each request is published to an output subdirectory
+named after its hash, which is removed once the response has been built
+unless the server keeps outputs.
+"""
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from precipy import PRECIPY_VERSION
+from precipy import PrecipyException
+from jinja2.exceptions import TemplateError
+from precipy.batch import Batch
+from precipy.context import RenderContext
+from precipy.identifiers import hash_for_dict
+from precipy.locking import SingleFlight
+from precipy.publish import output_name
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import socketserver
+import threading
+
+# the only config keys a request may set
+REQUEST_KEYS = ('analytics', 'ranges', 'constants', 'template', 'filters')
+
+DEFAULT_FILTERS = ('markdown',)
+
+class RenderService(object):
+    def __init__(self, analytics_modules, storages=None, defaults=None, filters=None, keep_outputs=False):
+        """
+        Arguments:
+
+            analytics_modules - list of modules containing analytics functions
+            storages - list of storages used for every request
+            defaults - dictionary of config values used for every request, requests can only override REQUEST_KEYS
+            filters - names of the filters requests may use, markdown if not given
+            keep_outputs - if true, each request's output directory is kept and its path is returned
+        """
+        self.analytics_modules = analytics_modules
+        self.storages = storages or []
+        self.defaults = defaults or {}
+        self.filters = set(filters or DEFAULT_FILTERS)
+        self.keep_outputs = keep_outputs
+        self.context = RenderContext()
+        self.requests = SingleFlight()
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_rendered = 0
+
+    def request_key(self, config):
+        return hash_for_dict({ "config" : json.dumps(config, sort_keys=True, default=str) })
+
+    def validate(self, config):
+        """
+        Raises PrecipyException if config sets keys other than REQUEST_KEYS,
+        lists analytics in the wrong form, uses filters the server doesn't
+        allow, or sets constants which aren't upper case names.
+        """
+        if not isinstance(config, dict):
+            raise PrecipyException("request should be a JSON object")
+
+        disallowed = sorted(set(config) - set(REQUEST_KEYS))
+        if disallowed:
+            raise PrecipyException("requests can't set %s, only %s" % (", ".join(disallowed), ", ".join(REQUEST_KEYS)))
+
+        analytics = config.get('analytics', [])
+        if not isinstance(analytics, list) or not all(isinstance(entry, list) and len(entry) == 2
+                and isinstance(entry[0], str) and isinstance(entry[1], dict) for entry in analytics):
+            raise PrecipyException("analytics should be a list of [function name, arguments]")
+
+        for filter_opts in config.get('filters', []):
+            if not isinstance(filter_opts, list) or len(filter_opts) != 2:
+                raise PrecipyException("filters should be given as [filter name, output extension], not %s" % (filter_opts,))
+            filter_name, output_ext = filter_opts
+            if not filter_name in self.filters:
+                raise PrecipyException("filter %s isn't available, use one of %s" % (filter_name, ", ".join(sorted(self.filters))))
+            if not isinstance(output_ext, str) or not re.match(r"^\w+$", output_ext):
+                raise PrecipyException("invalid output extension %s" % (output_ext,))
+
+        constants = config.get('constants', {})
+        if not isinstance(constants, dict):
+            raise PrecipyException("constants should be a JSON object")
+        for name in constants:
+            if not re.match(r"^[A-Z][A-Z0-9_]*$", name):
+                raise PrecipyException("constant names should be upper case, not %s" % name)
+
+    def render(self, config):
+        """
+        Renders config, or waits for an identical request which is already
+        being rendered, and returns a dictionary describing the documents.
+        """
+        with self.lock:
+            self.n_requests += 1
+        self.validate(config)
+        return self.requests.do(self.request_key(config), self.render_batch, config)
+
+    def render_batch(self, config):
+        info = dict(self.defaults)
+        info.update(config)
+        # documents from every range are described in the response
+        info['keep_range_state'] = True
+        # each config publishes to its own output subdirectory, so finishing
+        # one request doesn't remove another's documents
+        info['output_subdir'] = self.request_key(config)
+        # nothing is written to the server's working directory
+        info['local_output'] = False
+        info['sandbox'] = True
+        if self.storages:
+            info['storages'] = self.storages
+
+        batch = Batch(info, context=self.context)
+        try:
+            batch.run(self.analytics_modules)
+            description = self.describe(batch)
+        finally:
+            if not self.keep_outputs:
+                shutil.rmtree(batch.outputPath, ignore_errors=True)
+
+        with self.lock:
+            self.n_rendered += 1
+        return description
+
+    def describe(self, batch):
+        """
+        Returns the content of each range's documents, as published to the
+        batch's output directory, with their hashes and public urls.
+        """
+        documents = {}
+        for range_key in batch.range_keys:
+            if not range_key in batch.documents:
+                continue
+            documents[range_key] = {}
+            for name, doc in batch.documents[range_key].items():
+                filepath = batch.outputPath / output_name(range_key, doc.canonical_filename)
+                description = {
+                    "h" : doc.h,
+                    "public_urls" : doc.public_urls
+                    }
+                with open(filepath, 'rb') as f:
+                    content = f.read()
+                try:
+                    description["content"] = content.decode('utf-8')
+                except UnicodeDecodeError:
+                    description["content"] = base64.b64encode(content).decode('ascii')
+                    description["content_encoding"] = "base64"
+                if self.keep_outputs:
+                    description["path"] = str(filepath)
+                documents[range_key][name] = description
+        return { "batch" : batch.h, "documents" : documents }
+
+    def status(self):
+        with self.lock:
+            return {
+                    "version" : PRECIPY_VERSION,
+                    "requests" : self.n_requests,
+                    "rendered" : self.n_rendered
+                    }
+
+    def shutdown(self):
+        self.context.shutdown()
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # client_address is empty for Unix socket connections
+        return self.client_address[0] if self.client_address else "unix socket"
+
+    def log_message(self, format, *args):
+        logging.getLogger(name="precipy").info("%s %s" % (self.address_string(), format % args))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, { "error" : "not found" })
+
+    def do_POST(self):
+        if self.path != "/render":
+            self.send_json(404, { "error" : "not found" })
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            config = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_json(400, { "error" : "request body should be a JSON config: %s" % e })
+            return
+
+        try:
+            self.send_json(200, self.server.service.render(config))
+        except (PrecipyException, TemplateError) as e:
+            self.send_json(400, { "error" : str(e) })
+        except Exception as e:
+            logging.getLogger(name="precipy").exception("error rendering request")
+            self.send_json(500, { "error" : str(e) })
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host="127.0.0.1", port=8000, socket_path=None):
+    """
+    Returns a server which handles each request in its own thread, listening
+    on socket_path if given, otherwise on host and port.
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RenderRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    server.service = service
+    return server
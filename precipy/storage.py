@@ -1,7 +1,27 @@
+from pathlib import Path
+from precipy.locking import atomic_path
+from precipy.pack import PackReader
+from precipy.publish import MANIFEST_FILENAME
+from precipy.publish import is_owned
+from precipy.publish import merge_manifest
+from uuid import uuid4
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
 class Storage(object):
+    # read only storages are never written back to when used as a cache tier
+    read_only = False
+
     def init(self, batch):
         self.cache_bucket_name = batch.cache_bucket_name
         self.output_bucket_name = batch.output_bucket_name
+        # output manifests of batches publishing to this storage, keyed by output prefix
+        self.output_manifests = {}
+        self.published_outputs = {}
 
     def connect(self):
         pass
@@ -23,14 +43,29 @@ class Storage(object):
         """
         pass
 
-    def download_cache(self, cache_filepath):
+    async def upload_cache_async(self, cache_filepath):
+        """
+        Awaitable version of upload_cache. By default this runs upload_cache
+        in the event loop's default executor, storages with an asyncio
+        client can override it.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.upload_cache, cache_filepath)
+
+    def download_cache(self, cache_filepath, dest_filepath=None):
         """
-        Download the file from storage to local file system at cache_filepath 
+        Download the file from storage to local file system at cache_filepath,
+        or at dest_filepath if specified. The file is downloaded to a
+        temporary file first and then renamed, so it is never seen half
+        written.
 
         Should return true if sucessful, false if file does not exist remotely
         """
         cache_filename = cache_filepath.name
-        return self._download_cache(cache_filename, cache_filepath)
+        with atomic_path(dest_filepath or cache_filepath) as tmp_filepath:
+            found = self._download_cache(cache_filename, tmp_filepath)
+            if not found and os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return found
 
     def _download_cache(self, cache_filename, cache_filepath):
         """
@@ -38,6 +73,61 @@ class Storage(object):
         """
         pass
 
+    async def download_cache_async(self, cache_filepath, dest_filepath=None):
+        """
+        Awaitable version of download_cache, see upload_cache_async.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None,
+                self.download_cache, cache_filepath, dest_filepath)
+
+    def cache_exists(self, cache_filename):
+        """
+        Returns true if a file named cache_filename exists in the cache.
+        """
+        return self._cache_exists(cache_filename)
+
+    def _cache_exists(self, cache_filename):
+        """
+        Implement this method in subclass
+        """
+        return False
+
+    async def cache_exists_async(self, cache_filename):
+        """
+        Awaitable version of cache_exists, see upload_cache_async.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.cache_exists, cache_filename)
+
+    def delete_cache(self, cache_filename):
+        """
+        Deletes a file from the cache, if it exists. Only used for files
+        which are temporary, like checkpoints.
+        """
+        self._delete_cache(cache_filename)
+
+    def _delete_cache(self, cache_filename):
+        """
+        Implement this method in subclass
+        """
+        pass
+
+    def acquire_lease(self, lease_name, owner, seconds):
+        """
+        Tries to take, or renew, an exclusive lease called lease_name on
+        behalf of owner, expiring after the given number of seconds.
+
+        Should return true if owner holds the lease afterwards. Storages
+        without shared state can't coordinate, so by default this always
+        succeeds.
+        """
+        return True
+
+    def release_lease(self, lease_name, owner):
+        """
+        Releases lease_name if it is held by owner.
+        """
+        pass
+
     def reset_output(self):
         """
         Deletes and re-creates the output directory.
@@ -52,7 +142,7 @@ class Storage(object):
 
         Should return public_url to the file in storage if successful.
         """
-        return self._upload_cache(canonical_filename, cache_filepath)
+        return self._upload_output(canonical_filename, cache_filepath)
 
     def _upload_output(self, canonical_filename, cache_filepath):
         """
@@ -60,6 +150,246 @@ class Storage(object):
         """
         pass
 
+    def _read_output(self, canonical_filename):
+        """
+        Implement this method in subclass, should return the contents of the
+        output file as bytes, or None if it doesn't exist.
+        """
+        return None
+
+    def _delete_output(self, canonical_filenames):
+        """
+        Implement this method in subclass, should delete all the output files
+        in canonical_filenames, ideally in a single request.
+        """
+        pass
+
+    def start_output(self, prefix=None):
+        """
+        Loads the manifest of previously published output files, so only
+        files which changed are uploaded. If prefix is given, files are
+        published under it with their own manifest, so batches with
+        different prefixes can publish to the same storage at once.
+        """
+        manifest = self._read_output(self.output_path(MANIFEST_FILENAME, prefix))
+        self.output_manifests[prefix] = json.loads(manifest) if manifest else {}
+        self.published_outputs[prefix] = {}
+
+    def output_path(self, name, prefix=None):
+        if prefix:
+            return "%s/%s" % (prefix, name)
+        return name
+
+    def output_needs(self, name, h, prefix=None):
+        """
+        Returns True if publishing name with hash h would upload it.
+        """
+        return self.output_manifests[prefix].get(name) != h
+
+    def publish_output(self, entries, prefix=None):
+        """
+        Uploads output files which changed since they were last published.
+        Entries is a dictionary of output name:(hash, cache filepath).
+        Returns the list of names which were uploaded.
+        """
+        uploaded = []
+        for name, (h, cache_filepath) in entries.items():
+            if self.output_needs(name, h, prefix):
+                self.upload_output(self.output_path(name, prefix), cache_filepath)
+                uploaded.append(name)
+            self.published_outputs[prefix][name] = h
+        return uploaded
+
+    def finish_output(self, prefix=None, range_keys=None):
+        """
+        Deletes output files which weren't published this time and uploads
+        the new manifest. Returns the list of names which were deleted.
+
+        If range_keys is given, only files under those range keys are
+        deleted, and the manifest keeps other ranges' entries, see
+        precipy/publish.py.
+        """
+        published = self.published_outputs[prefix]
+        stale = [name for name in self.output_manifests[prefix]
+                if is_owned(name, range_keys) and not name in published]
+        if stale:
+            self._delete_output([self.output_path(name, prefix) for name in stale])
+
+        current = self._read_output(self.output_path(MANIFEST_FILENAME, prefix))
+        manifest = merge_manifest(json.loads(current) if current else {}, published, range_keys)
+        with tempfile.TemporaryDirectory() as tempdir:
+            manifest_filepath = os.path.join(tempdir, MANIFEST_FILENAME)
+            with open(manifest_filepath, 'w') as f:
+                json.dump(manifest, f, sort_keys=True, indent=1)
+            self._upload_output(self.output_path(MANIFEST_FILENAME, prefix), manifest_filepath)
+
+        self.output_manifests[prefix] = manifest
+        return stale
+
+
+class LocalStorage(Storage):
+    """
+    Stores files in a local directory, with one subdirectory per bucket.
+
+    Useful when several processes or machines share a filesystem, or as a
+    stand-in for cloud storage in tests.
+    """
+    def __init__(self, root=None):
+        self.root = root
+
+    def init(self, batch):
+        super().init(batch)
+        if self.root is None:
+            self.root = batch.config.get('local_storage_path', batch.tempdir / "storage")
+        self.root = Path(self.root)
+
+    def connect(self):
+        self.cache_dir = self.root / self.cache_bucket_name
+        self.output_dir = self.root / self.output_bucket_name
+        self.lease_dir = self.cache_dir / "leases"
+        for d in (self.cache_dir, self.output_dir, self.lease_dir):
+            os.makedirs(d, exist_ok=True)
+
+    def copy_file(self, src, dest):
+        with atomic_path(dest) as tmp_filepath:
+            shutil.copyfile(src, tmp_filepath)
+        return dest.resolve().as_uri()
+
+    def _upload_cache(self, cache_filename, cache_filepath):
+        return self.copy_file(cache_filepath, self.cache_dir / cache_filename)
+
+    def _download_cache(self, cache_filename, cache_filepath):
+        if self._cache_exists(cache_filename):
+            shutil.copyfile(self.cache_dir / cache_filename, cache_filepath)
+            return True
+        else:
+            return False
+
+    def _cache_exists(self, cache_filename):
+        return os.path.exists(self.cache_dir / cache_filename)
+
+    def _delete_cache(self, cache_filename):
+        try:
+            os.remove(self.cache_dir / cache_filename)
+        except FileNotFoundError:
+            pass
+
+    def _upload_output(self, canonical_filename, cache_filepath):
+        dest = self.output_dir / canonical_filename
+        os.makedirs(dest.parent, exist_ok=True)
+        return self.copy_file(cache_filepath, dest)
+
+    def _read_output(self, canonical_filename):
+        try:
+            with open(self.output_dir / canonical_filename, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _delete_output(self, canonical_filenames):
+        for canonical_filename in canonical_filenames:
+            try:
+                os.remove(self.output_dir / canonical_filename)
+            except FileNotFoundError:
+                pass
+
+    def read_lease(self, lease_filepath):
+        try:
+            with open(lease_filepath, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            # lease was released, or is being written right now
+            return None
+
+    def acquire_lease(self, lease_name, owner, seconds):
+        lease_filepath = self.lease_dir / ("%s.lease" % lease_name)
+        lease = { "owner" : owner, "expires" : time.time() + seconds }
+
+        current = self.read_lease(lease_filepath)
+        if current is not None and current['owner'] == owner:
+            with atomic_path(lease_filepath) as tmp_filepath:
+                with open(tmp_filepath, 'w') as f:
+                    json.dump(lease, f)
+            return True
+
+        if current is not None and current['expires'] < time.time():
+            # only one process can succeed in moving an expired lease aside
+            expired_filepath = "%s.%s.expired" % (lease_filepath, uuid4().hex)
+            try:
+                os.rename(lease_filepath, expired_filepath)
+            except FileNotFoundError:
+                return False
+            os.remove(expired_filepath)
+
+        try:
+            fd = os.open(lease_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+        return True
+
+    def release_lease(self, lease_name, owner):
+        lease_filepath = self.lease_dir / ("%s.lease" % lease_name)
+        # expired leases left by processes which died while moving them aside
+        for expired_filepath in self.lease_dir.glob("%s.lease.*.expired" % lease_name):
+            try:
+                os.remove(expired_filepath)
+            except FileNotFoundError:
+                pass
+
+        # move the lease aside before checking its owner, so a lease which
+        # expired and was taken over in the meantime isn't deleted
+        released_filepath = "%s.%s.released" % (lease_filepath, uuid4().hex)
+        try:
+            os.rename(lease_filepath, released_filepath)
+        except FileNotFoundError:
+            return
+        current = self.read_lease(released_filepath)
+        if current is None or current['owner'] != owner:
+            try:
+                os.link(released_filepath, lease_filepath)
+            except FileExistsError:
+                # another lease was taken while this one was moved aside
+                pass
+        os.remove(released_filepath)
+
+class PackStorage(Storage):
+    """
+    Reads cache entries straight from a pack file written by `precipy cache
+    export`, see precipy/pack.py. Nothing is written to it, and it has no
+    output files.
+    """
+    read_only = True
+
+    def __init__(self, pack_filepath=None):
+        self.pack_filepath = pack_filepath
+
+    def init(self, batch):
+        super().init(batch)
+        if self.pack_filepath is None:
+            self.pack_filepath = batch.config.get('pack_path')
+
+    def connect(self):
+        self.reader = PackReader(self.pack_filepath)
+
+    def _download_cache(self, cache_filename, cache_filepath):
+        return self.reader.extract(cache_filename, cache_filepath)
+
+    def _cache_exists(self, cache_filename):
+        return self.reader.exists(cache_filename)
+
+    def start_output(self, prefix=None):
+        pass
+
+    def output_needs(self, name, h, prefix=None):
+        return False
+
+    def publish_output(self, entries, prefix=None):
+        return []
+
+    def finish_output(self, prefix=None, range_keys=None):
+        return []
 
 class GoogleCloudStorage(Storage):
     def find_or_create_bucket(self, bucket_name):
@@ -90,16 +420,79 @@ class GoogleCloudStorage(Storage):
         else:
             return False
 
+    def _cache_exists(self, cache_filename):
+        return self.cache_storage_bucket.blob(cache_filename).exists()
+
+    def _delete_cache(self, cache_filename):
+        import google.api_core.exceptions
+        try:
+            self.cache_storage_bucket.delete_blob(cache_filename)
+        except google.api_core.exceptions.NotFound:
+            pass
+
+    def acquire_lease(self, lease_name, owner, seconds):
+        import google.api_core.exceptions
+        blob = self.cache_storage_bucket.get_blob("leases/%s" % lease_name)
+        lease = json.dumps({ "owner" : owner, "expires" : time.time() + seconds })
+
+        # generation preconditions make each of these steps fail if another
+        # worker changed the lease in the meantime
+        try:
+            if blob is None:
+                self.cache_storage_bucket.blob("leases/%s" % lease_name).upload_from_string(
+                        lease, if_generation_match=0)
+                return True
+
+            current = json.loads(blob.download_as_bytes())
+            if current['owner'] == owner or current['expires'] < time.time():
+                blob.upload_from_string(lease, if_generation_match=blob.generation)
+                return True
+        except google.api_core.exceptions.PreconditionFailed:
+            pass
+        return False
+
+    def release_lease(self, lease_name, owner):
+        import google.api_core.exceptions
+        blob = self.cache_storage_bucket.get_blob("leases/%s" % lease_name)
+        if blob is not None and json.loads(blob.download_as_bytes())['owner'] == owner:
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except (google.api_core.exceptions.PreconditionFailed, google.api_core.exceptions.NotFound):
+                pass
+
     def reset_output(self):
         #self.output_storage_bucket.delete(force=True)
         #self.output_storage_bucket = self.storage_client.create_bucket(self.output_bucket_name)
         pass
 
     def _upload_output(self, canonical_filename, cache_filepath):
-        blob = self.cache_storage_bucket.blob(canonical_filename)
+        blob = self.output_storage_bucket.blob(canonical_filename)
         blob.upload_from_filename(str(cache_filepath))
         return blob.public_url
 
+    def _read_output(self, canonical_filename):
+        blob = self.output_storage_bucket.get_blob(canonical_filename)
+        if blob is None:
+            return None
+        return blob.download_as_bytes()
+
+    def _delete_output(self, canonical_filenames):
+        import google.api_core.exceptions
+        try:
+            with self.storage_client.batch():
+                for canonical_filename in canonical_filenames:
+                    self.output_storage_bucket.delete_blob(canonical_filename)
+        except google.api_core.exceptions.NotFound:
+            # batched requests are only sent, and their errors raised, when
+            # the batch exits, so delete anything left over one at a time
+            for canonical_filename in canonical_filenames:
+                try:
+                    self.output_storage_bucket.delete_blob(canonical_filename)
+                except google.api_core.exceptions.NotFound:
+                    pass
+
 AVAILABLE_STORAGES = {
-        'google' : GoogleCloudStorage
+        'google' : GoogleCloudStorage,
+        'local' : LocalStorage,
+        'pack' : PackStorage
         }
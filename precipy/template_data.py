@@ -0,0 +1,137 @@
+"""
+Readers for data files used in templates. Parsed contents are memoized by
+content hash, so templates can call the readers inside loops, and a file
+published unchanged in several ranges is only parsed once. JSON is parsed
+with orjson or ujson if either is installed.
+
+Parsed values are shared between calls, and between batches which share a
+RenderContext, so templates shouldn't modify them.
+"""
+from precipy.identifiers import hash_for_file_content
+import collections
+import csv
+import io
+import json
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+def parse_json(f):
+    data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+def parse_text(f):
+    return io.TextIOWrapper(f, encoding='utf-8').read()
+
+class ParsedFileCache(object):
+    """
+    A size-bounded LRU of parsed file contents, keyed by content hash and
+    parser. Content hashes are remembered by path, and only recomputed when
+    a file's inode, size or modification time changes.
+    """
+    memory_size = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.content_hashes = collections.OrderedDict()
+        self.parsed = collections.OrderedDict()
+
+    def content_hash(self, filepath):
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if filepath in self.content_hashes:
+                self.content_hashes.move_to_end(filepath)
+                cached_signature, h = self.content_hashes[filepath]
+                if cached_signature == signature:
+                    return h
+
+        h = hash_for_file_content(filepath)
+
+        with self.lock:
+            self.content_hashes[filepath] = (signature, h)
+            while len(self.content_hashes) > 4 * self.memory_size:
+                self.content_hashes.popitem(last=False)
+        return h
+
+    def get(self, filepath, parser_name, parse):
+        """
+        Returns the result of calling parse on filepath opened in binary
+        mode, reusing the last result for the same contents and parser_name.
+        """
+        key = (self.content_hash(filepath), parser_name)
+        with self.lock:
+            if key in self.parsed:
+                self.parsed.move_to_end(key)
+                return self.parsed[key]
+
+        with open(filepath, 'rb') as f:
+            value = parse(f)
+
+        with self.lock:
+            self.parsed[key] = value
+            while len(self.parsed) > self.memory_size:
+                self.parsed.popitem(last=False)
+        return value
+
+class TemplateDataReader(object):
+    """
+    The data access functions made available to templates.
+    """
+    def __init__(self, parsed_files, resolve):
+        """
+        Arguments:
+
+            parsed_files - a ParsedFileCache
+            resolve - function returning the filepath to read for a path used in a template
+        """
+        self.parsed_files = parsed_files
+        self.resolve = resolve
+
+    def read_file_contents(self, path):
+        return self.parsed_files.get(self.resolve(path), "text", parse_text)
+
+    def load_json(self, path):
+        return self.parsed_files.get(self.resolve(path), "json", parse_json)
+
+    def csv_rows(self, path, **fmtparams):
+        """
+        Yields each row of a CSV file as a dictionary, reading the file as
+        it goes rather than loading it all at once.
+        """
+        with open(self.resolve(path), 'r', newline='') as f:
+            for row in csv.DictReader(f, **fmtparams):
+                yield row
+
+    def csv_columns(self, path, columns=None):
+        """
+        Returns a dictionary of column name:list of values for a CSV file,
+        keeping only the named columns if columns is given. Rows are read
+        one at a time, so only the kept columns are held in memory.
+        """
+        def parse_columns(f):
+            reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8', newline=''))
+            header = next(reader, [])
+            keep = [(i, name) for i, name in enumerate(header) if columns is None or name in columns]
+            values = collections.OrderedDict((name, []) for _, name in keep)
+            for row in reader:
+                for i, name in keep:
+                    values[name].append(row[i] if i < len(row) else None)
+            return values
+
+        parser_name = "csv_columns:%s" % (repr(tuple(columns)) if columns is not None else "*")
+        return self.parsed_files.get(self.resolve(path), parser_name, parse_columns)
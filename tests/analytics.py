@@ -1,5 +1,11 @@
+import asyncio
 import numpy as np
 import matplotlib.pyplot as plt
+import os
+import time
+
+# set by configs' constants
+CLIENT = None
 
 def wavy_line_plot(af, a, b):
     x1 = np.linspace(0.0, a)
@@ -8,17 +14,128 @@ def wavy_line_plot(af, a, b):
     y1 = np.cos(2 * np.pi * x1) * np.exp(-x1)
     y2 = np.cos(2 * np.pi * x2)
     
-    plt.subplot(2, 1, 1)
-    plt.plot(x1, y1, 'o-')
-    plt.title('A tale of 2 subplots')
-    plt.ylabel('Damped oscillation')
+    fig, (ax1, ax2) = plt.subplots(2, 1)
+    ax1.plot(x1, y1, 'o-')
+    ax1.set_title('A tale of 2 subplots')
+    ax1.set_ylabel('Damped oscillation')
     
-    plt.subplot(2, 1, 2)
-    plt.plot(x2, y2, '.-')
-    plt.xlabel('time (s)')
-    plt.ylabel('Undamped')
+    ax2.plot(x2, y2, '.-')
+    ax2.set_xlabel('time (s)')
+    ax2.set_ylabel('Undamped')
 
-    plt.savefig("two_subplots.png")
-    af.add_existing_file("two_subplots.png", remove=True)
+    af.save_figure(fig, "two_subplots")
+    plt.close(fig)
 
     return (list(x1), list(y1))
+
+def load_data(af, n):
+    return list(range(n))
+
+def scale_data(af, a):
+    return a * 10
+
+def slow_counted(af, counter_filepath):
+    with open(counter_filepath, 'a') as f:
+        f.write("x")
+    time.sleep(0.5)
+    return 1
+
+def allocate(af, n_bytes):
+    data = bytearray(n_bytes)
+    return len(data)
+
+def text_file(af, text):
+    for f in af.generate_file("%s.txt" % text):
+        f.write(text)
+    return text
+
+def read_text_file(af, text):
+    for f in af.read_file("%s.txt" % text, "text_file"):
+        return f.read()
+
+def resumable_sum(af, n, fail_at, counter_filepath):
+    state = af.restore({'i' : 0, 'total' : 0})
+    for i in range(state['i'], n):
+        if i == fail_at and not os.path.exists(counter_filepath + ".failed"):
+            open(counter_filepath + ".failed", 'w').close()
+            raise Exception("preempted")
+        with open(counter_filepath, 'a') as f:
+            f.write("x")
+        state = {'i' : i + 1, 'total' : state['total'] + i}
+        af.checkpoint(state)
+    return state['total']
+
+async def fetch(af, query, delay):
+    await asyncio.sleep(delay)
+    return query
+
+def blocking_fetch(af, query, delay):
+    time.sleep(delay)
+    return query
+
+def log_event(log_filepath, event):
+    with open(log_filepath, 'a') as f:
+        f.write("%s\n" % event)
+
+async def logged_fetch(af, query, delay, log_filepath):
+    log_event(log_filepath, "start")
+    await asyncio.sleep(delay)
+    log_event(log_filepath, "end")
+    return query
+
+def blocking_logged_fetch(af, query, delay, log_filepath):
+    log_event(log_filepath, "start")
+    time.sleep(delay)
+    log_event(log_filepath, "end")
+    return query
+
+def logged_allocate(af, n_bytes, log_filepath):
+    log_event(log_filepath, "start")
+    data = bytearray(n_bytes)
+    time.sleep(0.2)
+    log_event(log_filepath, "end")
+    return len(data)
+
+async def allocate_async(af, n_bytes):
+    data = bytearray(n_bytes)
+    await asyncio.sleep(0)
+    return len(data)
+
+async def dependencies_done(af):
+    return all((af.cache_dir(af.previous_functions[k]) / ("%s.pkl" % af.previous_functions[k])).exists()
+            for k in af.depends_function_keys)
+
+def count_words(af, path, counter_filepath):
+    with open(counter_filepath, 'a') as f:
+        f.write("x")
+    with open(path, 'r') as f:
+        return len(f.read().split())
+
+def total_words(af, results):
+    return sum(results.values())
+
+def table_files(af, n):
+    for f in af.generate_file("table.json"):
+        f.write("[%s]" % ", ".join('{"x" : %s}' % i for i in range(n)))
+    for f in af.generate_file("table.csv"):
+        f.write("x,y\n")
+        for i in range(n):
+            f.write("%s,%s\n" % (i, i * i))
+
+def line_figure(af, n, formats):
+    fig, ax = plt.subplots()
+    ax.plot(range(n))
+    af.save_figure(fig, "line", formats)
+    plt.close(fig)
+    return n
+
+def failing_figure(af, n, formats):
+    line_figure(af, n, formats)
+    raise ValueError("failed after saving a figure")
+
+def fail(af, message):
+    raise ValueError(message)
+
+def client_name(af, delay):
+    time.sleep(delay)
+    return CLIENT
@@ -0,0 +1,86 @@
+from precipy.main import render_data_async
+from precipy.storage import LocalStorage
+import asyncio
+import os
+import tempfile
+import tests.analytics
+
+def render(config):
+    config['tempdir'] = tempfile.mkdtemp()
+    return asyncio.run(render_data_async(config, [tests.analytics]))
+
+def test_async_functions_run_concurrently():
+    log_filepath = os.path.join(tempfile.mkdtemp(), "events.txt")
+    config = {
+        'template' : """{{ a.function_output }} {{ b.function_output }} {{ c.function_output }}""",
+        # the blocking function takes the only executor thread
+        'executor_workers' : 1,
+        'analytics' : [
+            ['c', {'function_name' : 'blocking_logged_fetch', 'query' : 'c', 'delay' : 0.5, 'log_filepath' : log_filepath}],
+            ['a', {'function_name' : 'logged_fetch', 'query' : 'a', 'delay' : 0.5, 'log_filepath' : log_filepath}],
+            ['b', {'function_name' : 'logged_fetch', 'query' : 'b', 'delay' : 0.5, 'log_filepath' : log_filepath}],
+            ]
+        }
+    batch = render(config)
+    # every function started before any of them finished
+    with open(log_filepath, 'r') as f:
+        assert f.read().split() == ["start"] * 3 + ["end"] * 3
+
+    doc = list(batch.documents[batch.range_keys[0]].values())[0]
+    with open(doc.cache_filepath, 'r') as f:
+        assert f.read() == "a b c"
+    assert [af.from_cache for af in batch.functions[batch.range_keys[0]].values()] == [False, False, False]
+
+def test_async_depends_are_respected():
+    config = {
+        'template' : """{{ check.function_output }}""",
+        'analytics' : [
+            ['slow', {'function_name' : 'blocking_fetch', 'query' : 'x', 'delay' : 0.2}],
+            ['fast', {'function_name' : 'fetch', 'query' : 'y', 'delay' : 0}],
+            ['check', {'function_name' : 'dependencies_done', 'depends' : ['slow', 'fast']}],
+            ]
+        }
+    batch = render(config)
+    assert batch.functions[batch.range_keys[0]]['check'].function_output is True
+    assert list(batch.functions[batch.range_keys[0]]) == ['slow', 'fast', 'check']
+
+    batch = asyncio.run(render_data_async(dict(config), [tests.analytics]))
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[0]].values())
+
+def test_async_results_are_downloaded_from_storage():
+    storage = LocalStorage(tempfile.mkdtemp())
+    config = {
+        'template' : """{{ a.function_output }}""",
+        'analytics' : [['a', {'function_name' : 'fetch', 'query' : 'a', 'delay' : 0}]]
+        }
+    batch = render(dict(config, storages=[storage]))
+    assert not batch.functions[batch.range_keys[0]]['a'].from_cache
+
+    # a fresh local cache is filled from the storage
+    batch = render(dict(config, storages=[storage]))
+    af = batch.functions[batch.range_keys[0]]['a']
+    assert af.from_cache
+    assert af.function_output == 'a'
+
+def test_async_function_memory_is_recorded():
+    config = {
+        'track_allocations' : True,
+        'analytics' : [['allocate_async', {'n_bytes' : 10 * 1024 ** 2}]]
+        }
+    batch = render(config)
+    af = batch.functions[batch.range_keys[0]]['allocate_async']
+    assert af.function_peak_alloc_bytes >= 10 * 1024 ** 2
+
+def test_concurrent_function_memory_is_not_recorded():
+    config = {
+        'track_allocations' : True,
+        'analytics' : [
+            ['small', {'function_name' : 'allocate_async', 'n_bytes' : 1024 ** 2}],
+            ['large', {'function_name' : 'allocate_async', 'n_bytes' : 20 * 1024 ** 2}]
+            ]
+        }
+    batch = render(config)
+    functions = batch.functions[batch.range_keys[0]]
+    # measured together, each would be charged with the other's memory
+    assert functions['small'].function_peak_alloc_bytes is None
+    assert functions['large'].function_peak_alloc_bytes is None
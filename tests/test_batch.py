@@ -1,4 +1,7 @@
+from precipy import PrecipyException
 from precipy.batch import Batch
+from precipy.batch import generate_range_key
+from precipy.batch import parse_shard
 import tests.analytics
 import os
 
@@ -42,3 +45,69 @@ def test_range_analytics():
     config['ranges'] = { 'a' : [1,2,3], 'b' : { "start" : 1, "stop" : 9, "step" : 2 }}
     batch = Batch(config)
     batch.generate_analytics([tests.analytics])
+
+def test_range_invariant_functions_are_shared():
+    invariant_config = {
+        'template' : """a is {{ wavy_line_plot.args.a }}""",
+        'ranges' : { 'a' : [1, 2, 3] },
+        'analytics' : [
+            ['load_data', {'n' : 5}],
+            ['summary', {'function_name' : 'load_data', 'n' : 2, 'depends' : ['load_data']}],
+            ['scale_data', {'a' : 1, 'depends' : ['load_data']}],
+            ]
+        }
+    batch = Batch(invariant_config)
+    batch.analytics_modules = [tests.analytics]
+    assert batch.range_invariant_keys() == set(['load_data', 'summary'])
+
+    for range_env in batch.range_environments():
+        batch.init_range(range_env)
+        batch.generate_analytics([tests.analytics])
+
+    range_functions = list(batch.functions.values())
+    assert len(range_functions) == 3
+    assert all(fns['load_data'] is range_functions[0]['load_data'] for fns in range_functions)
+    assert all(fns['summary'] is range_functions[0]['summary'] for fns in range_functions)
+    assert len(set(fns['scale_data'].h for fns in range_functions)) == 3
+    assert [fns['scale_data'].function_output for fns in range_functions] == [10, 20, 30]
+    assert invariant_config['analytics'][1][1]['depends'] == ['load_data']
+
+def test_range_environments_are_lazy():
+    batch = Batch({'ranges' : { 'a' : list(range(1000)), 'b' : list(range(1000)) }})
+    envs = batch.range_environments()
+    assert next(envs) == {'a' : 0, 'b' : 0}
+    assert next(envs) == {'a' : 0, 'b' : 1}
+
+def test_range_environment_shards():
+    ranges = { 'a' : [1,2,3], 'b' : { "start" : 1, "stop" : 9, "step" : 2 }}
+    all_envs = list(Batch({'ranges' : ranges}).range_environments())
+    assert len(all_envs) == 12
+
+    shards = [list(Batch({'ranges' : ranges, 'shard' : "%s/5" % i}).range_environments())
+            for i in range(1, 6)]
+    assert sum(len(envs) for envs in shards) == 12
+    assert sorted(generate_range_key(e) for envs in shards for e in envs) == \
+            sorted(generate_range_key(e) for e in all_envs)
+
+def test_released_ranges_are_forgotten():
+    range_config = {
+        'ranges' : { 'a' : [1, 2, 3, 4] },
+        'analytics' : [['scale_data', {'a' : 1}]]
+        }
+    batch = Batch(dict(range_config, template="{{ keys | join(',') }}"))
+    batch.run([tests.analytics])
+    assert batch.processed_range_keys == ["a_1", "a_2", "a_3", "a_4"]
+    assert batch.range_keys == list(batch.functions) == ["a_4"]
+    # templates still see every range processed so far
+    with open(list(batch.documents["a_4"].values())[0].cache_filepath, 'r') as f:
+        assert f.read() == "a_1,a_2,a_3,a_4"
+
+def test_parse_shard():
+    assert parse_shard("1/1") == (0, 1)
+    assert parse_shard("3/4") == (2, 4)
+    for bad_shard in ["0/4", "5/4", "x", "1/0"]:
+        try:
+            parse_shard(bad_shard)
+            assert False, "should raise PrecipyException"
+        except PrecipyException:
+            pass
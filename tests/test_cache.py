@@ -0,0 +1,101 @@
+from precipy import PrecipyException
+from precipy.batch import Batch
+from precipy.cache import MemoryTier
+from precipy.cache import TieredCache
+from precipy.context import RenderContext
+from precipy.storage import LocalStorage
+import os
+import pytest
+import tempfile
+import tests.analytics
+
+def connected_storage():
+    storage = LocalStorage(tempfile.mkdtemp())
+    storage.init(Batch({}))
+    storage.connect()
+    return storage
+
+def write(cache, filename, text):
+    with open(cache.filepath(filename), 'w') as f:
+        f.write(text)
+    return cache.filepath(filename)
+
+def test_memory_tier_evicts_least_recently_used():
+    memory = MemoryTier(max_bytes=10)
+    memory.put("a", b"12345")
+    memory.put("b", b"12345")
+    assert memory.get("a") == b"12345"
+    memory.put("c", b"12345")
+    assert memory.get("b") is None
+    assert memory.get("a") == b"12345"
+    memory.put("d", b"12345678901")
+    assert memory.get("d") is None
+    assert memory.size == 10
+
+def test_hits_are_promoted():
+    storage = connected_storage()
+    writer = TieredCache(tempfile.mkdtemp(), [storage])
+    writer.store(write(writer, "abc.txt", "hello"))
+
+    memory = MemoryTier()
+    reader = TieredCache(tempfile.mkdtemp(), [storage], memory)
+    assert not reader.exists_locally("abc.txt")
+    assert reader.exists_remotely("abc.txt")
+    assert reader.read_bytes("abc.txt") == b"hello"
+    assert reader.exists_locally("abc.txt")
+    assert memory.get("abc.txt") == b"hello"
+
+    # memory is used without touching the other tiers
+    os.remove(reader.filepath("abc.txt"))
+    assert reader.read_bytes("abc.txt") == b"hello"
+
+    with pytest.raises(FileNotFoundError):
+        reader.read_bytes("missing.txt")
+
+def test_write_back_policies():
+    storages = [connected_storage(), connected_storage(), connected_storage()]
+    cache = TieredCache(tempfile.mkdtemp(), storages, MemoryTier(write_back="sync"),
+            write_back=["sync", "async", "none"])
+    public_urls = []
+    cache.store(write(cache, "abc.txt", "hello"), on_upload=public_urls.append)
+    assert cache.memory.get("abc.txt") == b"hello"
+    assert storages[0].cache_exists("abc.txt")
+    cache.flush()
+    assert storages[1].cache_exists("abc.txt")
+    assert not storages[2].cache_exists("abc.txt")
+    assert len(public_urls) == 2
+
+    with pytest.raises(PrecipyException):
+        TieredCache(tempfile.mkdtemp(), storages, write_back="sometimes")
+    with pytest.raises(PrecipyException):
+        TieredCache(tempfile.mkdtemp(), storages, write_back=["sync"])
+
+def test_batch_with_async_write_back():
+    storage_root = tempfile.mkdtemp()
+    config = {
+        'template' : """{{ load_data.function_output }}""",
+        'storages' : [LocalStorage(storage_root)],
+        'storage_write_back' : "async",
+        'tempdir' : tempfile.mkdtemp(),
+        'analytics' : [['load_data', {'n' : 3}]]
+        }
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[0]]['load_data']
+    assert batch.storages[0].cache_exists(af.metadata_cache_filename())
+
+    # a batch with an empty local cache gets the results from storage
+    batch = Batch(dict(config, tempdir=tempfile.mkdtemp(), storages=[LocalStorage(storage_root)]))
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[0]]['load_data']
+    assert af.from_cache
+    assert af.function_output == [0, 1, 2]
+
+def test_memory_tiers_are_shared_by_settings():
+    context = RenderContext()
+    small = Batch({ 'memory_cache_bytes' : 1024 }, context=context)
+    also_small = Batch({ 'memory_cache_bytes' : 1024 }, context=context)
+    large = Batch({ 'memory_cache_bytes' : 2048, 'memory_write_back' : "sync" }, context=context)
+    assert small.cache.memory is also_small.cache.memory
+    assert large.cache.memory is not small.cache.memory
+    assert (large.cache.memory.max_bytes, large.cache.memory.write_back) == (2048, "sync")
@@ -0,0 +1,55 @@
+from precipy.batch import Batch
+from precipy.storage import LocalStorage
+import os
+import pytest
+import tempfile
+import tests.analytics
+
+def test_interrupted_function_resumes_from_checkpoint():
+    storage_root = tempfile.mkdtemp()
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    def make_config():
+        return {
+            'template' : """{{ resumable_sum.function_output }}""",
+            'tempdir' : tempfile.mkdtemp(),
+            'storages' : [LocalStorage(storage_root)],
+            'analytics' : [['resumable_sum', {'n' : 10, 'fail_at' : 6, 'counter_filepath' : counter_filepath}]]
+            }
+
+    batch = Batch(make_config())
+    with pytest.raises(Exception, match="preempted"):
+        batch.run([tests.analytics])
+
+    # the rerun happens on another node, sharing only the storage
+    batch = Batch(make_config())
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[0]]['resumable_sum']
+    assert af.function_output == sum(range(10))
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x" * 10
+
+    # checkpoints are removed once the function completes
+    assert not af.cache.exists_locally(af.checkpoint_cache_filename())
+    assert not batch.storages[0].cache_exists(af.checkpoint_cache_filename())
+    assert af.restore() is None
+
+class CountingStorage(LocalStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deleted = []
+
+    def delete_cache(self, cache_filename):
+        self.deleted.append(cache_filename)
+        return super().delete_cache(cache_filename)
+
+def test_functions_without_checkpoints_delete_nothing():
+    storage = CountingStorage(tempfile.mkdtemp())
+    batch = Batch({
+        'template' : """{{ scale_data.function_output }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'storages' : [storage],
+        'analytics' : [['scale_data', {'a' : 2}]]
+        })
+    batch.run([tests.analytics])
+    assert batch.functions[batch.range_keys[0]]['scale_data'].function_output == 20
+    assert storage.deleted == []
@@ -0,0 +1,165 @@
+from concurrent.futures import ThreadPoolExecutor
+from precipy import PrecipyException
+from precipy.batch import Batch
+from precipy.distributed import Coordinator
+from precipy.distributed import Worker
+from precipy.distributed import expand_tasks
+from precipy.pack import write_pack
+from precipy.storage import LocalStorage
+from precipy.storage import PackStorage
+import os
+import pytest
+import tempfile
+import tests.analytics
+import time
+
+def node_config(storage_root):
+    """
+    Each node has its own local cache and a storage shared with other nodes.
+    """
+    return {
+        'template' : """{% for x in load_data.function_output %}{{ x }}{% endfor %} {{ scale_data.function_output }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'storages' : [LocalStorage(storage_root)],
+        'ranges' : { 'a' : [1, 2, 3] },
+        'analytics' : [
+            ['load_data', {'n' : 3}],
+            ['scale_data', {'a' : 1, 'depends' : ['load_data']}],
+            ]
+        }
+
+def test_expand_tasks():
+    batch = Batch(node_config(tempfile.mkdtemp()))
+    tasks = expand_tasks(batch, [tests.analytics])
+    # load_data is the same in every range so it only appears once
+    assert [t.key for t in tasks.values()] == ['load_data', 'scale_data', 'scale_data', 'scale_data']
+    load_data_h = list(tasks)[0]
+    assert all(t.depends == {'load_data' : load_data_h} for t in list(tasks.values())[1:])
+
+def test_leases():
+    storage = LocalStorage(tempfile.mkdtemp())
+    storage.init(Batch({}))
+    storage.connect()
+    assert storage.acquire_lease("abc", "worker-1", 60)
+    assert not storage.acquire_lease("abc", "worker-2", 60)
+    assert storage.acquire_lease("abc", "worker-1", 60)
+    storage.release_lease("abc", "worker-2")
+    assert not storage.acquire_lease("abc", "worker-2", 60)
+    storage.release_lease("abc", "worker-1")
+    assert storage.acquire_lease("abc", "worker-2", -1)
+    # expired leases can be taken over
+    assert storage.acquire_lease("abc", "worker-1", 60)
+
+def test_release_keeps_lease_taken_over():
+    storage = LocalStorage(tempfile.mkdtemp())
+    storage.init(Batch({}))
+    storage.connect()
+    assert storage.acquire_lease("abc", "worker-1", -1)
+    assert storage.acquire_lease("abc", "worker-2", 60)
+    storage.release_lease("abc", "worker-1")
+    assert not storage.acquire_lease("abc", "worker-3", 60)
+    storage.release_lease("abc", "worker-2")
+    assert storage.acquire_lease("abc", "worker-3", 60)
+
+def test_expired_leases_are_removed():
+    storage = LocalStorage(tempfile.mkdtemp())
+    storage.init(Batch({}))
+    storage.connect()
+    assert storage.acquire_lease("abc", "worker-1", -1)
+    assert storage.acquire_lease("abc", "worker-2", 60)
+    assert os.listdir(storage.lease_dir) == ["abc.lease"]
+
+    # left behind by a process which died after moving the lease aside
+    with open(storage.lease_dir / "abc.lease.123.expired", 'w') as f:
+        f.write("{}")
+    storage.release_lease("abc", "worker-2")
+    assert os.listdir(storage.lease_dir) == []
+
+def test_worker_and_coordinator():
+    storage_root = tempfile.mkdtemp()
+
+    worker_batch = Batch(node_config(storage_root))
+    worker = Worker(worker_batch, [tests.analytics], poll_seconds=0.1)
+    assert worker.run() == 4
+
+    coordinator_batch = Batch(node_config(storage_root))
+    coordinator = Coordinator(coordinator_batch, [tests.analytics], work=False, poll_seconds=0.1)
+    coordinator.run()
+
+    functions = coordinator_batch.functions[coordinator_batch.current_range_key]
+    assert functions['scale_data'].function_output == 30
+    assert functions['scale_data'].from_cache
+
+    doc = coordinator_batch.documents[coordinator_batch.current_range_key]['template.md']
+    with open(doc.cache_filepath, 'r') as f:
+        assert f.read() == "012 30"
+
+def test_worker_publishes_locally_cached_results():
+    storage_root = tempfile.mkdtemp()
+    config = node_config(storage_root)
+    # results are already in the worker's local cache but not in the storage
+    Batch(dict(config, storages=[])).run([tests.analytics])
+
+    worker = Worker(Batch(config), [tests.analytics], poll_seconds=0.1)
+    assert worker.run() == 4
+    tasks = expand_tasks(worker.batch, [tests.analytics])
+    assert all(worker.storage.cache_exists("%s.pkl" % h) for h in tasks)
+
+    coordinator_batch = Batch(node_config(storage_root))
+    Coordinator(coordinator_batch, [tests.analytics], work=False, poll_seconds=0.1).run()
+    assert coordinator_batch.functions[coordinator_batch.current_range_key]['scale_data'].from_cache
+
+def test_worker_with_manifest():
+    storage_root = tempfile.mkdtemp()
+    coordinator = Coordinator(Batch(node_config(storage_root)), [tests.analytics])
+    tasks = expand_tasks(coordinator.batch, [tests.analytics])
+    run_id = coordinator.publish_manifest(tasks)
+
+    worker = Worker(Batch(node_config(storage_root)), [tests.analytics], run_id=run_id)
+    assert list(worker.load_tasks()) == list(tasks)
+    assert worker.run() == 4
+
+def test_read_only_storage_is_rejected():
+    pack_filepath = os.path.join(tempfile.mkdtemp(), "cache.pack")
+    config = node_config(tempfile.mkdtemp())
+    write_pack(pack_filepath, Batch(config).cache, [])
+
+    batch = Batch(dict(config, storages=[PackStorage(pack_filepath)]))
+    with pytest.raises(PrecipyException, match="read only"):
+        Worker(batch, [tests.analytics])
+    with pytest.raises(PrecipyException, match="read only"):
+        Coordinator(batch, [tests.analytics])
+
+def failing_config(storage_root):
+    return {
+        'tempdir' : tempfile.mkdtemp(),
+        'storages' : [LocalStorage(storage_root)],
+        'analytics' : [
+            ['fail', {'message' : 'broken'}],
+            ['scale_data', {'a' : 1, 'depends' : ['fail']}],
+            ]
+        }
+
+def test_failed_tasks_stop_the_run():
+    storage_root = tempfile.mkdtemp()
+    coordinator = Coordinator(Batch(failing_config(storage_root)), [tests.analytics], work=False,
+            poll_seconds=0.1, timeout=30)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        coordinating = executor.submit(coordinator.run)
+        time.sleep(0.2)
+        worker = Worker(Batch(failing_config(storage_root)), [tests.analytics], poll_seconds=0.1)
+        with pytest.raises(ValueError, match="broken"):
+            worker.run()
+        with pytest.raises(PrecipyException, match="broken"):
+            coordinating.result(timeout=10)
+
+    # workers started later try the failed task again
+    worker = Worker(Batch(failing_config(storage_root)), [tests.analytics], poll_seconds=0.1)
+    with pytest.raises(ValueError, match="broken"):
+        worker.run()
+
+def test_coordinator_timeout():
+    coordinator = Coordinator(Batch(node_config(tempfile.mkdtemp())), [tests.analytics], work=False,
+            poll_seconds=0.1, timeout=0.3)
+    with pytest.raises(PrecipyException, match="timed out"):
+        coordinator.run()
@@ -0,0 +1,39 @@
+from precipy import AnalyticsException
+from precipy.batch import Batch
+import pytest
+import tempfile
+import tests.analytics
+
+def figure_config(formats, workers):
+    return {
+        'template' : """{{ line_figure.function_output }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'figure_workers' : workers,
+        'analytics' : [['line_figure', {'n' : 5, 'formats' : formats}]]
+        }
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_save_figure(workers):
+    batch = Batch(figure_config(["png", "svg"], workers))
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[0]]['line_figure']
+    assert sorted(af.files) == ["line.png", "line.svg", "metadata.pkl"]
+    with open(af.files["line.png"].cache_filepath, 'rb') as f:
+        assert f.read(8) == b"\x89PNG\r\n\x1a\n"
+    with open(af.files["line.svg"].cache_filepath, 'r') as f:
+        assert "<svg" in f.read()
+
+def test_save_figure_error():
+    batch = Batch(figure_config(["not-a-format"], 1))
+    with pytest.raises(AnalyticsException, match="line.not-a-format"):
+        batch.run([tests.analytics])
+    batch.context.shutdown()
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_figures_of_failed_functions_are_discarded(workers):
+    config = dict(figure_config(["png"], workers), analytics=[['failing_figure', {'n' : 5, 'formats' : ["png"]}]])
+    batch = Batch(config)
+    with pytest.raises(ValueError, match="failed after saving a figure"):
+        batch.run([tests.analytics])
+    batch.context.shutdown()
+    assert not list(batch.cachePath.rglob("*.png"))
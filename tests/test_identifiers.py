@@ -0,0 +1,96 @@
+from precipy.identifiers import fingerprint_fn
+from precipy.identifiers import hash_for_fn
+import functools
+import os
+import tests.analytics
+
+SCALE = 2
+
+def helper(x):
+    return x * SCALE
+
+def indirect_helper(x):
+    return helper(x) + 1
+
+def analytics(af, x):
+    return indirect_helper(x)
+
+def other_helper(x):
+    return x - SCALE
+
+scaled = lambda x: helper(x)
+shifted = lambda x: other_helper(x)
+
+def uses_lambdas(af, x):
+    return scaled(x) + shifted(x)
+
+def scale_by(x, scale):
+    return x * scale
+
+scale_by_three = functools.partial(scale_by, scale=3)
+
+def uses_partial(af, x):
+    return scale_by_three(x)
+
+def uses_module_constant(af):
+    return tests.analytics.CLIENT
+
+def uses_library(af):
+    return os.path.join("a", "b")
+
+def test_fingerprint_follows_helpers():
+    fingerprint = fingerprint_fn(analytics)
+    assert "tests.test_identifiers.analytics" in fingerprint
+    assert "tests.test_identifiers.indirect_helper" in fingerprint
+    assert "tests.test_identifiers.helper" in fingerprint
+    assert fingerprint["tests.test_identifiers.helper:SCALE"] == "2"
+
+def test_fingerprint_does_not_follow_library_code():
+    fingerprint = fingerprint_fn(uses_library)
+    assert fingerprint["tests.test_identifiers.uses_library:os"] == "module os"
+    assert not any(k.startswith("posixpath") for k in fingerprint)
+
+def test_fingerprint_ignores_precipy_source():
+    fingerprint = fingerprint_fn(tests.analytics.wavy_line_plot)
+    assert not any(k.startswith("precipy") for k in fingerprint)
+
+def test_hash_changes_when_helper_global_changes():
+    global SCALE
+    h = hash_for_fn(analytics, {'x' : 1})
+    assert hash_for_fn(analytics, {'x' : 1}) == h
+    SCALE = 3
+    try:
+        assert hash_for_fn(analytics, {'x' : 1}) != h
+    finally:
+        SCALE = 2
+    assert hash_for_fn(analytics, {'x' : 1}) == h
+
+def test_hash_changes_with_arguments():
+    assert hash_for_fn(analytics, {'x' : 1}) != hash_for_fn(analytics, {'x' : 2})
+
+def test_fingerprint_follows_each_lambda():
+    fingerprint = fingerprint_fn(uses_lambdas)
+    assert "tests.test_identifiers.<lambda>" in fingerprint
+    assert "tests.test_identifiers.<lambda>#2" in fingerprint
+    assert "tests.test_identifiers.helper" in fingerprint
+    assert "tests.test_identifiers.other_helper" in fingerprint
+
+def test_hash_changes_with_cache_format_version(monkeypatch):
+    import precipy.identifiers
+    h = hash_for_fn(analytics, {'x' : 1})
+    monkeypatch.setattr(precipy.identifiers, 'CACHE_FORMAT_VERSION', precipy.identifiers.CACHE_FORMAT_VERSION + 1)
+    assert hash_for_fn(analytics, {'x' : 1}) != h
+
+def test_fingerprint_follows_partials(monkeypatch):
+    fingerprint = fingerprint_fn(uses_partial)
+    assert "tests.test_identifiers.scale_by" in fingerprint
+    h = hash_for_fn(uses_partial, {'x' : 1})
+    monkeypatch.setitem(globals(), 'scale_by_three', functools.partial(scale_by, scale=4))
+    assert hash_for_fn(uses_partial, {'x' : 1}) != h
+
+def test_fingerprint_follows_module_attributes(monkeypatch):
+    fingerprint = fingerprint_fn(uses_module_constant)
+    assert fingerprint["tests.test_identifiers.uses_module_constant:tests.analytics.CLIENT"] == "None"
+    h = hash_for_fn(uses_module_constant, {})
+    monkeypatch.setattr(tests.analytics, 'CLIENT', "acme")
+    assert hash_for_fn(uses_module_constant, {}) != h
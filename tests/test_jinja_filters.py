@@ -0,0 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+from precipy.jinja_filters import highlight
+import precipy.jinja_filters as jinja_filters
+import os
+import tempfile
+
+def test_highlight():
+    html = highlight("x = 1")
+    assert "x" in html
+    assert html.startswith("<div")
+
+def test_highlight_memoized():
+    text = "def memoized(): pass"
+    first = highlight(text)
+    assert first is highlight(text)
+    assert highlight(text, lexer_name='text') != first
+
+def test_highlight_disk_cache():
+    cachePath = tempfile.mkdtemp()
+    text = "y = 2 # disk"
+    html = highlight(text, cachePath=cachePath)
+    jinja_filters.highlight_memory.clear()
+    cached_files = [f for _, _, files in os.walk(cachePath) for f in files]
+    assert len(cached_files) == 1
+    assert highlight(text, cachePath=cachePath) == html
+
+def test_highlight_memory_is_bounded():
+    for i in range(jinja_filters.HIGHLIGHT_MEMORY_SIZE + 10):
+        highlight("z = %s" % i)
+    assert len(jinja_filters.highlight_memory) == jinja_filters.HIGHLIGHT_MEMORY_SIZE
+
+def test_highlight_memory_is_shared_by_threads(monkeypatch):
+    monkeypatch.setattr(jinja_filters, "HIGHLIGHT_MEMORY_SIZE", 4)
+    texts = ["t = %s" % i for i in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: highlight(texts[i % 8]), range(400)))
+    assert all("t" in html for html in results)
+    assert len(jinja_filters.highlight_memory) <= 4
@@ -0,0 +1,57 @@
+from precipy.batch import Batch
+from precipy.locking import FileLock
+from precipy.locking import atomic_write
+import multiprocessing
+import os
+import tempfile
+import tests.analytics
+
+def test_atomic_write():
+    filepath = os.path.join(tempfile.mkdtemp(), "atomic.txt")
+    with atomic_write(filepath) as f:
+        f.write("hello")
+        assert not os.path.exists(filepath)
+    with open(filepath, 'r') as f:
+        assert f.read() == "hello"
+
+def test_atomic_write_error_keeps_old_file():
+    tempdir = tempfile.mkdtemp()
+    filepath = os.path.join(tempdir, "atomic.txt")
+    with atomic_write(filepath) as f:
+        f.write("old")
+    try:
+        with atomic_write(filepath) as f:
+            f.write("partial")
+            raise ValueError()
+    except ValueError:
+        pass
+    with open(filepath, 'r') as f:
+        assert f.read() == "old"
+    assert os.listdir(tempdir) == ["atomic.txt"]
+
+def test_file_lock_is_exclusive():
+    lock_filepath = os.path.join(tempfile.mkdtemp(), "test.lock")
+    with FileLock(lock_filepath):
+        assert not FileLock(lock_filepath).acquire(blocking=False)
+    other = FileLock(lock_filepath)
+    assert other.acquire(blocking=False)
+    other.release()
+
+def run_counted_batch(tempdir, counter_filepath):
+    batch = Batch({'tempdir' : tempdir})
+    batch.analytics_modules = [tests.analytics]
+    batch.init_range({})
+    batch.process_analytics_entry('slow_counted', {'counter_filepath' : counter_filepath}, {})
+
+def test_concurrent_runs_compute_once():
+    tempdir = tempfile.mkdtemp()
+    counter_filepath = os.path.join(tempdir, "counter.txt")
+    processes = [multiprocessing.Process(target=run_counted_batch, args=(tempdir, counter_filepath))
+            for _ in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert all(p.exitcode == 0 for p in processes)
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x"
@@ -0,0 +1,141 @@
+from precipy import PrecipyException
+from precipy.batch import Batch
+from precipy.distributed import Worker
+from precipy.distributed import expand_tasks
+from precipy.memory import MemoryLedger
+from precipy.memory import MemoryTracker
+from precipy.memory import parse_memory
+from precipy.scheduling import CostModel
+from precipy.storage import LocalStorage
+import os
+import pytest
+import tempfile
+import tests.analytics
+
+def test_parse_memory():
+    assert parse_memory(None) is None
+    assert parse_memory(1000) == 1000
+    assert parse_memory("512") == 512
+    assert parse_memory("2K") == 2048
+    assert parse_memory("1.5g") == int(1.5 * 1024 ** 3)
+    assert parse_memory("8GB") == 8 * 1024 ** 3
+    with pytest.raises(PrecipyException):
+        parse_memory("lots")
+
+def test_memory_tracker():
+    with MemoryTracker(track_rss=False, track_allocations=True) as tracker:
+        data = bytearray(10 * 1024 ** 2)
+    assert tracker.peak_rss_bytes is None
+    assert tracker.peak_alloc_bytes >= 10 * 1024 ** 2
+
+    with MemoryTracker(track_rss=False) as tracker:
+        pass
+    assert tracker.peak_rss_bytes is None
+    assert tracker.peak_alloc_bytes is None
+
+def test_overlapping_trackers_record_nothing():
+    with MemoryTracker(track_rss=False, track_allocations=True) as outer:
+        with MemoryTracker(track_rss=False, track_allocations=True) as inner:
+            data = bytearray(10 * 1024 ** 2)
+        del data
+    assert outer.peak_alloc_bytes is None
+    assert inner.peak_alloc_bytes is None
+
+    with MemoryTracker(track_rss=False, track_allocations=True) as tracker:
+        data = bytearray(10 * 1024 ** 2)
+    assert tracker.peak_alloc_bytes >= 10 * 1024 ** 2
+
+def test_memory_ledger():
+    ledger = MemoryLedger(tempfile.mkdtemp(), 100)
+    # a task is always admitted when nothing else is running
+    assert ledger.reserve("big", 500)
+    assert not ledger.reserve("small", 10)
+    ledger.release("big")
+    assert ledger.reserve("a", 60)
+    assert ledger.reserve("b", 40)
+    assert not ledger.reserve("c", 1)
+    assert ledger.reservations() == { "a" : 60, "b" : 40 }
+
+def test_ledger_drops_dead_processes():
+    ledger = MemoryLedger(tempfile.mkdtemp(), 100)
+    assert ledger.reserve("a", 100)
+    with open(ledger.reservation_filepath("a"), 'w') as f:
+        # a pid larger than any pid_max
+        f.write('{"bytes" : 100, "pid" : 999999999, "time" : 0}')
+    assert ledger.reservations() == {}
+    assert not os.path.exists(ledger.reservation_filepath("a"))
+
+def test_function_memory_is_recorded():
+    config = {
+        'tempdir' : tempfile.mkdtemp(),
+        'track_allocations' : True,
+        'analytics' : [['allocate', {'n_bytes' : 10 * 1024 ** 2}]]
+        }
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[0]]['allocate']
+    assert af.function_peak_alloc_bytes >= 10 * 1024 ** 2
+    assert af.function_metadata()['function_peak_alloc_bytes'] == af.function_peak_alloc_bytes
+    assert batch.function_summary['allocate']['calls'] == 1
+
+    cost_model = CostModel(batch.cachePath)
+    assert cost_model.estimate_memory(cost_model.cost_key(af)) >= 10 * 1024 ** 2
+
+def test_partition_memory_is_tracked_one_at_a_time():
+    config = {
+        'tempdir' : tempfile.mkdtemp(),
+        'track_allocations' : True,
+        'analytics' : [['allocate', {'partition' : {'n_bytes' : [10 * 1024 ** 2, 20 * 1024 ** 2]}}]]
+        }
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    functions = batch.functions[batch.range_keys[0]]
+    for n_bytes in (10 * 1024 ** 2, 20 * 1024 ** 2):
+        peak = functions['allocate[%s]' % n_bytes].function_peak_alloc_bytes
+        assert n_bytes <= peak < n_bytes + 5 * 1024 ** 2
+
+    # partitions run in parallel aren't measured
+    batch = Batch(dict(config, tempdir=tempfile.mkdtemp(), partition_workers=2))
+    batch.run([tests.analytics])
+    functions = batch.functions[batch.range_keys[0]]
+    assert functions['allocate[%s]' % (10 * 1024 ** 2)].function_peak_alloc_bytes is None
+
+def test_max_memory_limits_parallel_functions():
+    tempdir = tempfile.mkdtemp()
+    log_filepath = os.path.join(tempfile.mkdtemp(), "events.txt")
+    def config(sizes, **kwargs):
+        return dict({
+            'tempdir' : tempdir,
+            'memory_poll_seconds' : 0.05,
+            'analytics' : [['logged_allocate', {'partition' : {'n_bytes' : sizes}, 'log_filepath' : log_filepath}]]
+            }, **kwargs)
+
+    def run(sizes, **kwargs):
+        if os.path.exists(log_filepath):
+            os.remove(log_filepath)
+        Batch(config(sizes, **kwargs)).run([tests.analytics])
+        with open(log_filepath, 'r') as f:
+            return f.read().split()
+
+    mb = 1024 ** 2
+    # learn how much memory the function uses
+    run([10 * mb], track_allocations=True)
+    assert run([10 * mb + 1, 10 * mb + 2], partition_workers=2) == ["start", "start", "end", "end"]
+    # two calls don't fit in the budget, so they run one at a time
+    assert run([10 * mb + 3, 10 * mb + 4], partition_workers=2, max_memory="15M") == ["start", "end", "start", "end"]
+
+def test_workers_reserve_memory_separately():
+    config = {
+        'tempdir' : tempfile.mkdtemp(),
+        'storages' : [LocalStorage(tempfile.mkdtemp())],
+        'analytics' : [['scale_data', {'a' : 1}]]
+        }
+    worker_a = Worker(Batch(config), [tests.analytics], max_memory="1G")
+    worker_b = Worker(Batch(config), [tests.analytics], max_memory="1G")
+    task = list(expand_tasks(worker_a.batch, [tests.analytics]).values())[0]
+    assert worker_a.reserve_memory(task)
+    # b loses the lease for the task and releases its own reservation only
+    assert worker_b.reserve_memory(task)
+    worker_b.release_memory(task)
+    assert list(worker_a.memory_ledger.reservations()) == [worker_a.reservation_name(task)]
+    worker_a.release_memory(task)
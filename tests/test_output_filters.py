@@ -0,0 +1,95 @@
+from precipy import ReportFilterException
+from precipy.output_filters import FilterEngine
+import os
+import precipy.output_filters as output_filters
+import tempfile
+import time
+
+def write_input(text="# Hello"):
+    work_dir = tempfile.mkdtemp()
+    with open(os.path.join(work_dir, "doc.md"), 'w') as f:
+        f.write(text)
+    return work_dir
+
+def read_output(work_dir):
+    with open(os.path.join(work_dir, "doc.html"), 'r') as f:
+        return f.read()
+
+def test_markdown_in_process():
+    engine = FilterEngine()
+    work_dir = write_input()
+    future = engine.submit("markdown", work_dir, "doc.md", "doc.html", "html", {})
+    engine.wait(future, "doc.html")
+    assert read_output(work_dir) == "<h1>Hello</h1>"
+
+def test_markdown_in_worker_processes():
+    engine = FilterEngine(workers=2)
+    work_dirs = [write_input("# Doc %s" % i) for i in range(4)]
+    futures = [engine.submit("markdown", d, "doc.md", "doc.html", "html", {}) for d in work_dirs]
+    for future in futures:
+        engine.wait(future, "doc.html")
+    engine.shutdown()
+    assert [read_output(d) for d in work_dirs] == ["<h1>Doc %s</h1>" % i for i in range(4)]
+
+def do_shout(input_filepath, output_filepath, output_ext, filter_args):
+    with open(input_filepath, 'r') as i_f:
+        with open(output_filepath, 'w') as o_f:
+            o_f.write(i_f.read().upper())
+
+def test_custom_filter():
+    engine = FilterEngine(custom_filter_fns=[do_shout])
+    work_dir = write_input()
+    engine.wait(engine.submit("shout", work_dir, "doc.md", "doc.html", "html", {}), "doc.html")
+    assert read_output(work_dir) == "# HELLO"
+
+def test_unknown_filter():
+    try:
+        FilterEngine().submit("nosuchfilter", write_input(), "doc.md", "doc.html", "html", {})
+        assert False, "should raise ReportFilterException"
+    except ReportFilterException:
+        pass
+
+def test_missing_executable():
+    engine = FilterEngine(executables={'pandoc' : "/does/not/exist/pandoc"})
+    future = engine.submit("pandoc", write_input(), "doc.md", "doc.html", "html", {})
+    try:
+        engine.wait(future, "doc.html")
+        assert False, "should raise ReportFilterException"
+    except ReportFilterException:
+        pass
+
+def do_which_pandoc(input_filepath, output_filepath, output_ext, filter_args):
+    with open(output_filepath, 'w') as o_f:
+        o_f.write(output_filters.executable('pandoc', 'pandoc'))
+
+def test_executables_are_per_engine():
+    engine = FilterEngine(executables={'pandoc' : "/opt/pandoc"}, custom_filter_fns=[do_which_pandoc])
+    other_engine = FilterEngine(executables={'pandoc' : "/usr/local/pandoc"}, custom_filter_fns=[do_which_pandoc])
+    work_dir = write_input()
+    engine.wait(engine.submit("which_pandoc", work_dir, "doc.md", "doc.html", "html", {}), "doc.html")
+    assert read_output(work_dir) == "/opt/pandoc"
+    other_engine.wait(other_engine.submit("which_pandoc", work_dir, "doc.md", "doc.html", "html", {}), "doc.html")
+    assert read_output(work_dir) == "/usr/local/pandoc"
+    # outside of a filter, the default is used
+    assert output_filters.executable('pandoc', "/bin/pandoc") == "/bin/pandoc"
+
+def do_sleep(input_filepath, output_filepath, output_ext, filter_args):
+    time.sleep(filter_args['seconds'])
+
+def test_timed_out_documents_are_abandoned():
+    engine = FilterEngine(workers=1, timeout=0.5, custom_filter_fns=[do_sleep])
+    engine.wait(engine.submit("sleep", write_input(), "doc.md", "doc.html", "html", {'seconds' : 0}), "warmup")
+    processes = list(engine.pools["sleep"]._processes.values())
+    future = engine.submit("sleep", write_input(), "doc.md", "doc.html", "html", {'seconds' : 30})
+    started = time.time()
+    try:
+        engine.wait(future, "doc.html", "sleep")
+        assert False, "should raise ReportFilterException"
+    except ReportFilterException:
+        pass
+    engine.shutdown()
+    assert time.time() - started < 2.5
+    # the worker stuck in the filter is stopped, so it can't hold up exit
+    for process in processes:
+        process.join(5)
+        assert not process.is_alive()
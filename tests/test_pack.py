@@ -0,0 +1,70 @@
+from precipy.batch import Batch
+from precipy.main import export_cache
+from precipy.main import import_cache
+from precipy.pack import PackReader
+from precipy.storage import PackStorage
+import json
+import os
+import tempfile
+import tests.analytics
+
+def write_config(counter_filepath):
+    config_filepath = os.path.join(tempfile.mkdtemp(), "config.json")
+    with open(config_filepath, 'w') as f:
+        json.dump({
+            'template' : """{{ text_file.function_output }} {{ slow_counted.function_output }}""",
+            'tempdir' : tempfile.mkdtemp(),
+            'ranges' : { 'text' : ["a", "b"] },
+            'analytics' : [
+                ['text_file', {'text' : "a"}],
+                ['slow_counted', {'counter_filepath' : counter_filepath}]
+                ]
+            }, f)
+    return config_filepath
+
+def load_config(config_filepath, **kwargs):
+    with open(config_filepath, 'r') as f:
+        config = json.load(f)
+    config.update(kwargs)
+    return config
+
+def test_export_and_import():
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    config_filepath = write_config(counter_filepath)
+    Batch(load_config(config_filepath)).run([tests.analytics])
+
+    pack_filepath = os.path.join(tempfile.mkdtemp(), "cache.pack")
+    # text_file for each range, its text files, and slow_counted once
+    assert export_cache(pack_filepath, config_filepath, [tests.analytics]) == 5
+    assert export_cache(pack_filepath + ".a", config_filepath, [tests.analytics], range_keys=["text_a"]) == 3
+
+    # seed a fresh cache, which then doesn't need to run anything
+    fresh_filepath = write_config(counter_filepath)
+    assert import_cache(pack_filepath, fresh_filepath) == 5
+    assert import_cache(pack_filepath, fresh_filepath) == 0
+    batch = Batch(load_config(fresh_filepath))
+    batch.run([tests.analytics])
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[-1]].values())
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x"
+
+def test_pack_storage():
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    config_filepath = write_config(counter_filepath)
+    batch = Batch(load_config(config_filepath))
+    batch.run([tests.analytics])
+    af = batch.functions[batch.range_keys[-1]]['text_file']
+
+    pack_filepath = os.path.join(tempfile.mkdtemp(), "cache.pack")
+    export_cache(pack_filepath, config_filepath, [tests.analytics])
+    reader = PackReader(pack_filepath)
+    with open(af.files["b.txt"].cache_filepath, 'rb') as f:
+        assert reader.read_bytes(af.files["b.txt"].cache_filepath.name) == f.read()
+
+    pack_size = os.path.getsize(pack_filepath)
+    batch = Batch(load_config(write_config(counter_filepath), storages=[PackStorage(pack_filepath)]))
+    batch.run([tests.analytics])
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[-1]].values())
+    assert os.path.getsize(pack_filepath) == pack_size
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x"
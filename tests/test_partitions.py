@@ -0,0 +1,64 @@
+from precipy.batch import Batch
+from precipy.distributed import expand_tasks
+import os
+import tempfile
+import tests.analytics
+
+def write_inputs(data_dir, texts):
+    for name, text in texts.items():
+        with open(os.path.join(data_dir, name), 'w') as f:
+            f.write(text)
+
+def test_only_changed_partitions_recompute():
+    data_dir = tempfile.mkdtemp()
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    write_inputs(data_dir, {"a.txt" : "one", "b.txt" : "one two", "c.txt" : "one two three"})
+    config = {
+        'template' : """{{ count_words.function_output }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'analytics' : [
+            ['count_words', {
+                'partition' : {'path' : {'glob' : os.path.join(data_dir, "*.txt")}},
+                'reduce' : 'total_words',
+                'counter_filepath' : counter_filepath
+                }]
+            ]
+        }
+
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    functions = batch.functions[batch.range_keys[0]]
+    assert functions['count_words'].function_output == 6
+    assert functions['count_words[%s]' % os.path.join(data_dir, "b.txt")].function_output == 2
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "xxx"
+
+    write_inputs(data_dir, {"b.txt" : "one two two two"})
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    functions = batch.functions[batch.range_keys[0]]
+    assert functions['count_words'].function_output == 8
+    assert not functions['count_words'].from_cache
+    assert [af.from_cache for af in functions['count_words'].partition_functions.values()] == [True, False, True]
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "xxxx"
+
+def test_partitions_without_reduce():
+    config = {
+        'template' : """{{ load_data.function_output[2] }} {{ scale_data.function_output }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'partition_workers' : 2,
+        'analytics' : [
+            ['load_data', {'partition' : {'n' : [1, 2, 3]}}],
+            ['scale_data', {'a' : 1, 'depends' : ['load_data']}]
+            ]
+        }
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    functions = batch.functions[batch.range_keys[0]]
+    assert functions['load_data'].function_output == {1 : [0], 2 : [0, 1], 3 : [0, 1, 2]}
+    assert functions['load_data[3]'].function_output == [0, 1, 2]
+
+    tasks = expand_tasks(Batch(config), [tests.analytics])
+    assert [t.key for t in tasks.values()] == ['load_data[1]', 'load_data[2]', 'load_data[3]', 'load_data', 'scale_data']
+    assert list(tasks.values())[3].depends == dict((k, functions[k].h) for k in ('load_data[1]', 'load_data[2]', 'load_data[3]'))
@@ -0,0 +1,94 @@
+from precipy.batch import Batch
+from precipy.storage import LocalStorage
+import os
+import shutil
+import tempfile
+import tests.analytics
+import threading
+import time
+
+class SlowStorage(LocalStorage):
+    """
+    A storage with high latency, which records what was downloaded.
+    """
+    def __init__(self, root):
+        super().__init__(root)
+        self.downloaded = []
+        self.lock = threading.Lock()
+
+    def _download_cache(self, cache_filename, cache_filepath):
+        time.sleep(0.1)
+        found = super()._download_cache(cache_filename, cache_filepath)
+        if found:
+            with self.lock:
+                self.downloaded.append(cache_filename)
+        return found
+
+def make_config(storage_root, template="{{ text_file.function_output }}", analytics=None):
+    return {
+        'template' : template,
+        'tempdir' : tempfile.mkdtemp(),
+        'storages' : [SlowStorage(storage_root)],
+        'ranges' : { 'text' : ["a", "b", "c", "d", "e", "f"] },
+        'analytics' : analytics or [['text_file', {'text' : 'x'}]]
+        }
+
+def test_cold_cache_is_prefetched_in_parallel():
+    storage_root = tempfile.mkdtemp()
+    Batch(make_config(storage_root)).run([tests.analytics])
+
+    batch = Batch(make_config(storage_root))
+    start_time = time.time()
+    batch.run([tests.analytics])
+    # 6 metadata files and 6 supplemental files, 0.1s latency each
+    assert time.time() - start_time < 0.8
+    assert len(batch.storages[0].downloaded) == 12
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[-1]].values())
+
+def test_files_nothing_reads_are_not_prefetched():
+    storage_root = tempfile.mkdtemp()
+    config = make_config(storage_root)
+    Batch(config).run([tests.analytics])
+
+    # the output locations already have every file, so only metadata is needed
+    shutil.rmtree(os.path.join(config['tempdir'], "precipy", "cache"))
+    batch = Batch(dict(config, storages=[SlowStorage(storage_root)]))
+    batch.run([tests.analytics])
+    assert all(filename.endswith(".pkl") for filename in batch.storages[0].downloaded)
+
+    # a function which has to run reads the file it depends on
+    analytics = [['text_file', {'text' : 'x'}], ['read_text_file', {'text' : 'x', 'depends' : ['text_file']}]]
+    config = make_config(storage_root, analytics=[analytics[0]])
+    Batch(config).run([tests.analytics])
+    batch = Batch(make_config(storage_root, template="{{ read_text_file.function_output }}", analytics=analytics))
+    batch.run([tests.analytics])
+    assert len([f for f in batch.storages[0].downloaded if f.endswith(".txt")]) == 6
+    assert batch.functions[batch.range_keys[-1]]['read_text_file'].function_output == "f"
+
+class CountingBatch(Batch):
+    """
+    Records how many ranges each prefetch covered.
+    """
+    def prefetch(self, analytics_modules, range_envs=None):
+        self.prefetched = getattr(self, 'prefetched', [])
+        self.prefetched.append(len(range_envs))
+        return super().prefetch(analytics_modules, range_envs)
+
+def test_ranges_are_prefetched_in_chunks():
+    storage_root = tempfile.mkdtemp()
+    Batch(make_config(storage_root)).run([tests.analytics])
+
+    batch = CountingBatch(dict(make_config(storage_root), prefetch_ranges=4))
+    batch.run([tests.analytics])
+    assert batch.prefetched == [4, 2]
+    assert len(batch.storages[0].downloaded) == 12
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[-1]].values())
+
+def test_prefetch_can_be_turned_off():
+    storage_root = tempfile.mkdtemp()
+    Batch(make_config(storage_root)).run([tests.analytics])
+
+    batch = CountingBatch(dict(make_config(storage_root), prefetch=False))
+    batch.run([tests.analytics])
+    assert not hasattr(batch, 'prefetched')
+    assert all(af.from_cache for af in batch.functions[batch.range_keys[-1]].values())
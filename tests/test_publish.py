@@ -0,0 +1,102 @@
+from precipy.batch import Batch
+from precipy.publish import OutputDirectory
+from precipy.publish import MANIFEST_FILENAME
+from precipy.storage import LocalStorage
+import json
+import os
+import tempfile
+import tests.analytics
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+def test_output_directory_sync():
+    src = tempfile.mkdtemp()
+    dest = os.path.join(tempfile.mkdtemp(), "out")
+    a = write_file(os.path.join(src, "a.txt"), "a")
+    b = write_file(os.path.join(src, "b.txt"), "b")
+
+    output_dir = OutputDirectory(dest)
+    assert sorted(output_dir.publish({"a.txt" : ("1", a), "x/b.txt" : ("2", b)})) == ["a.txt", "x/b.txt"]
+    assert output_dir.finish() == []
+
+    output_dir = OutputDirectory(dest)
+    assert output_dir.publish({"a.txt" : ("1", a), "x/b.txt" : ("2", b)}) == []
+    output_dir.finish()
+
+    output_dir = OutputDirectory(dest)
+    assert output_dir.publish({"a.txt" : ("3", b)}) == ["a.txt"]
+    assert output_dir.finish() == ["x/b.txt"]
+    assert sorted(os.listdir(dest)) == [MANIFEST_FILENAME, "a.txt"]
+    with open(os.path.join(dest, "a.txt"), 'r') as f:
+        assert f.read() == "b"
+
+class RecordingStorage(LocalStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.uploaded = []
+
+    def upload_output(self, canonical_filename, cache_filepath):
+        self.uploaded.append(canonical_filename)
+        return super().upload_output(canonical_filename, cache_filepath)
+
+def run_batch(tempdir, storage_root, template):
+    batch = Batch({
+        'template' : template,
+        'tempdir' : tempdir,
+        'storages' : [RecordingStorage(storage_root)],
+        'ranges' : { 'a' : [1, 2] },
+        'analytics' : [['scale_data', {'a' : 1}]]
+        })
+    batch.run([tests.analytics])
+    return batch.storages[0]
+
+def test_republishing_uploads_only_changes():
+    tempdir = tempfile.mkdtemp()
+    storage_root = tempfile.mkdtemp()
+
+    storage = run_batch(tempdir, storage_root, "{{ scale_data.function_output }}")
+    assert sorted(storage.uploaded) == ["a_1/metadata.pkl", "a_1/template.md",
+            "a_2/metadata.pkl", "a_2/template.md"]
+
+    storage = run_batch(tempdir, storage_root, "{{ scale_data.function_output }}")
+    assert storage.uploaded == []
+
+    storage = run_batch(tempdir, storage_root, "value {{ scale_data.function_output }}")
+    assert sorted(storage.uploaded) == ["a_1/template.md", "a_2/template.md"]
+    with open(os.path.join(storage_root, "output", "a_2", "template.md"), 'r') as f:
+        assert f.read() == "value 20"
+
+def run_shard(tempdir, storage_root, shard, ranges=(1, 2, 3, 4)):
+    batch = Batch({
+        'template' : "{{ scale_data.function_output }}",
+        'tempdir' : tempdir,
+        'storages' : [LocalStorage(storage_root)],
+        'shard' : shard,
+        'ranges' : { 'a' : list(ranges) },
+        'analytics' : [['scale_data', {'a' : 1}]]
+        })
+    batch.run([tests.analytics])
+    return batch
+
+def published_ranges(output_root):
+    return sorted(d for d in os.listdir(output_root) if d.startswith("a_") and os.listdir(os.path.join(output_root, d)))
+
+def test_shards_publish_to_the_same_output():
+    tempdir = tempfile.mkdtemp()
+    storage_root = tempfile.mkdtemp()
+    for shard in ["1/2", "2/2"]:
+        batch = run_shard(tempdir, storage_root, shard)
+
+    for output_root in [batch.outputPath, os.path.join(storage_root, "output")]:
+        assert published_ranges(output_root) == ["a_1", "a_2", "a_3", "a_4"]
+        with open(os.path.join(output_root, MANIFEST_FILENAME), 'r') as f:
+            assert sorted(json.load(f)) == ["a_%s/%s" % (a, name) for a in range(1, 5)
+                    for name in ("metadata.pkl", "template.md")]
+
+    # an unsharded run owns every range, so removes ranges no longer rendered
+    batch = run_shard(tempdir, storage_root, "1/1", ranges=(1, 2))
+    for output_root in [batch.outputPath, os.path.join(storage_root, "output")]:
+        assert published_ranges(output_root) == ["a_1", "a_2"]
@@ -1,4 +1,12 @@
+from precipy import PrecipyException
 from precipy.main import render_data
+from precipy.main import render_files
+from precipy.storage import LocalStorage
+import json
+import logging
+import os
+import pytest
+import tempfile
 import tests.analytics
 
 def test_render_data():
@@ -15,3 +23,98 @@ def test_render_data():
     final_doc = list(batch.documents.values())[0]
     with open(final_doc.cache_filepath, 'r') as f:
         assert f.read() == "a is 7"
+
+def write_client_config(config_dir, client, tempdir, storage_root, counter_filepath, **kwargs):
+    filepath = os.path.join(config_dir, "%s.json" % client)
+    with open(filepath, 'w') as f:
+        json.dump(dict({
+            'template' : """{{ CLIENT }} {{ slow_counted.function_output }} {{ client_name.function_output }}""",
+            'tempdir' : tempdir,
+            'local_storage_path' : storage_root,
+            'constants' : { 'CLIENT' : client },
+            'analytics' : [
+                ['slow_counted', {'counter_filepath' : counter_filepath}],
+                ['client_name', {'delay' : 0.2}]
+                ]
+            }, **kwargs), f)
+    return filepath
+
+def test_render_files():
+    config_dir = tempfile.mkdtemp()
+    tempdir = tempfile.mkdtemp()
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    clients = ("acme", "globex", "initech")
+    filepaths = [write_client_config(config_dir, client, tempdir, tempfile.mkdtemp(), counter_filepath)
+            for client in clients]
+    storage = LocalStorage()
+    n_handlers = len(logging.getLogger("precipy").handlers)
+
+    batches = render_files(filepaths, [tests.analytics], storages=[storage], workers=3)
+
+    # the shared function is computed once, functions using constants run
+    # with their own config's, and each config publishes separately
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x"
+    for client, batch in zip(clients, batches):
+        assert batch.context is batches[0].context
+        assert batch.functions[batch.range_keys[0]]['client_name'].function_output == client
+        with open(batch.outputPath / "template.md", 'r') as f:
+            assert f.read() == "%s 1 %s" % (client, client)
+        with open(storage.output_dir / client / "template.md", 'r') as f:
+            assert f.read() == "%s 1 %s" % (client, client)
+    assert tests.analytics.CLIENT is None
+
+    # the storage was connected once, for the first config to use it
+    assert len(batches[0].context.connected_storages) == 1
+
+    # batches don't leave log handlers behind
+    render_files(filepaths, [tests.analytics], storages=[LocalStorage()], workers=3)
+    assert len(logging.getLogger("precipy").handlers) == n_handlers
+
+def test_render_files_sharing_template_file():
+    config_dir = tempfile.mkdtemp()
+    template_dir = tempfile.mkdtemp()
+    tempdir = tempfile.mkdtemp()
+    with open(os.path.join(template_dir, "report.md"), 'w') as f:
+        f.write("""# {{ client_name.function_output }}""")
+    clients = ("acme", "globex")
+    filepaths = []
+    for client in clients:
+        filepaths.append(os.path.join(config_dir, "%s.json" % client))
+        with open(filepaths[-1], 'w') as f:
+            json.dump({
+                'template_file' : "report.md",
+                'template_dir' : template_dir,
+                'tempdir' : tempdir,
+                'constants' : { 'CLIENT' : client },
+                'filters' : [["markdown", "html"]],
+                'analytics' : [['client_name', {'delay' : 0.2}]]
+                }, f)
+
+    batches = render_files(filepaths, [tests.analytics], workers=2)
+
+    # the same template rendered with each config's data is saved and
+    # filtered separately
+    template_filepaths = set()
+    for client, batch in zip(clients, batches):
+        documents = batch.documents[batch.range_keys[0]]
+        template_filepaths.add(documents["report.md"].cache_filepath)
+        with open(documents["report.md"].cache_filepath, 'r') as f:
+            assert f.read() == "# %s" % client
+        with open(documents["report.html"].cache_filepath, 'r') as f:
+            assert f.read() == "<h1>%s</h1>" % client
+        with open(batch.outputPath / "report.html", 'r') as f:
+            assert f.read() == "<h1>%s</h1>" % client
+    assert len(template_filepaths) == 2
+
+def test_render_files_sharing_storage_need_same_buckets():
+    config_dir = tempfile.mkdtemp()
+    tempdir = tempfile.mkdtemp()
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    filepaths = [
+        write_client_config(config_dir, "acme", tempdir, tempfile.mkdtemp(), counter_filepath),
+        write_client_config(config_dir, "globex", tempdir, tempfile.mkdtemp(), counter_filepath,
+            output_bucket_name="globex-output")
+        ]
+    with pytest.raises(PrecipyException, match="output_bucket_name"):
+        render_files(filepaths, [tests.analytics], storages=[LocalStorage()])
@@ -0,0 +1,73 @@
+from precipy.batch import Batch
+from precipy.distributed import Task
+from precipy.scheduling import CostModel
+from precipy.scheduling import Plan
+from precipy.scheduling import arg_shape
+from precipy.scheduling import critical_path_priorities
+from precipy.scheduling import estimate_wall_time
+from precipy.scheduling import order_by_priority
+import collections
+import tempfile
+import tests.analytics
+
+def make_tasks(*specs):
+    tasks = collections.OrderedDict()
+    for h, depends in specs:
+        tasks[h] = Task(h, h, {}, {}, dict((d, d) for d in depends), "")
+    return tasks
+
+def test_critical_path_priorities():
+    # a -> b -> c, and a short independent task d
+    tasks = make_tasks(("a", []), ("b", ["a"]), ("c", ["b"]), ("d", []))
+    costs = { "a" : 1, "b" : 2, "c" : 3, "d" : 4 }
+    priorities = critical_path_priorities(tasks, costs)
+    assert priorities == { "a" : 6, "b" : 5, "c" : 3, "d" : 4 }
+    assert [t.h for t in order_by_priority(tasks, priorities)] == ["a", "b", "d", "c"]
+
+def test_estimate_wall_time():
+    tasks = make_tasks(("short1", []), ("short2", []), ("long", []))
+    costs = { "short1" : 2, "short2" : 2, "long" : 7200 }
+    assert estimate_wall_time(tasks, costs, 1) == 7204
+    # the long task starts first, so the short ones fit alongside it
+    assert estimate_wall_time(tasks, costs, 2) == 7200
+
+def test_arg_shape():
+    assert arg_shape({'a' : 1, 'b' : [1, 2], 'depends' : ['x']}) == [('a', 'int'), ('b', 'list', 2)]
+    assert arg_shape({'a' : 1}) == arg_shape({'a' : 2})
+
+def test_cost_model():
+    cachePath = tempfile.mkdtemp()
+    cost_model = CostModel(cachePath)
+    assert cost_model.estimate("abc") is None
+    cost_model.record("abc", 2.0)
+    cost_model.record("abc", 4.0)
+    assert cost_model.estimate("abc") == 3.0
+    # records are only written when flushed
+    other_model = CostModel(cachePath)
+    assert other_model.estimate("abc") is None
+    cost_model.flush()
+    assert CostModel(cachePath).estimate("abc") == 3.0
+
+    # flushing merges records from other processes
+    other_model.record("abc", 6.0)
+    other_model.flush()
+    assert other_model.estimate("abc") == 4.0
+    assert CostModel(cachePath).estimate("abc") == 4.0
+
+def test_plan():
+    config = {
+        'tempdir' : tempfile.mkdtemp(),
+        'ranges' : { 'a' : [1, 2] },
+        'analytics' : [['load_data', {'n' : 3}], ['scale_data', {'a' : 1, 'depends' : ['load_data']}]]
+        }
+    plan = Plan(Batch(config), [tests.analytics])
+    assert [e.cached for e in plan.entries] == [None, None, None]
+    assert "3 tasks: 0 cached, 3 to run" in plan.summary()
+
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    assert len(batch.cost_model.history["seconds"]) == 2
+
+    plan = Plan(Batch(config), [tests.analytics], workers=2)
+    assert [e.cached for e in plan.entries] == ["local", "local", "local"]
+    assert plan.wall_seconds == 0
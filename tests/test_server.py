@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+from precipy.server import RenderService
+from precipy.server import make_server
+import json
+import logging
+import os
+import pytest
+import socket
+import tempfile
+import tests.analytics
+import threading
+import urllib.error
+import urllib.request
+
+@pytest.fixture
+def server():
+    service = RenderService([tests.analytics], defaults={ 'tempdir' : tempfile.mkdtemp() })
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+def post(server, path, data):
+    url = "http://%s:%s%s" % (server.server_address[0], server.server_address[1], path)
+    request = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'),
+            headers={ "Content-Type" : "application/json" })
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def counted_config(counter_filepath, template):
+    return {
+        'template' : template,
+        'analytics' : [['slow_counted', {'counter_filepath' : counter_filepath}]]
+        }
+
+def test_identical_requests_are_coalesced(server):
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    config = counted_config(counter_filepath, "{{ slow_counted.function_output }}")
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: post(server, "/render", config), range(4)))
+
+    assert all(result == results[0] for result in results)
+    status = server.service.status()
+    assert status["requests"] == 4
+    assert status["rendered"] == 1
+
+    doc = list(list(results[0]["documents"].values())[0].values())[0]
+    assert doc["content"] == "1"
+
+def test_shared_functions_are_computed_once(server):
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    configs = [counted_config(counter_filepath, "request %s" % i) for i in range(3)]
+
+    with ThreadPoolExecutor(3) as executor:
+        list(executor.map(lambda config: post(server, "/render", config), configs))
+
+    assert server.service.status()["rendered"] == 3
+    with open(counter_filepath, 'r') as f:
+        assert f.read() == "x"
+
+def test_requests_publish_separately(server):
+    server.service.keep_outputs = True
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    configs = [counted_config(counter_filepath, "request %s" % i) for i in range(2)]
+    for config in configs:
+        post(server, "/render", config)
+
+    # finishing the second request didn't remove the first one's documents
+    output_root = os.path.join(server.service.defaults['tempdir'], "precipy", "output")
+    for i, config in enumerate(configs):
+        with open(os.path.join(output_root, server.service.request_key(config), "template.md"), 'r') as f:
+            assert f.read() == "request %s" % i
+
+def test_requests_with_different_constants(server):
+    configs = [{
+        'template' : "{{ client_name.function_output }}",
+        'constants' : { 'CLIENT' : client },
+        'analytics' : [['client_name', {'delay' : 0.2}]]
+        } for client in ("acme", "globex", "initech")]
+
+    with ThreadPoolExecutor(3) as executor:
+        results = list(executor.map(lambda config: post(server, "/render", config), configs))
+
+    for client, result in zip(("acme", "globex", "initech"), results):
+        doc = list(list(result["documents"].values())[0].values())[0]
+        assert doc["content"] == client
+    assert tests.analytics.CLIENT is None
+
+def test_requests_dont_add_log_handlers(server):
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    post(server, "/render", counted_config(counter_filepath, "first"))
+    n_handlers = len(logging.getLogger("precipy").handlers)
+    post(server, "/render", counted_config(counter_filepath, "second"))
+    assert len(logging.getLogger("precipy").handlers) == n_handlers
+
+def test_outputs_are_removed(server):
+    counter_filepath = os.path.join(tempfile.mkdtemp(), "counter")
+    config = counted_config(counter_filepath, "removed")
+    result = post(server, "/render", config)
+
+    doc = list(list(result["documents"].values())[0].values())[0]
+    assert doc["content"] == "removed"
+    assert not "path" in doc
+    output_root = os.path.join(server.service.defaults['tempdir'], "precipy", "output")
+    assert not os.path.exists(os.path.join(output_root, server.service.request_key(config)))
+    assert not os.path.exists(os.path.join("output", server.service.request_key(config)))
+
+def test_ranges_are_described_separately(server):
+    result = post(server, "/render", {
+        'template' : "a={{ scale_data.function_output }}",
+        'ranges' : { 'a' : [1, 2, 3] },
+        'analytics' : [['scale_data', { 'a' : 1 }]]
+        })
+    contents = sorted(list(docs.values())[0]["content"] for docs in result["documents"].values())
+    assert contents == ["a=10", "a=20", "a=30"]
+
+def test_bad_requests(server):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(server, "/nowhere", {})
+    assert e.value.code == 404
+
+@pytest.mark.parametrize("config", [
+    { 'template' : "x", 'filter_executables' : { 'pandoc' : "/bin/sh" } },
+    { 'template' : "x", 'tempdir' : "/tmp/elsewhere" },
+    { 'template' : "x", 'filters' : [["pandoc", "pdf"]] },
+    { 'template' : "x", 'filters' : [["markdown", "../html"]] },
+    { 'template' : "x", 'constants' : { 'os' : None } },
+    { 'template' : "x", 'analytics' : { 'scale_data' : { 'a' : 1 } } }
+    ])
+def test_disallowed_requests(server, config):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(server, "/render", config)
+    assert e.value.code == 400
+    assert server.service.status()["rendered"] == 0
+
+@pytest.mark.parametrize("template", [
+    "{{ batch.config }}",
+    "{{ read_file_contents('/etc/passwd') }}",
+    "{{ ''.__class__.__mro__ }}",
+    "{{ read_file_contents('../../../cache/x') }}"
+    ])
+def test_templates_are_sandboxed(server, template):
+    try:
+        result = post(server, "/render", { 'template' : template })
+    except urllib.error.HTTPError as e:
+        assert e.code == 400
+    else:
+        doc = list(list(result["documents"].values())[0].values())[0]
+        assert not "root:" in doc["content"]
+        assert not "tempdir" in doc["content"]
+        assert not "object" in doc["content"]
+
+def test_unix_socket():
+    socket_path = os.path.join(tempfile.mkdtemp(), "precipy.sock")
+    service = RenderService([tests.analytics])
+    server = make_server(service, socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+        client.sendall(b"GET /status HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+        assert response.startswith(b"HTTP/1.0 200")
+        assert json.loads(response.split(b"\r\n\r\n", 1)[1])["requests"] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,6 +1,7 @@
 from pathlib import Path
 from precipy.analytics_function import AnalyticsFunction
 from precipy.batch import Batch
+from precipy.cache import TieredCache
 from precipy.storage import GoogleCloudStorage
 import os
 
@@ -26,12 +27,12 @@ def test_connect():
     assert str(storage.output_storage_bucket) == "<Bucket: precipy_testing_output>"
 
 def test_upload_and_download():
-    af.storages = [storage]
+    af.cache = TieredCache(af.cachePath, [storage])
     af.run_function()
     public_url = af.files["metadata.pkl"].public_urls[0]
     assert public_url.endswith(af.metadata_cache_filename())
 
-    result = af.download_from_storages(af.metadata_cache_filepath())
+    result = af.cache.fetch(af.metadata_cache_filename())
     assert result
 
 def test_invalid_upload():
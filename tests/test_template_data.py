@@ -0,0 +1,61 @@
+from precipy.batch import Batch
+from precipy.template_data import ParsedFileCache
+from precipy.template_data import TemplateDataReader
+import os
+import tempfile
+import tests.analytics
+
+def write(filepath, text):
+    with open(filepath, 'w') as f:
+        f.write(text)
+
+def test_parsed_files_are_memoized_by_content():
+    tempdir = tempfile.mkdtemp()
+    parsed_files = ParsedFileCache()
+    reader = TemplateDataReader(parsed_files, lambda path: os.path.join(tempdir, path))
+    write(os.path.join(tempdir, "a.json"), '{"a" : 1}')
+    write(os.path.join(tempdir, "b.json"), '{"a" : 1}')
+
+    a = reader.load_json("a.json")
+    assert a == {"a" : 1}
+    assert reader.load_json("a.json") is a
+    # same contents at another path are parsed once
+    assert reader.load_json("b.json") is a
+
+    write(os.path.join(tempdir, "a.json"), '{"a" : 2, "b" : 3}')
+    assert reader.load_json("a.json") == {"a" : 2, "b" : 3}
+    assert reader.read_file_contents("a.json") == '{"a" : 2, "b" : 3}'
+
+def test_csv_readers():
+    tempdir = tempfile.mkdtemp()
+    reader = TemplateDataReader(ParsedFileCache(), lambda path: os.path.join(tempdir, path))
+    write(os.path.join(tempdir, "t.csv"), "x,y,z\n1,2,3\n4,5,6\n")
+    assert list(reader.csv_rows("t.csv")) == [{"x" : "1", "y" : "2", "z" : "3"}, {"x" : "4", "y" : "5", "z" : "6"}]
+    assert reader.csv_columns("t.csv", ["x", "z"]) == {"x" : ["1", "4"], "z" : ["3", "6"]}
+    assert list(reader.csv_columns("t.csv")) == ["x", "y", "z"]
+
+    # a column name containing a comma is memoized separately
+    write(os.path.join(tempdir, "u.csv"), '"a,b",a,b\n1,2,3\n')
+    assert reader.csv_columns("u.csv", ["a,b"]) == {"a,b" : ["1"]}
+    assert reader.csv_columns("u.csv", ["a", "b"]) == {"a" : ["2"], "b" : ["3"]}
+
+def test_text_newlines_are_translated():
+    tempdir = tempfile.mkdtemp()
+    reader = TemplateDataReader(ParsedFileCache(), lambda path: os.path.join(tempdir, path))
+    with open(os.path.join(tempdir, "t.txt"), 'wb') as f:
+        f.write(b"one\r\ntwo\rthree\n")
+    assert reader.read_file_contents("t.txt") == "one\ntwo\nthree\n"
+
+def test_templates_read_files_generated_in_this_run():
+    config = {
+        'template' : """{% for row in load_json('table.json') %}{{ row.x }}{% endfor %} """
+            """{% for row in csv_rows('table.csv') %}{{ row.y }};{% endfor %} """
+            """{{ csv_columns('table.csv', ['y'])['y'] | join(',') }}""",
+        'tempdir' : tempfile.mkdtemp(),
+        'analytics' : [['table_files', {'n' : 4}]]
+        }
+    batch = Batch(config)
+    batch.run([tests.analytics])
+    doc = batch.documents[batch.range_keys[0]]['template.md']
+    with open(doc.cache_filepath, 'r') as f:
+        assert f.read() == "0123 0;1;4;9; 0,1,4,9"